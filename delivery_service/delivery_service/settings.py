@@ -231,3 +231,80 @@ CORS_ALLOWED_HEADERS = [
     'x-csrftoken',
     'x-requested-with',
 ]
+
+# Геокодирование адресов
+GEOCODE_CACHE_TTL = 30 * 24 * 60 * 60  # seconds a found address stays cached
+GEOCODE_NEGATIVE_CACHE_TTL = 24 * 60 * 60  # seconds a "not found" answer stays cached
+GEOCODE_MEMORY_CACHE_SIZE = 10000  # entries in the in-process LRU
+GEOCODER_BACKEND = os.environ.get('GEOCODER_BACKEND', 'nominatim')  # 'nominatim' or 'gazetteer'
+if GEOCODER_BACKEND == 'gazetteer':
+    # Offline lookups from a CSV/JSONL file with address, lat, lon columns
+    GEOCODER_OPTIONS = {'path': os.environ.get('GEOCODER_GAZETTEER_PATH', os.path.join(BASE_DIR, 'gazetteer.csv'))}
+else:
+    GEOCODER_OPTIONS = {'timeout': 10, 'min_interval': 1.0}
+
+# Фоновые задачи (геокодирование новых заказов)
+ORDERS_BACKGROUND_TASKS = True  # False runs them synchronously after commit
+
+# Распределение заказов
+ORDER_DISTRIBUTION_MODE = 'per_courier'  # 'per_courier' (one TSP per courier), 'global' (one VRP for all couriers) or 'cluster' (one VRP per area)
+ORDER_CANDIDATE_RADIUS_KM = 15.0  # orders farther from a courier are not offered to them
+ORDER_CANDIDATES_PER_SLOT = 3  # nearest orders per free courier slot in the global model
+ORDER_GRID_CELL_KM = 1.0  # cell size of the spatial index over unassigned orders
+ORDER_INCREMENTAL_DISPATCH = False  # insert new orders into courier routes as soon as they are geocoded
+ORDER_BATCH_DISPATCH = {
+    # Collect new orders and solve them together instead of inserting each one
+    'enabled': os.getenv('ORDER_BATCH_DISPATCH', '') == '1',
+    'window_seconds': 60.0,  # a batch is solved this long after its first order...
+    'max_batch': 200,  # ...or as soon as it holds this many orders
+    'max_pending': 2000,  # waiting orders beyond this are inserted one by one
+}
+DISTRIBUTION_JOB_RUNNER = os.getenv('DISTRIBUTION_JOB_RUNNER', 'thread')  # 'worker': jobs wait for manage.py run_distribution_worker
+DISTRIBUTION_JOB_HEARTBEAT_SECONDS = 30  # how often a running job reports that it is alive
+DISTRIBUTION_JOB_TIMEOUT_SECONDS = 300  # a running job without a heartbeat this long is marked failed
+# Parallel dispatch workers (manage.py dispatch_worker) each claim one partition at a time
+DISPATCH_PARTITION_BY = 'vehicle'  # or 'zone'
+DISPATCH_ZONES = {
+    # name: (min_lat, min_lon, max_lat, max_lon)
+}
+ORDER_SLA_MINUTES = 60  # orders without deliver_by are due this long after creation and are served by due time
+ORDER_QUEUE_WINDOW = 500  # unassigned orders read per query when walking the queue
+DISPATCH_CLUSTER_ORDERS = 150  # orders per area in 'cluster' mode
+DISPATCH_ORDER_BATCH_SIZE = 2000  # unassigned orders one run locks at most
+DISPATCH_PROFILE = os.getenv('DISPATCH_PROFILE') or None  # 'cpu' or 'memory' profiles every run
+DISPATCH_SNAPSHOT_DIR = os.getenv('DISPATCH_SNAPSHOT_DIR') or None  # writes the inputs of every run there for replay_dispatch
+ORDER_SOLVER = {
+    # Search budget of the routing solver, see orders.order_distribution.SolverSettings
+    'time_limit_per_node': 0.1,  # seconds per routed node
+    'min_time_limit': 1.0,
+    'max_time_limit': 30.0,
+    'exact_max_nodes': 8,  # solved exactly by dynamic programming
+    'guided_local_search_min_nodes': 15,
+    'lack_of_improvement_seconds': 2.0,
+}
+ORDER_SOLVER_PROCESSES = int(os.getenv('ORDER_SOLVER_PROCESSES', 1))  # worker processes for route solving; 1 solves in-process
+ORDER_SOLVER_TASKS_PER_CHILD = 200  # solves before a worker process is replaced
+# Travel time model: road distance = straight line x detour_factor, driven at speed_kmh
+VEHICLE_PROFILES = {
+    'Автомобиль': {'speed_kmh': 25.0, 'detour_factor': 1.4},
+    'Мотоцикл': {'speed_kmh': 30.0, 'detour_factor': 1.35},
+    'Велосипед': {'speed_kmh': 14.0, 'detour_factor': 1.25},
+}
+DEFAULT_VEHICLE_PROFILE = {'speed_kmh': 20.0, 'detour_factor': 1.3}
+# Distances between stops: 'haversine' (straight line) or 'road_network' (shortest paths
+# over a local OSM extract, see orders.road_network; detour_factor is then ignored)
+DISTANCE_PROVIDER = os.getenv('DISTANCE_PROVIDER', 'haversine')
+ROAD_NETWORK = {
+    'path': os.getenv('ROAD_NETWORK_PATH', ''),  # .geojson or .osm.pbf (needs osmium)
+    'cache_dir': os.getenv('ROAD_NETWORK_CACHE_DIR') or None,  # parsed graph cache, default: next to the extract
+    'snap_radius_km': 0.5,  # points farther from any road use straight-line distances
+}
+# Cache of road distances between quantized points, see orders.distance_cache
+DISTANCE_CACHE = {
+    'enabled': True,
+    'dir': os.getenv('DISTANCE_CACHE_DIR', str(BASE_DIR / 'distance_cache')),  # shared by all processes
+    'precision': 4,  # decimal places of the coordinates in a key, 4 = ~11 m
+    'memory_pairs': 200000,  # in-process LRU size
+    'disk_points': 4096,  # most frequent points kept in the memory-mapped table (64 MB)
+    'persist_interval': 300,  # seconds between rewrites of the table
+}
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Customer, Courier, Order, User
+from .models import Customer, Courier, Order, User, DistributionJob, DispatchRun, CourierRoute
 
 @admin.register(User)
 class UserAdmin(admin.ModelAdmin):
@@ -14,13 +14,31 @@ class CustomerAdmin(admin.ModelAdmin):
 
 @admin.register(Courier)
 class CourierAdmin(admin.ModelAdmin):
-    list_display = ('name', 'email', 'phone', 'vehicle', 'balance', 'get_monthly_orders_count')
+    list_display = ('name', 'email', 'phone', 'vehicle', 'balance', 'active_orders', 'get_monthly_orders_count')
     search_fields = ('name', 'email', 'phone')
 
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
     list_display = ('id', 'customer', 'courier', 'status', 'address', 'description', 'created_at', 'delivery_date')
-    list_filter = ('status', 'created_at', 'delivery_date')
+    list_filter = ('status', 'geocode_status', 'created_at', 'delivery_date')
     search_fields = ('customer__name', 'courier__name', 'address', 'description')
     ordering = ('-created_at',)
-    readonly_fields = ('created_at', 'updated_at') 
\ No newline at end of file
+    readonly_fields = ('created_at', 'updated_at', 'lat', 'lon') 
+
+@admin.register(DistributionJob)
+class DistributionJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'status', 'mode', 'dry_run', 'assigned_count', 'created_by', 'created_at', 'finished_at', 'applied_at')
+    list_filter = ('status', 'mode', 'dry_run')
+    ordering = ('-created_at',)
+
+@admin.register(DispatchRun)
+class DispatchRunAdmin(admin.ModelAdmin):
+    list_display = ('id', 'mode', 'partition', 'assigned_count', 'duration_s', 'profile_mode', 'created_at')
+    list_filter = ('mode', 'profile_mode')
+    readonly_fields = ('created_at',)
+    ordering = ('-created_at',)
+
+@admin.register(CourierRoute)
+class CourierRouteAdmin(admin.ModelAdmin):
+    list_display = ('courier', 'length_km', 'updated_at')
+    readonly_fields = ('updated_at',)
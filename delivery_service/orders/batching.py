@@ -0,0 +1,212 @@
+"""Time-windowed batching of new orders for incremental dispatch.
+
+With ORDER_BATCH_DISPATCH enabled, new orders are not inserted one by one
+but collected until the window closes or the batch is full, and then solved
+together against the couriers' current routes by distribute_orders().
+
+Batch membership lives in the database: a queued order carries the time
+its batch is due in Order.batch_due_at. Each process's scheduler only
+decides when to wake up; a batch it flushes also takes the due orders other
+processes queued, and a new scheduler picks up the orders still queued
+from before a restart.
+"""
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Order
+from .tasks import run_in_background
+
+logger = logging.getLogger(__name__)
+
+
+class BatchScheduler:
+    """Collects order ids and hands them to dispatch(batch) in windows.
+
+    A batch is flushed window_seconds after its first order arrived, or as
+    soon as it holds max_batch orders. Only one batch is solved at a time.
+    Backpressure: when solves take longer than the window, the window
+    stretches to the last solve time so batches grow instead of queueing up;
+    beyond max_pending waiting orders add() refuses new ones and the caller
+    dispatches them some other way.
+    """
+
+    def __init__(self, dispatch, window_seconds=60.0, max_batch=200, max_pending=2000,
+                 clock=time.monotonic, run=None):
+        self.dispatch = dispatch
+        self.window_seconds = window_seconds
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.clock = clock
+        self.run = run or (lambda func, *args: run_in_background(func, *args, queue='batch-dispatch'))
+        self.pending = []
+        self.opened_at = None
+        self.solving = False
+        self.last_solve_seconds = 0.0
+        self._timer = None
+        self._lock = threading.Lock()
+
+    @property
+    def window(self):
+        return max(self.window_seconds, self.last_solve_seconds)
+
+    def add(self, order_id):
+        """Queue an order; returns False when the backlog is full"""
+        with self._lock:
+            if len(self.pending) >= self.max_pending:
+                return False
+            self.pending.append(order_id)
+            if self.opened_at is None:
+                self.opened_at = self.clock()
+            due = self._take_due_batch()
+            if due is None:
+                self._arm_timer()
+        if due:
+            self.run(self._solve, due)
+        return True
+
+    def flush_due(self):
+        """Start the next batch if its window closed or it is full; returns whether one started"""
+        with self._lock:
+            due = self._take_due_batch()
+            if due is None:
+                self._arm_timer()
+        if due:
+            self.run(self._solve, due)
+        return bool(due)
+
+    def _take_due_batch(self):
+        # Called with the lock held
+        if self.solving or not self.pending:
+            return None
+        full = len(self.pending) >= self.max_batch
+        if not full and self.clock() - self.opened_at < self.window:
+            return None
+        batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+        self.opened_at = self.clock() if self.pending else None
+        self.solving = True
+        return batch
+
+    def _arm_timer(self):
+        # Called with the lock held; one timer for the open window, none while solving
+        if self._timer is not None or self.solving or self.opened_at is None:
+            return
+        delay = max(self.opened_at + self.window - self.clock(), 0.0)
+        self._timer = threading.Timer(delay, self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+        self.flush_due()
+
+    def _solve(self, batch):
+        started = self.clock()
+        try:
+            self.dispatch(batch)
+        except Exception:
+            logger.exception(f"Batch dispatch of {len(batch)} orders failed")
+        finally:
+            with self._lock:
+                self.solving = False
+                self.last_solve_seconds = self.clock() - started
+                if self.last_solve_seconds > self.window_seconds:
+                    logger.warning(
+                        f"Batch of {len(batch)} orders took {self.last_solve_seconds:.1f}s, "
+                        f"longer than the {self.window_seconds:.0f}s window; {len(self.pending)} orders waiting"
+                    )
+        self.flush_due()
+
+    def cancel(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+
+def queued_orders(due_before=None):
+    """Ids of unassigned orders waiting for a batch, earliest due first"""
+    orders = Order.objects.filter(courier__isnull=True, batch_due_at__isnull=False)
+    if due_before is not None:
+        orders = orders.filter(batch_due_at__lte=due_before)
+    return list(orders.order_by('batch_due_at', 'id').values_list('id', flat=True))
+
+
+def dispatch_batch(order_ids):
+    """Solve one batch of new orders together against the current courier routes.
+
+    Due orders queued by other processes join the batch, up to max_batch.
+    Orders the batch could not place are left to the next full distribution.
+    """
+    from .order_distribution import distribute_orders
+    max_batch = getattr(settings, 'ORDER_BATCH_DISPATCH', {}).get('max_batch', 200)
+    order_ids = list(order_ids)
+    batch = set(order_ids)
+    others = [order_id for order_id in queued_orders(timezone.now()) if order_id not in batch]
+    order_ids.extend(others[:max(max_batch - len(order_ids), 0)])
+    result = distribute_orders(order_ids=order_ids)
+    Order.objects.filter(id__in=order_ids).update(batch_due_at=None)
+    logger.info(f"Batch dispatch: {result.get('assigned', 0)} of {len(order_ids)} orders assigned")
+    return result
+
+
+def enqueue_order(order_id):
+    """Queue a new order for its batch; returns False when the backlog is full"""
+    scheduler = get_batch_scheduler()
+    due_at = timezone.now() + timedelta(seconds=scheduler.window)
+    Order.objects.filter(pk=order_id, courier__isnull=True, batch_due_at__isnull=True).update(batch_due_at=due_at)
+    if scheduler.add(order_id):
+        return True
+    Order.objects.filter(pk=order_id).update(batch_due_at=None)
+    return False
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def batching_enabled():
+    return getattr(settings, 'ORDER_BATCH_DISPATCH', {}).get('enabled', False)
+
+
+def get_batch_scheduler():
+    """The process-wide scheduler configured by ORDER_BATCH_DISPATCH.
+
+    A new scheduler takes over the orders still queued in the database, e.g.
+    by a process that was restarted before it flushed them.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is not None:
+            return _scheduler
+        options = getattr(settings, 'ORDER_BATCH_DISPATCH', {})
+        _scheduler = scheduler = BatchScheduler(
+            dispatch_batch,
+            window_seconds=options.get('window_seconds', 60.0),
+            max_batch=options.get('max_batch', 200),
+            max_pending=options.get('max_pending', 2000),
+        )
+    queued = queued_orders()
+    if queued:
+        logger.info(f"Requeued {len(queued)} orders waiting for batch dispatch")
+    for order_id in queued:
+        if not scheduler.add(order_id):
+            break
+    return scheduler
+
+
+@receiver(setting_changed)
+def _reset_scheduler(setting, **kwargs):
+    global _scheduler
+    if setting == 'ORDER_BATCH_DISPATCH':
+        with _scheduler_lock:
+            if _scheduler is not None:
+                _scheduler.cancel()
+            _scheduler = None
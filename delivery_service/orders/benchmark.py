@@ -0,0 +1,145 @@
+"""Synthetic city generator and runner for dispatch benchmarks (see manage.py benchmark_dispatch)"""
+import logging
+import resource
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from decimal import Decimal
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Sum
+
+from .geocoding import GazetteerGeocoder, get_geocoder, normalize_address, set_geocoder
+from .models import Courier, CourierRoute, Order
+from .order_distribution import KM_PER_DEGREE, distribute_orders
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_VEHICLE_MIX = {'Автомобиль': 0.5, 'Мотоцикл': 0.3, 'Велосипед': 0.2}
+
+
+@dataclass
+class City:
+    """Couriers and orders of a synthetic city, plus the gazetteer that geocodes its addresses"""
+    couriers: list
+    orders: list
+    gazetteer: dict = field(default_factory=dict)
+
+
+def generate_city(couriers, orders, vehicle_mix=None, center=(55.7558, 37.6173), radius_km=15.0,
+                  hotspots=8, seed=0):
+    """Build unsaved couriers and orders scattered around a few demand hotspots.
+
+    Orders carry addresses only; their coordinates live in the returned
+    gazetteer so that a run also exercises the geocoding phase.
+    """
+    rng = np.random.default_rng(seed)
+    vehicle_mix = vehicle_mix or DEFAULT_VEHICLE_MIX
+    vehicles = list(vehicle_mix)
+    weights = np.array([vehicle_mix[vehicle] for vehicle in vehicles], dtype=np.float64)
+    weights /= weights.sum()
+
+    lat_scale = 1 / KM_PER_DEGREE
+    lon_scale = 1 / (KM_PER_DEGREE * np.cos(np.radians(center[0])))
+    spots = rng.uniform(-radius_km, radius_km, (hotspots, 2)) * 0.6
+
+    def scatter(count, spread_km):
+        offsets = spots[rng.integers(0, hotspots, count)] + rng.normal(0, spread_km, (count, 2))
+        offsets = np.clip(offsets, -radius_km, radius_km)
+        return np.column_stack([center[0] + offsets[:, 0] * lat_scale, center[1] + offsets[:, 1] * lon_scale])
+
+    courier_points = scatter(couriers, radius_km / 4)
+    courier_rows = [
+        Courier(
+            name=f'Курьер {i}',
+            email=f'benchmark-courier-{seed}-{i}@example.com',
+            phone='+70000000000',
+            vehicle=vehicles[rng.choice(len(vehicles), p=weights)],
+            current_location_lat=Decimal(f'{lat:.6f}'),
+            current_location_lon=Decimal(f'{lon:.6f}'),
+        )
+        for i, (lat, lon) in enumerate(courier_points)
+    ]
+
+    gazetteer = {}
+    order_rows = []
+    for i, (lat, lon) in enumerate(scatter(orders, radius_km / 8)):
+        address = f'Синтетическая ул., {seed}-{i}'
+        gazetteer[normalize_address(address)] = (float(lat), float(lon))
+        order_rows.append(Order(address=address, description='benchmark'))
+    return City(courier_rows, order_rows, gazetteer)
+
+
+def measure_run(mode, courier_ids, order_ids, trace_memory=True, profile=None, partition=None):
+    """Run one distribution pass over the given couriers and orders and measure it.
+
+    Other rows in the database are neither dispatched nor locked. Returns
+    the result dict of run_mode() without the city size, and the id of the
+    DispatchRun record.
+    """
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    result = distribute_orders(mode=mode, profile=profile, partition=partition,
+                               order_ids=order_ids, courier_ids=courier_ids)
+    wall = time.perf_counter() - started
+    peak = None
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    totals = CourierRoute.objects.filter(courier_id__in=courier_ids).aggregate(
+        km=Sum('length_km'), minutes=Sum('duration_min')
+    )
+    assigned = result.get('assigned', 0)
+    return {
+        'mode': mode,
+        'assigned': assigned,
+        'error': result.get('error'),
+        'wall_seconds': round(wall, 4),
+        'phase_seconds': {phase: round(seconds, 4) for phase, seconds in result.get('phase_timings', {}).items()},
+        'assignments_per_second': round(assigned / wall, 2) if wall > 0 else None,
+        'route_km': round(totals['km'] or 0.0, 3),
+        'route_minutes': round(totals['minutes'] or 0.0, 1),
+        'peak_python_mb': round(peak / 2 ** 20, 2) if peak is not None else None,
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }, result.get('run_id')
+
+
+def run_mode(city, mode, trace_memory=True):
+    """Load the city, run one distribution pass and measure it; all rows are rolled back.
+
+    tracemalloc slows allocation-heavy code down, so wall times taken with
+    trace_memory are only comparable with each other.
+    """
+    previous_geocoder = get_geocoder()
+    set_geocoder(GazetteerGeocoder(index=city.gazetteer))
+    try:
+        with transaction.atomic():
+            couriers = Courier.objects.bulk_create(city.couriers)
+            orders = Order.objects.bulk_create(city.orders)
+            result, _ = measure_run(
+                mode, [courier.id for courier in couriers], [order.id for order in orders], trace_memory
+            )
+            transaction.set_rollback(True)
+    finally:
+        set_geocoder(previous_geocoder)
+        # bulk_create set primary keys on the shared objects; the next run creates them again
+        for row in [*city.couriers, *city.orders]:
+            row.pk = None
+
+    return {'mode': mode, 'couriers': len(city.couriers), 'orders': len(city.orders), **result}
+
+
+def run_benchmark(couriers, orders, modes, repeat=1, trace_memory=True, **city_options):
+    """Run every mode `repeat` times on the same synthetic city; returns one result dict per run"""
+    city = generate_city(couriers, orders, **city_options)
+    results = []
+    for mode in modes:
+        for run in range(repeat):
+            result = run_mode(city, mode, trace_memory)
+            result['run'] = run
+            logger.info(f"Benchmark {mode} #{run}: {result['assigned']} orders in {result['wall_seconds']}s")
+            results.append(result)
+    return results
@@ -0,0 +1,222 @@
+"""Record the inputs of a dispatch run and replay them offline (see manage.py replay_dispatch).
+
+With DISPATCH_SNAPSHOT_DIR set, every run writes one compressed .npz file
+once its couriers and orders are claimed: courier positions, vehicles and
+loads, their orders in progress and stored routes, the claimed orders with
+their coordinates and age, and the dispatch settings as JSON. Coordinates
+are stored as they were resolved, so a replay needs neither the live
+tables nor the geocoder.
+"""
+import json
+import logging
+import os
+from dataclasses import asdict, dataclass
+from datetime import timedelta
+from decimal import Decimal
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, DateTimeField, Value, When
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from .models import Courier, CourierRoute, DispatchRun, Order
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+# Settings a replay runs with unless told to use the local ones
+REPLAYED_SETTINGS = (
+    'ORDER_SOLVER', 'ORDER_CANDIDATE_RADIUS_KM', 'ORDER_CANDIDATES_PER_SLOT', 'ORDER_GRID_CELL_KM',
+    'DISPATCH_CLUSTER_ORDERS', 'ORDER_SLA_MINUTES', 'DISPATCH_ORDER_BATCH_SIZE',
+)
+# Recorded for reference only: they name files or services of the recording host
+RECORDED_SETTINGS = REPLAYED_SETTINGS + ('DISTANCE_PROVIDER', 'ORDER_SOLVER_PROCESSES')
+
+
+def snapshot_dir():
+    return getattr(settings, 'DISPATCH_SNAPSHOT_DIR', None)
+
+
+def _points(rows, lat='lat', lon='lon'):
+    """(n, 2) float array of coordinates, NaN where they are missing"""
+    points = np.full((len(rows), 2), np.nan)
+    for i, row in enumerate(rows):
+        if getattr(row, lat) is not None and getattr(row, lon) is not None:
+            points[i] = float(getattr(row, lat)), float(getattr(row, lon))
+    return points
+
+
+def record_snapshot(state, orders, mode, partition=None):
+    """Write the inputs of a run to DISPATCH_SNAPSHOT_DIR; returns the file path"""
+    recorded_at = timezone.now()
+    directory = snapshot_dir()
+    os.makedirs(directory, exist_ok=True)
+    suffix = f'-{partition.name}' if partition else ''
+    path = os.path.join(directory, f"dispatch-{recorded_at:%Y%m%dT%H%M%S.%f}-{mode}{suffix}.npz")
+
+    active = [order for courier in state.couriers for order in state.active_orders[courier.id]]
+    routes = [(courier_id, stops) for courier_id, stops in sorted(state.stored_routes.items())]
+    meta = {
+        'version': SNAPSHOT_VERSION,
+        'mode': mode,
+        'partition': asdict(partition) if partition else None,
+        'recorded_at': recorded_at.isoformat(),
+        'settings': {name: getattr(settings, name, None) for name in RECORDED_SETTINGS},
+    }
+    np.savez_compressed(
+        path,
+        meta=np.array(json.dumps(meta, ensure_ascii=False)),
+        courier_ids=state.courier_ids,
+        courier_positions=state.positions,
+        courier_loads=state.loads,
+        courier_vehicles=np.array([courier.vehicle for courier in state.couriers], dtype=str),
+        active_ids=np.array([order.id for order in active], dtype=np.int64),
+        active_couriers=np.array([order.courier_id for order in active], dtype=np.int64),
+        active_points=_points(active),
+        route_couriers=np.array([courier_id for courier_id, _ in routes], dtype=np.int64),
+        route_offsets=np.cumsum([0] + [len(stops) for _, stops in routes]).astype(np.int64),
+        route_stops=np.array([order_id for _, stops in routes for order_id in stops], dtype=np.int64),
+        order_ids=np.array([order.id for order in orders], dtype=np.int64),
+        order_points=_points(orders),
+        # Ages and deadlines relative to the recording, so a replay sees the same urgencies
+        order_age_s=np.array([(recorded_at - order.created_at).total_seconds() for order in orders]),
+        order_due_in_s=np.array([
+            (order.deliver_by - recorded_at).total_seconds() if order.deliver_by else np.nan for order in orders
+        ]),
+    )
+    return path
+
+
+@dataclass
+class Snapshot:
+    """Arrays and metadata of one recorded run"""
+    meta: dict
+    arrays: dict
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            arrays = {name: data[name] for name in data.files}
+        meta = json.loads(str(arrays.pop('meta')))
+        if meta.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version: {meta.get('version')}")
+        return cls(meta, arrays)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def describe(self):
+        return (f"{self.meta['mode']} run of {self.meta['recorded_at']}: {len(self['courier_ids'])} couriers, "
+                f"{len(self['active_ids'])} orders in progress, {len(self['order_ids'])} orders to dispatch")
+
+
+def _coordinate(value):
+    return None if np.isnan(value) else Decimal(f'{value:.6f}')
+
+
+def load_into_database(snapshot):
+    """Create the couriers, orders and routes of a snapshot; returns the new courier and order ids.
+
+    Meant to run inside a transaction that is rolled back afterwards.
+    """
+    now = timezone.now()
+    couriers = Courier.objects.bulk_create([
+        Courier(
+            name=f'Курьер {courier_id}',
+            email=f'replay-courier-{courier_id}@example.com',
+            phone='+70000000000',
+            vehicle=str(vehicle),
+            current_location_lat=_coordinate(position[0]),
+            current_location_lon=_coordinate(position[1]),
+            active_orders=int(load),
+        )
+        for courier_id, position, vehicle, load in zip(
+            snapshot['courier_ids'].tolist(), snapshot['courier_positions'],
+            snapshot['courier_vehicles'], snapshot['courier_loads']
+        )
+    ])
+    courier_map = dict(zip(snapshot['courier_ids'].tolist(), (courier.id for courier in couriers)))
+
+    active = Order.objects.bulk_create([
+        Order(
+            courier_id=courier_map[courier_id],
+            status='In Progress',
+            address=f'Заказ {order_id}',
+            lat=_coordinate(point[0]),
+            lon=_coordinate(point[1]),
+            geocode_status='ok' if not np.isnan(point).any() else 'failed',
+        )
+        for order_id, courier_id, point in zip(
+            snapshot['active_ids'].tolist(), snapshot['active_couriers'].tolist(), snapshot['active_points']
+        )
+    ])
+    order_map = dict(zip(snapshot['active_ids'].tolist(), (order.id for order in active)))
+
+    orders = Order.objects.bulk_create([
+        Order(
+            address=f'Заказ {order_id}',
+            lat=_coordinate(point[0]),
+            lon=_coordinate(point[1]),
+            # Orders that were not geocoded stay unresolved instead of reaching the geocoder
+            geocode_status='ok' if not np.isnan(point).any() else 'failed',
+            deliver_by=None if np.isnan(due_in) else now + timedelta(seconds=float(due_in)),
+        )
+        for order_id, point, due_in in zip(
+            snapshot['order_ids'].tolist(), snapshot['order_points'], snapshot['order_due_in_s']
+        )
+    ])
+    # created_at is set on insert, so the recorded ages are restored afterwards
+    for start in range(0, len(orders), 500):
+        chunk = list(zip(orders[start:start + 500], snapshot['order_age_s'][start:start + 500].tolist()))
+        Order.objects.filter(id__in=[order.id for order, _ in chunk]).update(created_at=Case(
+            *[When(id=order.id, then=Value(now - timedelta(seconds=age))) for order, age in chunk],
+            output_field=DateTimeField()
+        ))
+    order_map.update(zip(snapshot['order_ids'].tolist(), (order.id for order in orders)))
+
+    offsets = snapshot['route_offsets'].tolist()
+    stops = snapshot['route_stops'].tolist()
+    CourierRoute.objects.bulk_create([
+        CourierRoute(
+            courier_id=courier_map[courier_id],
+            stops=[order_map[order_id] for order_id in stops[offsets[i]:offsets[i + 1]] if order_id in order_map],
+        )
+        for i, courier_id in enumerate(snapshot['route_couriers'].tolist())
+        if courier_id in courier_map
+    ])
+    return [courier.id for courier in couriers], [order.id for order in orders]
+
+
+def replay_snapshot(snapshot, mode=None, profile=None, trace_memory=False, recorded_settings=True):
+    """Run a snapshot through a dispatch mode and measure it; nothing is kept.
+
+    Only the snapshot's own rows take part, in the partition it was recorded
+    in, so other couriers and orders in the database are neither dispatched
+    nor locked. Returns a result like the benchmark's, plus the profiler
+    report when a profile ('cpu' or 'memory') is asked for. With
+    recorded_settings the run uses the solver and dispatch settings of the
+    recording.
+    """
+    from .benchmark import measure_run
+    from .order_distribution import DispatchPartition
+
+    mode = mode or snapshot.meta['mode']
+    overrides = {}
+    if recorded_settings:
+        overrides = {
+            name: value for name, value in snapshot.meta['settings'].items()
+            if name in REPLAYED_SETTINGS and value is not None
+        }
+    partition = snapshot.meta.get('partition')
+    if partition:
+        partition = DispatchPartition(**{**partition, 'bbox': tuple(partition['bbox']) if partition['bbox'] else None})
+    with override_settings(**overrides), transaction.atomic():
+        courier_ids, order_ids = load_into_database(snapshot)
+        result, run = measure_run(mode, courier_ids, order_ids, trace_memory, profile=profile, partition=partition)
+        result['profile'] = DispatchRun.objects.filter(id=run).values_list('profile', flat=True).first() or ''
+        transaction.set_rollback(True)
+    result['couriers'] = len(snapshot['courier_ids'])
+    result['orders'] = len(snapshot['order_ids'])
+    return result
@@ -0,0 +1,377 @@
+"""Two-tier cache of point-to-point distances for expensive distance providers.
+
+Points are keyed by their coordinates quantized to DISTANCE_CACHE['precision']
+decimal places (4 is about 11 m), so a pair key is (origin key, destination
+key); road distances are directional, so both orders are stored.
+
+The memory tier is an in-process LRU of pairs. The disk tier is a dense
+float32 table between the most frequently seen points, stored as .npy files
+that every process memory-maps read-only. persist() rewrites the table under
+a new generation and then swaps the pointer file, so readers never see a
+half-written table and pick the new one up on their next lookup. Writers
+take a lock file first and merge with the newest table on disk, so
+concurrent dispatchers add to each other's pairs instead of dropping them,
+and the publisher deletes every generation that is no longer current.
+"""
+import fcntl
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+KEY_OFFSET = 1 << 31  # keeps quantized longitudes non-negative in the low 32 bits
+SEEN_LIMIT = 4  # points counted between persists, in multiples of disk_points
+
+
+def _setting(name, default):
+    return getattr(settings, 'DISTANCE_CACHE', {}).get(name, default)
+
+
+def quantize(coords, precision=4):
+    """One int64 key per (lat, lon) row: quantized latitude in the high bits, longitude in the low"""
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    scaled = np.rint(coords * 10 ** precision).astype(np.int64)
+    return (scaled[:, 0] << 32) | (scaled[:, 1] + KEY_OFFSET)
+
+
+class DiskTier:
+    """Read-only view of the shared distance table of one namespace"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.pointer = os.path.join(directory, 'current')
+        self.generation = None
+        self.points = np.zeros(0, dtype=np.int64)
+        self.table = np.zeros((0, 0), dtype=np.float32)
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def _files(self, generation):
+        base = os.path.join(self.directory, f'distances.{generation}')
+        return f'{base}.points.npy', f'{base}.table.npy'
+
+    def refresh(self, force=False):
+        """Map the newest table if another process published one since the last look"""
+        with self._lock:
+            try:
+                mtime = os.stat(self.pointer).st_mtime_ns
+            except FileNotFoundError:
+                return
+            if mtime == self._checked_at and not force:
+                return
+            with open(self.pointer, encoding='utf-8') as f:
+                generation = f.read().strip()
+            if generation != self.generation:
+                points_path, table_path = self._files(generation)
+                try:
+                    points = np.load(points_path)
+                    table = np.load(table_path, mmap_mode='r')
+                except (OSError, ValueError) as e:
+                    # Retried on the next lookup
+                    logger.error(f"Error loading distance table {generation}: {str(e)}")
+                    return
+                self.points, self.table, self.generation = points, table, generation
+            self._checked_at = mtime
+
+    def lookup(self, origin_keys, target_keys, out):
+        """Fill out[i, j] for pairs whose points are both in the table; returns the number filled"""
+        points, table = self.points, self.table
+        if not len(points):
+            return 0
+        rows, row_index = self._index(points, origin_keys)
+        columns, column_index = self._index(points, target_keys)
+        if not len(rows) or not len(columns):
+            return 0
+        block = np.asarray(table[np.ix_(row_index, column_index)], dtype=np.float64)
+        known = ~np.isnan(block)
+        target = out[np.ix_(rows, columns)]
+        fill = known & np.isnan(target)
+        target[fill] = block[fill]
+        out[np.ix_(rows, columns)] = target
+        return int(fill.sum())
+
+    @staticmethod
+    def _index(points, keys):
+        """Positions in keys that are in the table, and their rows in the table"""
+        index = np.minimum(np.searchsorted(points, keys), len(points) - 1)
+        found = np.flatnonzero(points[index] == keys)
+        return found, index[found]
+
+    @contextmanager
+    def publishing(self):
+        """Hold the namespace's lock file, so one process at a time merges and publishes"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, 'publish.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def publish(self, points, table):
+        """Write a new generation, point readers at it and sweep the others; call within publishing()"""
+        generation = f'{time.time_ns()}-{os.getpid()}'
+        points_path, table_path = self._files(generation)
+        np.save(points_path, points)
+        np.save(table_path, table.astype(np.float32, copy=False))
+        tmp = f'{self.pointer}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(generation)
+        os.replace(tmp, self.pointer)
+        self.refresh(force=True)
+        self.sweep(generation)
+
+    def sweep(self, current):
+        """Delete the files of every generation but current, including those of crashed writers.
+
+        Only the publisher sweeps, under the lock, so no other generation is
+        being written. Readers that still map old files keep them alive until
+        they remap; one that read the old pointer just before the swap fails
+        to load and retries on its next lookup.
+        """
+        keep = {os.path.basename(path) for path in self._files(current)}
+        removed = 0
+        for name in os.listdir(self.directory):
+            stale_table = name.startswith('distances.') and name.endswith('.npy') and name not in keep
+            stale_pointer = name.startswith('current.') and name.endswith('.tmp')
+            if stale_table or stale_pointer:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+
+class DistanceCache:
+    """Memory LRU of pairs in front of the shared disk table"""
+
+    def __init__(self, directory, precision=4, memory_pairs=200000, disk_points=4096, persist_interval=300):
+        self.precision = precision
+        self.memory_pairs = memory_pairs
+        self.disk_points = disk_points
+        self.persist_interval = persist_interval
+        self.disk = DiskTier(directory)
+        self._memory = OrderedDict()
+        self._seen = Counter()
+        self._dirty = 0
+        self._persisted_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+    def keys(self, coords):
+        return quantize(coords, self.precision)
+
+    def lookup(self, origin_keys, target_keys):
+        """Cached km between every origin and target key; NaN where unknown"""
+        out = np.full((len(origin_keys), len(target_keys)), np.nan)
+        # Points in the same cell are the same place at this precision
+        out[np.equal.outer(origin_keys, target_keys)] = 0.0
+        self.disk.refresh()
+        disk_hits = self.disk.lookup(origin_keys, target_keys, out)
+        memory_hits = 0
+        origins, targets = origin_keys.tolist(), target_keys.tolist()
+        with self._lock:
+            self._seen.update(set(origins) | set(targets))
+            if len(self._seen) > SEEN_LIMIT * self.disk_points:
+                # Between persists only the leaders are worth counting
+                self._seen = Counter(dict(self._seen.most_common(self.disk_points)))
+            for i, j in zip(*np.nonzero(np.isnan(out))):
+                pair = (origins[i], targets[j])
+                value = self._memory.get(pair)
+                if value is not None:
+                    self._memory.move_to_end(pair)
+                    out[i, j] = value
+                    memory_hits += 1
+            self._stats['disk_hits'] += disk_hits
+            self._stats['memory_hits'] += memory_hits
+            self._stats['misses'] += int(np.isnan(out).sum())
+        return out
+
+    def store(self, origin_keys, target_keys, block):
+        """Remember computed km; NaN entries are skipped"""
+        origins, targets = origin_keys.tolist(), target_keys.tolist()
+        with self._lock:
+            for i, j in zip(*np.nonzero(~np.isnan(block))):
+                self._memory[(origins[i], targets[j])] = float(block[i, j])
+                self._dirty += 1
+            while len(self._memory) > self.memory_pairs:
+                self._memory.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, memory_pairs=len(self._memory), disk_points=len(self.disk.points))
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_ratio'] = round((lookups - stats['misses']) / lookups, 4) if lookups else None
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._seen.clear()
+            self._dirty = 0
+            for name in self._stats:
+                self._stats[name] = 0
+
+    def persist(self, force=False):
+        """Publish a new disk table over the most frequently seen points.
+
+        Known pairs come from the newest table on disk, read under the publish
+        lock so another process's last write is merged rather than
+        overwritten, and from the memory tier; the rest stay NaN. Unless
+        forced, this only happens when new pairs were learned and
+        persist_interval seconds passed since the last time. Returns whether
+        a table was written.
+        """
+        with self._lock:
+            if not self._dirty and not force:
+                return False
+            if not force and time.monotonic() - self._persisted_at < self.persist_interval:
+                return False
+            common = self._seen.most_common(self.disk_points)
+            frequent = {key for key, _ in common}
+            # Counts decay at every persist, so the counter stays bounded and follows where demand moves
+            self._seen = Counter({key: count // 2 for key, count in common if count > 1})
+            memory = list(self._memory.items())
+            self._dirty = 0
+            self._persisted_at = time.monotonic()
+
+        with self.disk.publishing():
+            self.disk.refresh(force=True)
+            old_points, old_table = self.disk.points, self.disk.table
+            # Points already on disk stay unless more frequent ones push them out
+            keep = [key for key in old_points.tolist() if key not in frequent]
+            chosen = list(frequent) + keep[:max(self.disk_points - len(frequent), 0)]
+            points = np.array(sorted(chosen), dtype=np.int64)
+
+            table = np.full((len(points), len(points)), np.nan, dtype=np.float32)
+            if len(old_points) and len(points):
+                found, old_index = DiskTier._index(old_points, points)
+                table[np.ix_(found, found)] = old_table[np.ix_(old_index, old_index)]
+            position = {key: row for row, key in enumerate(points.tolist())}
+            for (origin, target), value in memory:
+                row, column = position.get(origin), position.get(target)
+                if row is not None and column is not None:
+                    table[row, column] = value
+            self.disk.publish(points, table)
+        logger.info(f"Published distance table with {len(points)} points ({int((~np.isnan(table)).sum())} pairs)")
+        return True
+
+
+class CachedDistances:
+    """Distance provider that answers from a DistanceCache and computes only the misses"""
+
+    def __init__(self, provider, cache):
+        self.provider = provider
+        self.cache = cache
+
+    def distance_matrix(self, coords):
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        keys = self.cache.keys(coords)
+        matrix = self.cache.lookup(keys, keys)
+        missing = np.isnan(matrix)
+        if missing.any():
+            # New points miss most of their row: compute those rows in one block, then
+            # the columns still missing from the other rows (the provider searches
+            # from whichever side has fewer points)
+            row_gaps = missing.sum(axis=1)
+            fresh = np.flatnonzero(row_gaps * 2 > missing.any(axis=0).sum())
+            self._fill(coords, keys, matrix, missing, fresh)
+            missing = np.isnan(matrix)
+            self._fill(coords, keys, matrix, missing, np.flatnonzero(missing.any(axis=1)))
+        return matrix
+
+    def _fill(self, coords, keys, matrix, missing, rows):
+        if not len(rows):
+            return
+        columns = np.flatnonzero(missing[rows].any(axis=0))
+        block = self.provider.distance_block(coords[rows], coords[columns])
+        gaps = missing[np.ix_(rows, columns)]
+        matrix[np.ix_(rows, columns)] = np.where(gaps, block, matrix[np.ix_(rows, columns)])
+        self.cache.store(keys[rows], keys[columns], np.where(gaps, block, np.nan))
+
+    def path_lengths(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if len(points) < 2:
+            return np.zeros(0)
+        keys = self.cache.keys(points)
+        origins, targets = keys[:-1], keys[1:]
+        legs = np.array([self.cache.lookup(origins[i:i + 1], targets[i:i + 1])[0, 0] for i in range(len(origins))])
+        missing = np.flatnonzero(np.isnan(legs))
+        if len(missing):
+            legs[missing] = self.provider.pair_distances(points[:-1][missing], points[1:][missing])
+            for i in missing:
+                self.cache.store(origins[i:i + 1], targets[i:i + 1], legs[i:i + 1].reshape(1, 1))
+        return legs
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def cache_enabled():
+    return _setting('enabled', False)
+
+
+def get_distance_cache(namespace='default'):
+    """The process-wide cache of one provider; namespace separates e.g. different road extracts"""
+    with _caches_lock:
+        if namespace not in _caches:
+            directory = os.path.join(_setting('dir', os.path.join(settings.BASE_DIR, 'distance_cache')), namespace)
+            _caches[namespace] = DistanceCache(
+                directory,
+                precision=_setting('precision', 4),
+                memory_pairs=_setting('memory_pairs', 200000),
+                disk_points=_setting('disk_points', 4096),
+                persist_interval=_setting('persist_interval', 300),
+            )
+        return _caches[namespace]
+
+
+def all_caches():
+    with _caches_lock:
+        return dict(_caches)
+
+
+def cache_stats():
+    """Counters of every distance cache used by this process, by namespace"""
+    return {namespace: cache.stats() for namespace, cache in all_caches().items()}
+
+
+def cache_usage(before, after):
+    """Pair lookups of all caches between two cache_stats() snapshots"""
+    usage = {'distance_memory_hits': 0, 'distance_disk_hits': 0, 'distance_misses': 0}
+    for namespace, stats in after.items():
+        previous = before.get(namespace, {})
+        for name in ('memory_hits', 'disk_hits', 'misses'):
+            usage[f'distance_{name}'] += stats[name] - previous.get(name, 0)
+    lookups = sum(usage.values())
+    usage['distance_hit_ratio'] = round((lookups - usage['distance_misses']) / lookups, 4) if lookups else None
+    return usage
+
+
+def persist_caches(force=False):
+    """Publish the disk tier of every cache that learned new pairs; returns how many were written"""
+    written = 0
+    for cache in all_caches().values():
+        try:
+            written += cache.persist(force=force)
+        except OSError as e:
+            logger.error(f"Error writing distance cache: {str(e)}")
+    return written
+
+
+@receiver(setting_changed)
+def _reset_caches(setting, **kwargs):
+    if setting == 'DISTANCE_CACHE':
+        with _caches_lock:
+            _caches.clear()
@@ -0,0 +1,414 @@
+import csv
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+import requests
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.timezone import now
+
+from .models import GeocodeCache, Order
+
+logger = logging.getLogger(__name__)
+
+NOMINATIM_URL = 'https://nominatim.openstreetmap.org/search'
+NOMINATIM_MIN_INTERVAL = 1.0  # Nominatim usage policy: at most 1 request per second
+DB_BATCH_SIZE = 500  # keeps IN (...) lists below SQLite's variable limit
+
+_MISSING = object()
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class GeocodingError(Exception):
+    """The geocoder could not be reached; the address may still be valid"""
+
+
+class LRUCache:
+    """Small thread-safe LRU mapping with per-entry expiry"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                return _MISSING
+            value, expires_at = item
+            if expires_at <= now():
+                del self._data[key]
+                return _MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def normalize_address(address):
+    """Build the cache key for an address: lowercase, no punctuation, single spaces"""
+    address = (address or '').lower().replace('ё', 'е')
+    address = re.sub(r'[\s,.;:"\'«»()]+', ' ', address)
+    return address.strip()
+
+
+class Geocoder:
+    """Base class for geocoder backends.
+
+    geocode() returns (lat, lon) or None when the address is unknown and
+    raises GeocodingError when the backend cannot answer. Results of
+    cacheable backends are stored in the GeocodeCache table.
+    """
+    cacheable = True
+
+    def geocode(self, address):
+        raise NotImplementedError
+
+    def geocode_batch(self, addresses):
+        """Resolve many addresses; addresses the backend could not answer are left out"""
+        results = {}
+        for address in addresses:
+            try:
+                results[address] = self.geocode(address)
+            except GeocodingError as e:
+                logger.error(f"Error geocoding address {address}: {str(e)}")
+        return results
+
+
+class NominatimGeocoder(Geocoder):
+    """OpenStreetMap Nominatim over HTTP, throttled to its usage policy"""
+
+    def __init__(self, url=NOMINATIM_URL, user_agent='DeliveryService/1.0', timeout=10,
+                 min_interval=NOMINATIM_MIN_INTERVAL):
+        self.url = url
+        self.user_agent = user_agent
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._last_request_at = 0.0
+
+    def _respect_rate_limit(self):
+        """Sleep only as long as needed to keep one request per interval"""
+        with self._lock:
+            elapsed = time.monotonic() - self._last_request_at
+            if elapsed < self.min_interval:
+                time.sleep(self.min_interval - elapsed)
+            self._last_request_at = time.monotonic()
+
+    def _request(self, address):
+        self._respect_rate_limit()
+        response = requests.get(
+            self.url,
+            params={'q': address, 'format': 'json', 'limit': 1},
+            headers={'User-Agent': self.user_agent},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        data = response.json()
+        if data and len(data) > 0:
+            return float(data[0]['lat']), float(data[0]['lon'])
+        return None
+
+    def geocode(self, address):
+        try:
+            return self._request(address)
+        except Exception as e:
+            raise GeocodingError(str(e)) from e
+
+
+def load_gazetteer(path):
+    """Load a gazetteer into a dict of normalized address -> (lat, lon).
+
+    Accepts CSV with an address,lat,lon header or JSONL with objects carrying
+    the same keys (.jsonl / .json extension).
+    """
+    index = {}
+    path = str(path)
+    with open(path, encoding='utf-8', newline='') as f:
+        if path.endswith(('.jsonl', '.json')):
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            rows = csv.DictReader(f)
+        for row in rows:
+            key = normalize_address(row['address'])
+            if key:
+                index[key] = (float(row['lat']), float(row['lon']))
+    logger.info(f"Loaded {len(index)} gazetteer entries from {path}")
+    return index
+
+
+class GazetteerGeocoder(Geocoder):
+    """Offline geocoder answering from a local address -> coordinates file"""
+    cacheable = False  # lookups are already in memory
+
+    def __init__(self, path=None, index=None):
+        if index is None:
+            if not path:
+                raise ImproperlyConfigured("GazetteerGeocoder requires a 'path' option")
+            index = load_gazetteer(path)
+        self.index = index
+
+    def geocode(self, address):
+        return self.index.get(normalize_address(address))
+
+    def geocode_batch(self, addresses):
+        return {address: self.index.get(normalize_address(address)) for address in addresses}
+
+
+GEOCODER_BACKENDS = {
+    'nominatim': NominatimGeocoder,
+    'gazetteer': GazetteerGeocoder,
+}
+
+_geocoder = None
+_geocoder_lock = threading.Lock()
+_memory_cache = LRUCache(_setting('GEOCODE_MEMORY_CACHE_SIZE', 10000))
+_stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'errors': 0}
+_stats_lock = threading.Lock()
+
+
+def get_geocoder():
+    """Return the backend configured by GEOCODER_BACKEND / GEOCODER_OPTIONS"""
+    global _geocoder
+    with _geocoder_lock:
+        if _geocoder is None:
+            name = _setting('GEOCODER_BACKEND', 'nominatim')
+            try:
+                backend = GEOCODER_BACKENDS[name]
+            except KeyError:
+                raise ImproperlyConfigured(f"Unknown geocoder backend: {name}")
+            _geocoder = backend(**_setting('GEOCODER_OPTIONS', {}))
+        return _geocoder
+
+
+def set_geocoder(geocoder):
+    """Replace the active backend, e.g. with an in-memory gazetteer for benchmarks"""
+    global _geocoder
+    with _geocoder_lock:
+        _geocoder = geocoder
+
+
+@receiver(setting_changed)
+def _reset_geocoder(setting, **kwargs):
+    if setting in ('GEOCODER_BACKEND', 'GEOCODER_OPTIONS'):
+        set_geocoder(None)
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def get_cache_stats():
+    """Return a copy of geocode cache counters"""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def clear_memory_cache():
+    _memory_cache.clear()
+    with _stats_lock:
+        for name in _stats:
+            _stats[name] = 0
+
+
+def _expiry_for(coords):
+    if coords is None:
+        return now() + timedelta(seconds=_setting('GEOCODE_NEGATIVE_CACHE_TTL', 24 * 60 * 60))
+    return now() + timedelta(seconds=_setting('GEOCODE_CACHE_TTL', 30 * 24 * 60 * 60))
+
+
+def _cache_entry(key, address, coords):
+    return GeocodeCache(
+        address_key=key,
+        address=address[:255],
+        status='found' if coords else 'not_found',
+        lat=round(coords[0], 6) if coords else None,
+        lon=round(coords[1], 6) if coords else None,
+        expires_at=_expiry_for(coords),
+    )
+
+
+def _store(entries):
+    """Upsert cache rows and mirror them into the in-process LRU"""
+    GeocodeCache.objects.bulk_create(
+        entries,
+        batch_size=DB_BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=['address_key'],
+        update_fields=['address', 'status', 'lat', 'lon', 'expires_at'],
+    )
+    for entry in entries:
+        _memory_cache.set(entry.address_key, entry.coords, entry.expires_at)
+
+
+def _geocode(address):
+    geocoder = get_geocoder()
+    if not geocoder.cacheable:
+        return geocoder.geocode(address)
+
+    key = normalize_address(address)
+    if not key:
+        return None
+
+    coords = _memory_cache.get(key)
+    if coords is not _MISSING:
+        _count('memory_hits')
+        return coords
+
+    entry = GeocodeCache.objects.filter(address_key=key, expires_at__gt=now()).first()
+    if entry is not None:
+        _count('db_hits')
+        _memory_cache.set(key, entry.coords, entry.expires_at)
+        return entry.coords
+
+    _count('misses')
+    try:
+        coords = geocoder.geocode(address)
+    except GeocodingError:
+        # Transport errors are not cached so the address is retried next time
+        _count('errors')
+        raise
+
+    _store([_cache_entry(key, address, coords)])
+    return coords
+
+
+def geocode_address(address):
+    """Convert address to coordinates using the configured geocoder backend.
+
+    Results, including "not found" answers, are cached in memory and in the
+    GeocodeCache table, so the rate-limit delay is only paid on real misses.
+    """
+    try:
+        return _geocode(address)
+    except GeocodingError as e:
+        logger.error(f"Error geocoding address {address}: {str(e)}")
+        return None
+
+
+def geocode_addresses(addresses):
+    """Resolve many addresses at once.
+
+    Cache lookups are done in bulk and only the remaining misses reach the
+    backend, through its batch API. Returns a dict of address -> (lat, lon)
+    or None; addresses the backend could not answer are left out.
+    """
+    geocoder = get_geocoder()
+    addresses = set(addresses)
+    if not geocoder.cacheable:
+        return geocoder.geocode_batch(addresses)
+
+    results = {}
+    pending = {}
+    for address in addresses:
+        key = normalize_address(address)
+        if not key:
+            results[address] = None
+            continue
+        coords = _memory_cache.get(key)
+        if coords is not _MISSING:
+            _count('memory_hits')
+            results[address] = coords
+        else:
+            pending.setdefault(key, []).append(address)
+
+    keys = list(pending)
+    for start in range(0, len(keys), DB_BATCH_SIZE):
+        entries = GeocodeCache.objects.filter(
+            address_key__in=keys[start:start + DB_BATCH_SIZE],
+            expires_at__gt=now()
+        )
+        for entry in entries:
+            _count('db_hits', len(pending[entry.address_key]))
+            _memory_cache.set(entry.address_key, entry.coords, entry.expires_at)
+            for address in pending.pop(entry.address_key):
+                results[address] = entry.coords
+
+    if pending:
+        _count('misses', len(pending))
+        # One representative address per normalized key goes to the backend
+        representatives = {variants[0]: key for key, variants in pending.items()}
+        resolved = geocoder.geocode_batch(list(representatives))
+        _count('errors', len(representatives) - len(resolved))
+        entries = []
+        for address, coords in resolved.items():
+            key = representatives[address]
+            entries.append(_cache_entry(key, address, coords))
+            for variant in pending[key]:
+                results[variant] = coords
+        _store(entries)
+    return results
+
+
+def _apply_coords(order, coords):
+    if coords:
+        order.lat, order.lon = round(coords[0], 6), round(coords[1], 6)
+        order.geocode_status = 'ok'
+    else:
+        order.lat = order.lon = None
+        order.geocode_status = 'failed'
+
+
+def geocode_order(order):
+    """Resolve the order address and store the coordinates on the order.
+
+    Orders stay 'pending' when the geocoder is unreachable so they are retried.
+    """
+    try:
+        coords = _geocode(order.address)
+    except GeocodingError as e:
+        logger.error(f"Error geocoding order {order.id}: {str(e)}")
+        return None
+
+    _apply_coords(order, coords)
+    # Only touch the row if the address was not edited in the meantime
+    Order.objects.filter(pk=order.pk, address=order.address).update(
+        lat=order.lat,
+        lon=order.lon,
+        geocode_status=order.geocode_status
+    )
+    return coords
+
+
+def geocode_orders(orders):
+    """Batch version of geocode_order; returns the number of orders resolved"""
+    orders = list(orders)
+    resolved = geocode_addresses(order.address for order in orders)
+    updated = []
+    for order in orders:
+        if order.address in resolved:
+            _apply_coords(order, resolved[order.address])
+            updated.append(order)
+    Order.objects.bulk_update(updated, ['lat', 'lon', 'geocode_status'], batch_size=DB_BATCH_SIZE)
+    return len(updated)
+
+
+def geocode_order_task(order_id):
+    """Background entry point: geocode a freshly created or edited order"""
+    order = Order.objects.filter(pk=order_id).first()
+    if order is not None and order.geocode_status == 'pending':
+        geocode_order(order)
@@ -0,0 +1,185 @@
+"""Tracing and metrics for dispatcher runs.
+
+A DispatchTrace is active for the duration of one distribute_orders() call;
+code deeper in the dispatcher reports into it through current_trace(),
+which is a no-op outside a run (and in solver pool workers). Finished runs
+feed process-local histograms that the metrics endpoint exposes.
+"""
+import cProfile
+import io
+import pstats
+import threading
+import time
+import tracemalloc
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+PROFILE_MODES = ('cpu', 'memory')
+
+_current = ContextVar('dispatch_trace', default=None)
+
+
+class DispatchTrace:
+    """Wall time and attributes of each dispatcher phase, plus an optional profile"""
+
+    def __init__(self, progress=None, profile=None):
+        if profile and profile not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode: {profile}")
+        self.progress = progress
+        self.profile_mode = profile
+        self.timings = {}
+        self.attributes = {}
+        self.profile = ''
+        self.started = None
+        self.duration = None
+
+    @contextmanager
+    def phase(self, name):
+        if self.progress:
+            self.progress(name)
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+    def record(self, phase, **values):
+        """Attach values to a phase; numbers recorded twice are added up"""
+        attributes = self.attributes.setdefault(phase, {})
+        for key, value in values.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and key in attributes:
+                attributes[key] += value
+            else:
+                attributes[key] = value
+
+    @contextmanager
+    def run(self):
+        """Make this the current trace and time (and optionally profile) the block"""
+        token = _current.set(self)
+        profiler = cProfile.Profile() if self.profile_mode == 'cpu' else None
+        tracing_memory = self.profile_mode == 'memory' and not tracemalloc.is_tracing()
+        if tracing_memory:
+            tracemalloc.start()
+        if profiler:
+            profiler.enable()
+        self.started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.duration = time.perf_counter() - self.started
+            if profiler:
+                profiler.disable()
+                self.profile = _format_cpu_profile(profiler)
+            if tracing_memory:
+                self.profile = _format_memory_profile()
+                tracemalloc.stop()
+            _current.reset(token)
+
+    def summary(self):
+        return {
+            'duration': self.duration,
+            'phases': dict(self.timings),
+            'attributes': {phase: dict(values) for phase, values in self.attributes.items()},
+        }
+
+
+class _NullTrace:
+    @contextmanager
+    def phase(self, name):
+        yield self
+
+    def record(self, phase, **values):
+        pass
+
+
+_null_trace = _NullTrace()
+
+
+def current_trace():
+    """The trace of the running dispatch, or a trace that records nothing"""
+    return _current.get() or _null_trace
+
+
+def _format_cpu_profile(profiler, limit=40):
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
+
+
+def _format_memory_profile(limit=25):
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f"current {current / 2 ** 20:.2f} MiB, peak {peak / 2 ** 20:.2f} MiB"]
+    lines.extend(str(stat) for stat in snapshot.statistics('lineno')[:limit])
+    return '\n'.join(lines)
+
+
+class Histogram:
+    """Cumulative-bucket histogram with labels, kept in process memory"""
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.setdefault(key, {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0})
+            series['counts'][bisect_left(self.buckets, value)] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            series = []
+            for key, data in self._series.items():
+                cumulative, buckets = 0, {}
+                for bound, count in zip((*self.buckets, float('inf')), data['counts']):
+                    cumulative += count
+                    buckets['+Inf' if bound == float('inf') else str(bound)] = cumulative
+                series.append({'labels': dict(key), 'buckets': buckets, 'sum': data['sum'], 'count': data['count']})
+        return {'name': self.name, 'help': self.help_text, 'series': series}
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+PHASE_SECONDS = Histogram('dispatch_phase_seconds', 'Wall time of a dispatcher phase', SECONDS_BUCKETS)
+RUN_SECONDS = Histogram('dispatch_run_seconds', 'Wall time of a whole distribution run', SECONDS_BUCKETS)
+ASSIGNED_ORDERS = Histogram('dispatch_assigned_orders', 'Orders assigned by one run', (0, 1, 5, 10, 50, 100, 500, 1000, 5000))
+METRICS = (PHASE_SECONDS, RUN_SECONDS, ASSIGNED_ORDERS)
+
+
+def observe_run(trace, mode, assigned):
+    for phase, seconds in trace.timings.items():
+        PHASE_SECONDS.observe(seconds, phase=phase, mode=mode)
+    RUN_SECONDS.observe(trace.duration, mode=mode)
+    ASSIGNED_ORDERS.observe(assigned, mode=mode)
+
+
+def metrics_snapshot():
+    return [metric.snapshot() for metric in METRICS]
+
+
+def render_prometheus():
+    """Metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in metrics_snapshot():
+        lines.append(f"# HELP {metric['name']} {metric['help']}")
+        lines.append(f"# TYPE {metric['name']} histogram")
+        for series in metric['series']:
+            labels = ','.join(f'{key}="{value}"' for key, value in series['labels'].items())
+            for bound, count in series['buckets'].items():
+                bucket_labels = f'{labels},le="{bound}"' if labels else f'le="{bound}"'
+                lines.append(f"{metric['name']}_bucket{{{bucket_labels}}} {count}")
+            suffix = f'{{{labels}}}' if labels else ''
+            lines.append(f"{metric['name']}_sum{suffix} {series['sum']}")
+            lines.append(f"{metric['name']}_count{suffix} {series['count']}")
+    return '\n'.join(lines) + '\n'
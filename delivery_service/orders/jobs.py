@@ -0,0 +1,154 @@
+import logging
+import queue
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils.timezone import now
+
+from .models import DistributionJob
+from .order_distribution import apply_plan, distribute_orders, DISTRIBUTION_PHASES
+from .tasks import run_in_background
+
+logger = logging.getLogger(__name__)
+
+
+def create_distribution_job(mode=None, user=None, profile=None, dry_run=False):
+    """Queue a distribution pass and hand it to the configured runner.
+
+    With DISTRIBUTION_JOB_RUNNER = 'thread' the job runs in the web process
+    on the background 'distribution' queue; with 'worker' it stays queued
+    until the run_distribution_worker command picks it up. profile ('cpu'
+    or 'memory') stores a profiler report with the run. A dry_run job only
+    stores the plan, which apply_distribution_job() saves later.
+    """
+    job = DistributionJob.objects.create(mode=mode or '', profile=profile or '', dry_run=dry_run, created_by=user)
+    if getattr(settings, 'DISTRIBUTION_JOB_RUNNER', 'thread') == 'thread':
+        run_in_background(run_distribution_job, job.id, queue='distribution')
+    return job
+
+
+def run_distribution_job(job_id):
+    """Run a queued job; returns False if another runner already claimed it"""
+    # The conditional update is the claim, so a job never runs twice
+    started = now()
+    claimed = DistributionJob.objects.filter(pk=job_id, status='queued').update(
+        status='running',
+        started_at=started,
+        heartbeat_at=started
+    )
+    if not claimed:
+        return False
+
+    job = DistributionJob.objects.get(pk=job_id)
+
+    # Phases are written by the heartbeat thread on its own connection, outside the dispatch transaction
+    phases = queue.Queue()
+    heartbeat = threading.Thread(target=_send_heartbeats, args=(job_id, phases), daemon=True)
+    heartbeat.start()
+    try:
+        result = distribute_orders(mode=job.mode or None, progress=phases.put, profile=job.profile or None, dry_run=job.dry_run)
+    except Exception as e:
+        logger.exception(f"Distribution job {job_id} failed")
+        result = {"message": f"Ошибка при распределении заказов: {str(e)}", "error": str(e)}
+    finally:
+        phases.put(None)
+        heartbeat.join()
+
+    failed = 'error' in result
+    DistributionJob.objects.filter(pk=job_id).update(
+        status='failed' if failed else 'done',
+        phase='',
+        progress=0 if failed else 1,
+        message=result.get('message', ''),
+        error=result.get('error', ''),
+        assigned_count=result.get('assigned', 0),
+        phase_timings=result.get('phase_timings', {}),
+        run_id=result.get('run_id'),
+        plan=result.get('plan'),
+        finished_at=now()
+    )
+    return True
+
+
+def _send_heartbeats(job_id, phases):
+    """Write the job's phase and heartbeat until None comes out of phases.
+
+    Runs in its own thread, so the writes use that thread's connection: the
+    dispatch holds its transaction open from the couriers phase on (a dry
+    run from the start, and rolls it back), and writes on its connection
+    would stay invisible and keep the job row locked. heartbeat_at is
+    touched with every phase and at least every
+    DISTRIBUTION_JOB_HEARTBEAT_SECONDS; a failed write is retried with the
+    next one.
+    """
+    interval = getattr(settings, 'DISTRIBUTION_JOB_HEARTBEAT_SECONDS', 30)
+    try:
+        while True:
+            try:
+                phase = phases.get(timeout=interval)
+            except queue.Empty:
+                phase = ''
+            if phase is None:
+                return
+            fields = {'heartbeat_at': now()}
+            if phase:
+                done = DISTRIBUTION_PHASES.index(phase) if phase in DISTRIBUTION_PHASES else 0
+                fields.update(phase=phase, progress=done / len(DISTRIBUTION_PHASES))
+            try:
+                DistributionJob.objects.filter(pk=job_id, status='running').update(**fields)
+            except Exception as e:
+                logger.error(f"Error sending heartbeat of distribution job {job_id}: {str(e)}")
+    finally:
+        # The thread's own connection would otherwise stay open until the process exits
+        connection.close()
+
+
+def apply_distribution_job(job_id):
+    """Save the plan of a finished dry-run job, at most once; returns the apply_plan() result"""
+    with transaction.atomic():
+        # The conditional update is the claim, so a plan is never applied twice
+        claimed = DistributionJob.objects.filter(
+            pk=job_id, dry_run=True, status='done', plan__isnull=False, applied_at__isnull=True
+        ).update(applied_at=now())
+        if not claimed:
+            return {"message": "Нет плана для применения: он уже применён или ещё не готов", "error": "No plan to apply"}
+        result = apply_plan(DistributionJob.objects.values_list('plan', flat=True).get(pk=job_id))
+        if 'error' in result:
+            transaction.set_rollback(True)
+    return result
+
+
+def fail_stale_jobs():
+    """Mark running jobs whose runner died (deploy, OOM) as failed; returns how many.
+
+    A running job is stale once its last heartbeat, sent on every phase and
+    every DISTRIBUTION_JOB_HEARTBEAT_SECONDS, is older than
+    DISTRIBUTION_JOB_TIMEOUT_SECONDS.
+    """
+    cutoff = now() - timedelta(seconds=getattr(settings, 'DISTRIBUTION_JOB_TIMEOUT_SECONDS', 300))
+    stale = DistributionJob.objects.filter(status='running').filter(
+        Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at__isnull=True, started_at__lt=cutoff)
+    ).update(
+        status='failed',
+        phase='',
+        progress=0,
+        message='Распределение прервано: обработчик задания перестал отвечать',
+        error='Job runner stopped responding',
+        finished_at=now()
+    )
+    if stale:
+        logger.warning(f"Marked {stale} stale distribution jobs as failed")
+    return stale
+
+
+def run_queued_jobs():
+    """Run every queued job, oldest first; returns the number of jobs run"""
+    fail_stale_jobs()
+    count = 0
+    for job_id in DistributionJob.objects.filter(status='queued').order_by('created_at', 'id').values_list('id', flat=True):
+        if run_distribution_job(job_id):
+            count += 1
+    return count
@@ -0,0 +1,92 @@
+import json
+import platform
+import subprocess
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand, CommandError
+
+from orders.benchmark import DEFAULT_VEHICLE_MIX, run_benchmark
+from orders.order_distribution import DISTRIBUTION_MODES, VEHICLE_TYPES
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        'Замеряет распределение заказов на синтетическом городе. Данные создаются в транзакции, '
+        'которая откатывается; остальные курьеры и заказы в базе в прогоне не участвуют.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--couriers', type=int, default=50, help='Число курьеров')
+        parser.add_argument('--orders', type=int, default=500, help='Число заказов')
+        parser.add_argument('--modes', default=','.join(DISTRIBUTION_MODES), help='Режимы через запятую')
+        parser.add_argument('--vehicle-mix', help='Доли транспорта, например "Автомобиль=0.5,Велосипед=0.5"')
+        parser.add_argument('--radius-km', type=float, default=15.0, help='Радиус города, км')
+        parser.add_argument('--repeat', type=int, default=1, help='Повторов каждого режима')
+        parser.add_argument('--seed', type=int, default=0, help='Зерно генератора')
+        parser.add_argument('--no-trace-memory', action='store_true',
+                            help='Не замерять пик памяти (tracemalloc замедляет прогон)')
+        parser.add_argument('--output', help='Файл для результатов в JSON')
+
+    def _vehicle_mix(self, value):
+        if not value:
+            return DEFAULT_VEHICLE_MIX
+        mix = {}
+        for part in value.split(','):
+            vehicle, _, share = part.partition('=')
+            vehicle = vehicle.strip()
+            if vehicle not in VEHICLE_TYPES:
+                raise CommandError(f"Неизвестный транспорт: {vehicle}")
+            try:
+                mix[vehicle] = float(share)
+            except ValueError:
+                raise CommandError(f"Неверная доля для {vehicle}: {share}")
+        return mix
+
+    def handle(self, *args, **options):
+        modes = [mode.strip() for mode in options['modes'].split(',') if mode.strip()]
+        unknown = set(modes) - set(DISTRIBUTION_MODES)
+        if unknown:
+            raise CommandError(f"Неизвестные режимы: {', '.join(sorted(unknown))}")
+
+        results = run_benchmark(
+            options['couriers'],
+            options['orders'],
+            modes,
+            repeat=options['repeat'],
+            trace_memory=not options['no_trace_memory'],
+            vehicle_mix=self._vehicle_mix(options['vehicle_mix']),
+            radius_km=options['radius_km'],
+            seed=options['seed'],
+        )
+
+        for result in results:
+            phases = ', '.join(f"{phase} {seconds:.3f}s" for phase, seconds in result['phase_seconds'].items())
+            self.stdout.write(
+                f"{result['mode']:<12} {result['assigned']:>6}/{result['orders']} заказов "
+                f"за {result['wall_seconds']:.3f}s ({result['assignments_per_second']} в секунду), "
+                f"маршруты {result['route_km']} км / {result['route_minutes']} мин, "
+                f"пик памяти {result['peak_python_mb']} МБ [{phases}]"
+            )
+
+        if options['output']:
+            report = {
+                'commit': _git_commit(),
+                'created_at': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'parameters': {
+                    key: options[key] for key in ('couriers', 'orders', 'vehicle_mix', 'radius_km', 'repeat', 'seed')
+                },
+                'results': results,
+            }
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            self.stdout.write(f"Результаты записаны в {options['output']}")
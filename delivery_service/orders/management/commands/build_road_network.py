@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from orders.road_network import RoadNetwork, cache_path
+
+
+class Command(BaseCommand):
+    help = 'Разбирает выгрузку OSM в граф дорог и сохраняет его в кэш'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Файл .geojson или .osm.pbf')
+        parser.add_argument('--cache-dir', help='Каталог кэша, по умолчанию рядом с выгрузкой')
+
+    def handle(self, *args, **options):
+        try:
+            network = RoadNetwork.load(options['path'], cache_dir=options['cache_dir'])
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        self.stdout.write(
+            f"Граф дорог: {network.node_count} узлов, {network.edge_count} ребер, "
+            f"кэш {cache_path(options['path'], options['cache_dir'])}"
+        )
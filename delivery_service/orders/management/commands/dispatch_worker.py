@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from orders.order_distribution import distribute_orders, dispatch_partitions, DISTRIBUTION_MODES
+
+
+class Command(BaseCommand):
+    help = 'Распределяет заказы по партициям; несколько процессов могут работать параллельно'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--partition', action='append', help='Обрабатывать только эту партицию (можно повторять)')
+        parser.add_argument('--mode', choices=DISTRIBUTION_MODES, help='Режим распределения')
+        parser.add_argument('--once', action='store_true', help='Пройти по партициям один раз и завершиться')
+        parser.add_argument('--interval', type=float, default=2.0, help='Пауза, если распределять нечего, с')
+
+    def handle(self, *args, **options):
+        partitions = dispatch_partitions()
+        if options['partition']:
+            names = set(options['partition'])
+            unknown = names - {partition.name for partition in partitions}
+            if unknown:
+                raise CommandError(f"Неизвестные партиции: {', '.join(sorted(unknown))}")
+            partitions = [partition for partition in partitions if partition.name in names]
+        if not partitions:
+            raise CommandError("Не настроено ни одной партиции (DISPATCH_ZONES)")
+
+        while True:
+            assigned = 0
+            for partition in partitions:
+                # Partitions held by another worker are skipped, not waited on
+                result = distribute_orders(mode=options['mode'], partition=partition)
+                if result.get('error'):
+                    self.stderr.write(f"{partition.name}: {result['message']}")
+                elif result['assigned']:
+                    self.stdout.write(f"{partition.name}: назначено заказов {result['assigned']}")
+                    assigned += result['assigned']
+            if options['once']:
+                break
+            if not assigned:
+                time.sleep(options['interval'])
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from orders.geocoding import geocode_orders
+from orders.models import Order
+
+
+class Command(BaseCommand):
+    help = 'Геокодирует заказы без координат пакетами через настроенный геокодер'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Заказов в одном пакете')
+        parser.add_argument('--retry-failed', action='store_true', help='Повторить заказы с ненайденным адресом')
+
+    def handle(self, *args, **options):
+        statuses = ['pending', 'failed'] if options['retry_failed'] else ['pending']
+        batch_size = options['batch_size']
+        last_id = 0
+        total = resolved = 0
+
+        while True:
+            batch = list(
+                Order.objects.filter(geocode_status__in=statuses, id__gt=last_id)
+                .only('id', 'address', 'lat', 'lon', 'geocode_status')
+                .order_by('id')[:batch_size]
+            )
+            if not batch:
+                break
+            last_id = batch[-1].id
+            total += len(batch)
+            resolved += geocode_orders(batch)
+            self.stdout.write(f"Обработано заказов: {total}")
+
+        found = Order.objects.filter(geocode_status='ok').count()
+        self.stdout.write(self.style.SUCCESS(
+            f"Готово: обработано {total}, получили ответ {resolved}, всего с координатами {found}"
+        ))
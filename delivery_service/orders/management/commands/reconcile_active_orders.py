@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from orders.models import reconcile_active_orders
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает счётчики заказов в работе у курьеров по таблице заказов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Только показать расхождения, ничего не менять')
+
+    def handle(self, *args, **options):
+        drifted = reconcile_active_orders(dry_run=options['dry_run'])
+        for courier_id, (stored, counted) in sorted(drifted.items()):
+            self.stdout.write(f"Курьер {courier_id}: в счётчике {stored}, по заказам {counted}")
+        action = 'найдено' if options['dry_run'] else 'исправлено'
+        self.stdout.write(self.style.SUCCESS(f"Расхождений {action}: {len(drifted)}"))
@@ -0,0 +1,73 @@
+import json
+import platform
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand, CommandError
+
+from orders.dispatch_snapshot import Snapshot, replay_snapshot
+from orders.instrumentation import PROFILE_MODES
+from orders.order_distribution import DISTRIBUTION_MODES
+
+
+class Command(BaseCommand):
+    help = (
+        'Повторяет распределение по снимку, записанному при DISPATCH_SNAPSHOT_DIR, в выбранных режимах '
+        'и под профилировщиком. Данные снимка создаются в транзакции, которая откатывается; остальные '
+        'курьеры и заказы в базе в прогоне не участвуют и не блокируются.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('snapshot', help='Файл снимка (.npz)')
+        parser.add_argument('--modes', help='Режимы через запятую (по умолчанию режим записанного прогона)')
+        parser.add_argument('--profile', choices=PROFILE_MODES, help='Профилировщик: cpu или memory')
+        parser.add_argument('--repeat', type=int, default=1, help='Повторов каждого режима')
+        parser.add_argument('--current-settings', action='store_true',
+                            help='Использовать локальные настройки решателя вместо записанных в снимке')
+        parser.add_argument('--trace-memory', action='store_true', help='Замерять пик памяти через tracemalloc')
+        parser.add_argument('--output', help='Файл для результатов в JSON')
+
+    def handle(self, *args, **options):
+        try:
+            snapshot = Snapshot.load(options['snapshot'])
+        except (OSError, ValueError, KeyError) as e:
+            raise CommandError(f"Не удалось прочитать снимок {options['snapshot']}: {e}")
+        self.stdout.write(f"Снимок: {snapshot.describe()}")
+
+        modes = [mode.strip() for mode in (options['modes'] or snapshot.meta['mode']).split(',') if mode.strip()]
+        unknown = set(modes) - set(DISTRIBUTION_MODES)
+        if unknown:
+            raise CommandError(f"Неизвестные режимы: {', '.join(sorted(unknown))}")
+
+        results = []
+        for mode in modes:
+            for _ in range(options['repeat']):
+                result = replay_snapshot(
+                    snapshot,
+                    mode=mode,
+                    profile=options['profile'],
+                    trace_memory=options['trace_memory'],
+                    recorded_settings=not options['current_settings'],
+                )
+                results.append(result)
+                phases = ', '.join(f"{phase} {seconds:.3f}s" for phase, seconds in result['phase_seconds'].items())
+                self.stdout.write(
+                    f"{result['mode']:<12} {result['assigned']:>6}/{result['orders']} заказов "
+                    f"за {result['wall_seconds']:.3f}s, "
+                    f"маршруты {result['route_km']} км / {result['route_minutes']} мин [{phases}]"
+                )
+                if result['error']:
+                    self.stderr.write(f"Ошибка: {result['error']}")
+                if result['profile']:
+                    self.stdout.write(result['profile'])
+
+        if options['output']:
+            report = {
+                'snapshot': options['snapshot'],
+                'recorded': snapshot.meta,
+                'created_at': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'results': results,
+            }
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            self.stdout.write(f"Результаты записаны в {options['output']}")
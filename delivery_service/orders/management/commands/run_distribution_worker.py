@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from orders.jobs import run_queued_jobs
+
+
+class Command(BaseCommand):
+    help = 'Выполняет задания распределения заказов из очереди'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Обработать очередь один раз и завершиться')
+        parser.add_argument('--interval', type=float, default=2.0, help='Пауза между опросами очереди, с')
+
+    def handle(self, *args, **options):
+        while True:
+            count = run_queued_jobs()
+            if count:
+                self.stdout.write(f"Выполнено заданий: {count}")
+            if options['once']:
+                break
+            time.sleep(options['interval'])
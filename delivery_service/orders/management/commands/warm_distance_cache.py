@@ -0,0 +1,39 @@
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+from orders.distance_cache import cache_enabled
+from orders.models import Courier, Order
+from orders.road_network import get_distance_provider
+
+
+class Command(BaseCommand):
+    help = 'Заполняет кэш расстояний между самыми частыми адресами и позициями курьеров'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=1000, help='Сколько точек взять, по частоте заказов')
+
+    def handle(self, *args, **options):
+        provider = get_distance_provider()
+        if provider is None or not cache_enabled():
+            raise CommandError('Кэш расстояний используется только с DISTANCE_PROVIDER = road_network и DISTANCE_CACHE enabled')
+
+        frequent = (
+            Order.objects.filter(lat__isnull=False, lon__isnull=False)
+            .values('lat', 'lon')
+            .annotate(orders=Count('id'))
+            .order_by('-orders')[:options['limit']]
+        )
+        points = [(float(row['lat']), float(row['lon'])) for row in frequent]
+        points.extend(
+            (float(lat), float(lon))
+            for lat, lon in Courier.objects.filter(current_location_lat__isnull=False, current_location_lon__isnull=False)
+            .values_list('current_location_lat', 'current_location_lon')
+        )
+        if not points:
+            self.stdout.write('Нет точек для расчета')
+            return
+
+        provider.distance_matrix(np.array(points))
+        provider.cache.persist(force=True)
+        self.stdout.write(f"Точек: {len(points)}; кэш: {provider.cache.stats()}")
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.6 on 2026-10-18 14:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0014_courierrating'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodeCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address_key', models.CharField(max_length=255, unique=True, verbose_name='Нормализованный адрес')),
+                ('address', models.CharField(max_length=255, verbose_name='Адрес')),
+                ('status', models.CharField(choices=[('found', 'Найден'), ('not_found', 'Не найден')], max_length=10, verbose_name='Результат')),
+                ('lat', models.DecimalField(blank=True, decimal_places=6, max_digits=9, null=True, verbose_name='Широта')),
+                ('lon', models.DecimalField(blank=True, decimal_places=6, max_digits=9, null=True, verbose_name='Долгота')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('expires_at', models.DateTimeField(db_index=True, verbose_name='Действует до')),
+            ],
+            options={
+                'verbose_name': 'Кэш геокодирования',
+                'verbose_name_plural': 'Кэш геокодирования',
+            },
+        ),
+    ]
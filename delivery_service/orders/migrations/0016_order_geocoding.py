@@ -0,0 +1,28 @@
+# Generated by Django 5.1.6 on 2026-10-18 14:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0015_geocodecache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='geocode_status',
+            field=models.CharField(choices=[('pending', 'Ожидает геокодирования'), ('ok', 'Координаты найдены'), ('failed', 'Адрес не найден')], default='pending', max_length=10, verbose_name='Статус геокодирования'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='lat',
+            field=models.DecimalField(blank=True, decimal_places=6, max_digits=9, null=True, verbose_name='Широта'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='lon',
+            field=models.DecimalField(blank=True, decimal_places=6, max_digits=9, null=True, verbose_name='Долгота'),
+        ),
+    ]
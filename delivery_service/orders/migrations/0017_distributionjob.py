@@ -0,0 +1,38 @@
+# Generated by Django 5.1.6 on 2026-10-18 14:18
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0016_order_geocoding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DistributionJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('queued', 'В очереди'), ('running', 'Выполняется'), ('done', 'Завершено'), ('failed', 'Ошибка')], db_index=True, default='queued', max_length=10, verbose_name='Статус')),
+                ('mode', models.CharField(blank=True, max_length=20, verbose_name='Режим распределения')),
+                ('phase', models.CharField(blank=True, max_length=30, verbose_name='Текущий этап')),
+                ('progress', models.FloatField(default=0, verbose_name='Прогресс')),
+                ('phase_timings', models.JSONField(blank=True, default=dict, verbose_name='Длительность этапов, с')),
+                ('assigned_count', models.PositiveIntegerField(default=0, verbose_name='Назначено заказов')),
+                ('message', models.TextField(blank=True, verbose_name='Результат')),
+                ('error', models.TextField(blank=True, verbose_name='Ошибка')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Начало')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Окончание')),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='distribution_jobs', to=settings.AUTH_USER_MODEL, verbose_name='Запустил')),
+            ],
+            options={
+                'verbose_name': 'Задание распределения',
+                'verbose_name_plural': 'Задания распределения',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
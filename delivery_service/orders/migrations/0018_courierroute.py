@@ -0,0 +1,28 @@
+# Generated by Django 5.1.6 on 2026-10-18 14:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0017_distributionjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CourierRoute',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stops', models.JSONField(blank=True, default=list, verbose_name='Заказы в порядке объезда')),
+                ('length_km', models.FloatField(default=0, verbose_name='Длина маршрута, км')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+                ('courier', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='route', to='orders.courier', verbose_name='Курьер')),
+            ],
+            options={
+                'verbose_name': 'Маршрут курьера',
+                'verbose_name_plural': 'Маршруты курьеров',
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.6 on 2026-10-18 14:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0018_courierroute'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='courierroute',
+            name='duration_min',
+            field=models.FloatField(default=0, verbose_name='Время в пути, мин'),
+        ),
+        migrations.AddField(
+            model_name='courierroute',
+            name='eta_minutes',
+            field=models.JSONField(blank=True, default=list, verbose_name='Прибытие к остановкам, мин'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.1.6 on 2026-10-18 14:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0019_courierroute_eta'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DispatchRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mode', models.CharField(max_length=20, verbose_name='Режим распределения')),
+                ('partition', models.CharField(blank=True, max_length=50, verbose_name='Раздел')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Дата запуска')),
+                ('duration_s', models.FloatField(default=0, verbose_name='Длительность, с')),
+                ('assigned_count', models.PositiveIntegerField(default=0, verbose_name='Назначено заказов')),
+                ('error', models.TextField(blank=True, verbose_name='Ошибка')),
+                ('phase_timings', models.JSONField(blank=True, default=dict, verbose_name='Длительность этапов, с')),
+                ('stats', models.JSONField(blank=True, default=dict, verbose_name='Показатели этапов')),
+                ('profile_mode', models.CharField(blank=True, max_length=10, verbose_name='Профилирование')),
+                ('profile', models.TextField(blank=True, verbose_name='Отчет профилировщика')),
+            ],
+            options={
+                'verbose_name': 'Запуск распределения',
+                'verbose_name_plural': 'Запуски распределения',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='distributionjob',
+            name='profile',
+            field=models.CharField(blank=True, max_length=10, verbose_name='Профилирование'),
+        ),
+        migrations.AddField(
+            model_name='distributionjob',
+            name='run',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='jobs', to='orders.dispatchrun', verbose_name='Запуск'),
+        ),
+    ]
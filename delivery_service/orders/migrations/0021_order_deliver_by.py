@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 15:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0020_dispatchrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='deliver_by',
+            field=models.DateTimeField(blank=True, help_text='Если не указано, заказ должен быть доставлен в стандартный срок с момента создания', null=True, verbose_name='Доставить до'),
+        ),
+    ]
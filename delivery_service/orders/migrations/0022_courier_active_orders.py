@@ -0,0 +1,30 @@
+# Generated by Django 5.1.6 on 2026-10-18 15:25
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_active_orders(apps, schema_editor):
+    Courier = apps.get_model('orders', 'Courier')
+    Order = apps.get_model('orders', 'Order')
+    Courier.objects.update(active_orders=Coalesce(Subquery(
+        Order.objects.filter(courier=OuterRef('pk'), status='In Progress')
+        .order_by().values('courier').annotate(count=Count('id')).values('count')
+    ), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0021_order_deliver_by'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='courier',
+            name='active_orders',
+            field=models.IntegerField(db_index=True, default=0, editable=False, verbose_name='Заказов в работе'),
+        ),
+        migrations.RunPython(count_active_orders, migrations.RunPython.noop),
+    ]
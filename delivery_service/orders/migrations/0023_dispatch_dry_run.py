@@ -0,0 +1,33 @@
+# Generated by Django 5.1.6 on 2026-10-18 15:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0022_courier_active_orders'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dispatchrun',
+            name='dry_run',
+            field=models.BooleanField(default=False, verbose_name='Пробный запуск'),
+        ),
+        migrations.AddField(
+            model_name='distributionjob',
+            name='applied_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='План применён'),
+        ),
+        migrations.AddField(
+            model_name='distributionjob',
+            name='dry_run',
+            field=models.BooleanField(default=False, verbose_name='Пробный запуск'),
+        ),
+        migrations.AddField(
+            model_name='distributionjob',
+            name='plan',
+            field=models.JSONField(blank=True, null=True, verbose_name='Предложенный план'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 16:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0023_dispatch_dry_run'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='batch_due_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, help_text='Заказ ждет пакетного распределения, которое начнется не позже этого времени', null=True, verbose_name='Пакетное распределение в'),
+        ),
+    ]
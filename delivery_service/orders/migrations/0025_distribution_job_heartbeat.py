@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0024_order_batch_due_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='distributionjob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, help_text='Обновляется, пока задание выполняется; задание без сигнала дольше DISTRIBUTION_JOB_TIMEOUT_SECONDS считается прерванным', null=True, verbose_name='Последний сигнал'),
+        ),
+    ]
@@ -1,9 +1,12 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import AbstractUser
 from decimal import Decimal  
 from django.utils.timezone import now
 from django.contrib.auth.hashers import make_password
-from django.db.models import Avg
+from django.db.models import Avg, Case, Count, F, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 
 class User(AbstractUser):
     ROLE_CHOICES = [
@@ -60,6 +63,8 @@ class Courier(models.Model):
     current_location_lat = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True, verbose_name='Текущая широта')
     current_location_lon = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True, verbose_name='Текущая долгота')
     user = models.OneToOneField(User, on_delete=models.CASCADE, null=True, blank=True)
+    # Orders 'In Progress', kept up to date by Order.save(), dispatch and manage.py reconcile_active_orders
+    active_orders = models.IntegerField(default=0, db_index=True, editable=False, verbose_name='Заказов в работе')
 
     def __str__(self):
         return self.name
@@ -80,6 +85,12 @@ class Courier(models.Model):
             user.first_name = self.name
             user.save()
         self.user = user
+        if not self._state.adding and 'update_fields' not in kwargs:
+            # The counter is only changed with F() updates; a stale copy must not overwrite it
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'active_orders'
+            ]
         super().save(*args, **kwargs)
 
     def get_monthly_orders_count(self):
@@ -103,12 +114,46 @@ class Courier(models.Model):
         ).count()
         return delivered_orders * Decimal('10.00')
     
+def adjust_active_orders(changes):
+    """Apply {courier id: change} to the couriers' active order counters in one UPDATE"""
+    changes = {courier_id: change for courier_id, change in changes.items() if courier_id and change}
+    if changes:
+        Courier.objects.filter(id__in=list(changes)).update(active_orders=F('active_orders') + Case(
+            *[When(id=courier_id, then=Value(change)) for courier_id, change in changes.items()],
+            default=Value(0),
+            output_field=models.IntegerField()
+        ))
+
+def counted_active_orders():
+    """Expression counting a courier's orders 'In Progress' from the orders table"""
+    return Coalesce(Subquery(
+        Order.objects.filter(courier=OuterRef('pk'), status='In Progress')
+        .order_by().values('courier').annotate(count=Count('id')).values('count')
+    ), 0)
+
+def reconcile_active_orders(dry_run=False):
+    """Rebuild drifted Courier.active_orders counters; returns {courier id: (stored, counted)} of the drifted ones"""
+    drifted = {
+        courier_id: (stored, counted)
+        for courier_id, stored, counted in Courier.objects.annotate(counted=counted_active_orders())
+        .exclude(active_orders=F('counted')).values_list('id', 'active_orders', 'counted')
+    }
+    if drifted and not dry_run:
+        # Recounted inside the UPDATE, so orders changed in the meantime are not lost
+        Courier.objects.filter(id__in=list(drifted)).update(active_orders=counted_active_orders())
+    return drifted
+
 class Order(models.Model):
     STATUS_CHOICES = [
         ('Pending', 'Ожидает обработки'),
         ('In Progress', 'В процессе доставки'),
         ('Delivered', 'Доставлен'),
     ]
+    GEOCODE_STATUS_CHOICES = [
+        ('pending', 'Ожидает геокодирования'),
+        ('ok', 'Координаты найдены'),
+        ('failed', 'Адрес не найден'),
+    ]
 
     customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name="orders", verbose_name='Клиент', null=True, blank=True)
     courier = models.ForeignKey('Courier', on_delete=models.CASCADE, related_name="orders", verbose_name='Курьер', null=True, blank=True)
@@ -118,6 +163,11 @@ class Order(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата обновления')
     delivery_date = models.DateTimeField(null=True, blank=True, verbose_name='Дата доставки')
+    deliver_by = models.DateTimeField(null=True, blank=True, verbose_name='Доставить до', help_text='Если не указано, заказ должен быть доставлен в стандартный срок с момента создания')
+    lat = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True, verbose_name='Широта')
+    lon = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True, verbose_name='Долгота')
+    batch_due_at = models.DateTimeField(null=True, blank=True, db_index=True, editable=False, verbose_name='Пакетное распределение в', help_text='Заказ ждет пакетного распределения, которое начнется не позже этого времени')
+    geocode_status = models.CharField(max_length=10, choices=GEOCODE_STATUS_CHOICES, default='pending', verbose_name='Статус геокодирования')
 
     class Meta:
         verbose_name = 'Заказ'
@@ -125,18 +175,36 @@ class Order(models.Model):
         ordering = ['-created_at']
 
     def save(self, *args, **kwargs):
-        if self.pk:
-            old_status = Order.objects.get(pk=self.pk).status
-            if old_status != 'Delivered' and self.status == 'Delivered':
-                self.delivery_date = now()
-                if self.courier:
-                    self.courier.balance += Decimal('10.00')
-                    self.courier.save()
-        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        with transaction.atomic():
+            old = None
+            if self.pk:
+                # Locked until commit, so of two concurrent saves the second sees the first one's
+                # status and the counter and balance change once per transition
+                old = Order.objects.select_for_update().filter(pk=self.pk).values('status', 'courier_id').first()
+                if old and old['status'] != 'Delivered' and self.status == 'Delivered':
+                    self.delivery_date = now()
+                    if self.courier:
+                        self.courier.balance += Decimal('10.00')
+                        self.courier.save()
+            super().save(*args, **kwargs)
+            if update_fields is not None and not {'status', 'courier'} & set(update_fields):
+                return
+            changes = {}
+            if old and old['status'] == 'In Progress' and old['courier_id']:
+                changes[old['courier_id']] = -1
+            if self.status == 'In Progress' and self.courier_id:
+                changes[self.courier_id] = changes.get(self.courier_id, 0) + 1
+            adjust_active_orders(changes)
 
     def __str__(self):
         return f"Заказ №{self.id} - {self.get_status_display()}"
 
+@receiver(post_delete, sender=Order)
+def _release_active_order(sender, instance, **kwargs):
+    if instance.status == 'In Progress' and instance.courier_id:
+        adjust_active_orders({instance.courier_id: -1})
+
 class CourierRating(models.Model):
     courier = models.ForeignKey(Courier, on_delete=models.CASCADE, related_name='ratings')
     customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='given_ratings')
@@ -152,4 +220,105 @@ class CourierRating(models.Model):
 
     @property
     def average_rating(self):
-        return CourierRating.objects.filter(courier=self.courier).aggregate(Avg('rating'))['rating__avg'] or 0
\ No newline at end of file
+        return CourierRating.objects.filter(courier=self.courier).aggregate(Avg('rating'))['rating__avg'] or 0
+
+class GeocodeCache(models.Model):
+    STATUS_CHOICES = [
+        ('found', 'Найден'),
+        ('not_found', 'Не найден'),
+    ]
+
+    address_key = models.CharField(max_length=255, unique=True, verbose_name='Нормализованный адрес')
+    address = models.CharField(max_length=255, verbose_name='Адрес')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, verbose_name='Результат')
+    lat = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True, verbose_name='Широта')
+    lon = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True, verbose_name='Долгота')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+    expires_at = models.DateTimeField(db_index=True, verbose_name='Действует до')
+
+    class Meta:
+        verbose_name = 'Кэш геокодирования'
+        verbose_name_plural = 'Кэш геокодирования'
+
+    def __str__(self):
+        return f"{self.address} ({self.get_status_display()})"
+
+    @property
+    def coords(self):
+        if self.status != 'found':
+            return None
+        return float(self.lat), float(self.lon)
+
+
+class DispatchRun(models.Model):
+    mode = models.CharField(max_length=20, verbose_name='Режим распределения')
+    dry_run = models.BooleanField(default=False, verbose_name='Пробный запуск')
+    partition = models.CharField(max_length=50, blank=True, verbose_name='Раздел')
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Дата запуска')
+    duration_s = models.FloatField(default=0, verbose_name='Длительность, с')
+    assigned_count = models.PositiveIntegerField(default=0, verbose_name='Назначено заказов')
+    error = models.TextField(blank=True, verbose_name='Ошибка')
+    phase_timings = models.JSONField(default=dict, blank=True, verbose_name='Длительность этапов, с')
+    stats = models.JSONField(default=dict, blank=True, verbose_name='Показатели этапов')
+    profile_mode = models.CharField(max_length=10, blank=True, verbose_name='Профилирование')
+    profile = models.TextField(blank=True, verbose_name='Отчет профилировщика')
+
+    class Meta:
+        verbose_name = 'Запуск распределения'
+        verbose_name_plural = 'Запуски распределения'
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"Запуск №{self.id} ({self.mode}) - {self.assigned_count} заказов"
+
+
+class DistributionJob(models.Model):
+    STATUS_CHOICES = [
+        ('queued', 'В очереди'),
+        ('running', 'Выполняется'),
+        ('done', 'Завершено'),
+        ('failed', 'Ошибка'),
+    ]
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued', db_index=True, verbose_name='Статус')
+    mode = models.CharField(max_length=20, blank=True, verbose_name='Режим распределения')
+    dry_run = models.BooleanField(default=False, verbose_name='Пробный запуск')
+    plan = models.JSONField(null=True, blank=True, verbose_name='Предложенный план')
+    applied_at = models.DateTimeField(null=True, blank=True, verbose_name='План применён')
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='distribution_jobs', verbose_name='Запустил')
+    phase = models.CharField(max_length=30, blank=True, verbose_name='Текущий этап')
+    progress = models.FloatField(default=0, verbose_name='Прогресс')
+    phase_timings = models.JSONField(default=dict, blank=True, verbose_name='Длительность этапов, с')
+    profile = models.CharField(max_length=10, blank=True, verbose_name='Профилирование')
+    run = models.ForeignKey(DispatchRun, on_delete=models.SET_NULL, null=True, blank=True, related_name='jobs', verbose_name='Запуск')
+    assigned_count = models.PositiveIntegerField(default=0, verbose_name='Назначено заказов')
+    message = models.TextField(blank=True, verbose_name='Результат')
+    error = models.TextField(blank=True, verbose_name='Ошибка')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name='Начало')
+    heartbeat_at = models.DateTimeField(null=True, blank=True, verbose_name='Последний сигнал', help_text='Обновляется, пока задание выполняется; задание без сигнала дольше DISTRIBUTION_JOB_TIMEOUT_SECONDS считается прерванным')
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name='Окончание')
+
+    class Meta:
+        verbose_name = 'Задание распределения'
+        verbose_name_plural = 'Задания распределения'
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"Распределение №{self.id} - {self.get_status_display()}"
+
+
+class CourierRoute(models.Model):
+    courier = models.OneToOneField(Courier, on_delete=models.CASCADE, related_name='route', verbose_name='Курьер')
+    stops = models.JSONField(default=list, blank=True, verbose_name='Заказы в порядке объезда')
+    length_km = models.FloatField(default=0, verbose_name='Длина маршрута, км')
+    duration_min = models.FloatField(default=0, verbose_name='Время в пути, мин')
+    eta_minutes = models.JSONField(default=list, blank=True, verbose_name='Прибытие к остановкам, мин')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата обновления')
+
+    class Meta:
+        verbose_name = 'Маршрут курьера'
+        verbose_name_plural = 'Маршруты курьеров'
+
+    def __str__(self):
+        return f"Маршрут курьера {self.courier_id} ({len(self.stops)} остановок)"
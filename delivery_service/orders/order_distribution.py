@@ -1,43 +1,37 @@
 from ortools.constraint_solver import routing_enums_pb2
 from ortools.constraint_solver import pywrapcp
+from django.conf import settings
 from django.db.models import Q
-from .models import Order, Courier
-from math import radians, sin, cos, sqrt, atan2
+from .models import Order, Courier, CourierRoute, DispatchRun, adjust_active_orders
+from .geocoding import geocode_order, geocode_orders, get_cache_stats
+from .instrumentation import PROFILE_MODES, DispatchTrace, current_trace, observe_run
+from . import distance_cache
+from .solver_pool import solve_tsps, solve_vrps
+from .batching import batching_enabled, enqueue_order
+from .order_queue import OrderQueue, urgency
+from .tasks import run_in_background
+from math import radians, sin, cos, sqrt, atan2, ceil
 import numpy as np
-import requests
-import time
 import logging
-from django.db import transaction
-from django.db.models import F
-from django.db.models import Count
+import time
+from dataclasses import dataclass
+from django.db import connections, transaction
+from django.db.models.sql import UpdateQuery
+from django.utils import timezone
+from django.db.models import Case, When, Value
 
 logger = logging.getLogger(__name__)
 
-def geocode_address(address):
-    """Convert address to coordinates using OpenStreetMap Nominatim"""
-    try:
-        # Add a small delay to respect Nominatim's usage policy
-        time.sleep(1)
-                    
-        # Format the address for the API
-        formatted_address = address.replace(' ', '+')
-        
-        # Make the request to Nominatim
-        url = f'https://nominatim.openstreetmap.org/search?q={formatted_address}&format=json&limit=1'
-        headers = {'User-Agent': 'DeliveryService/1.0'}
-        
-        response = requests.get(url, headers=headers)
-        data = response.json()
-        
-        if data and len(data) > 0:
-            return float(data[0]['lat']), float(data[0]['lon'])
-        return None
-    except Exception as e:
-        logger.error(f"Error geocoding address {address}: {str(e)}")
-        return None
+EARTH_RADIUS_KM = 6371
+SYMMETRIC_BLOCK_ROWS = 256
+KM_PER_DEGREE = 111.195  # length of one degree of latitude
+MAX_ACTIVE_ORDERS = 5  # orders a courier can carry at once
+ASSIGNMENT_BATCH_SIZE = 500  # orders per UPDATE when saving a dispatch plan
+DISTRIBUTION_MODES = ('per_courier', 'global', 'cluster')
+VEHICLE_TYPES = ('Автомобиль', 'Мотоцикл', 'Велосипед')
 
 def calculate_distance(lat1, lon1, lat2, lon2):
-    R = 6371  # Earth's radius in kilometers
+    R = EARTH_RADIUS_KM
 
     lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
     dlat = lat2 - lat1
@@ -49,27 +43,250 @@ def calculate_distance(lat1, lon1, lat2, lon2):
 
     return distance
 
-def create_distance_matrix(locations):
-    size = len(locations)
-    matrix = np.zeros((size, size))
-    
-    for i in range(size):
-        for j in range(size):
-            if i != j:
-                matrix[i][j] = calculate_distance(
-                    locations[i]['lat'], locations[i]['lon'],
-                    locations[j]['lat'], locations[j]['lon']
-                )
-    
-    return matrix
+def _haversine(lat1, lon1, lat2, lon2):
+    """Element-wise great-circle distance in km; arguments are radians and broadcast"""
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    a = np.clip(a, 0, 1)
+    return EARTH_RADIUS_KM * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+def haversine_matrix(origins, destinations=None, dtype=np.float64, symmetric=False):
+    """Distance matrix in km between (lat, lon) points given as (n, 2) arrays in degrees.
+
+    Without destinations the square origins x origins matrix is returned;
+    otherwise the rectangular origins x destinations block. symmetric=True
+    evaluates only the upper triangle of a square matrix and mirrors it.
+    The computation runs in dtype, so float32 halves memory and bandwidth.
+    """
+    origins = np.radians(np.asarray(origins, dtype=dtype).reshape(-1, 2))
+
+    if symmetric:
+        if destinations is not None:
+            raise ValueError("symmetric mode needs a square matrix")
+        size = len(origins)
+        matrix = np.zeros((size, size), dtype=dtype)
+        # Row blocks against the columns right of the diagonal, then mirror
+        for start in range(0, size, SYMMETRIC_BLOCK_ROWS):
+            stop = min(start + SYMMETRIC_BLOCK_ROWS, size)
+            block = _haversine(
+                origins[start:stop, 0:1], origins[start:stop, 1:2],
+                origins[None, start:, 0], origins[None, start:, 1]
+            )
+            block[:, :stop - start] = np.triu(block[:, :stop - start], 1)
+            matrix[start:stop, start:] = block
+        matrix += matrix.T
+        return matrix
+
+    if destinations is None:
+        destinations = origins
+    else:
+        destinations = np.radians(np.asarray(destinations, dtype=dtype).reshape(-1, 2))
+    matrix = _haversine(
+        origins[:, 0:1], origins[:, 1:2],
+        destinations[None, :, 0], destinations[None, :, 1]
+    )
+    return matrix.astype(dtype, copy=False)
+
+def location_coords(locations):
+    """(n, 2) array of (lat, lon) for a list of location dicts"""
+    return np.array([(loc['lat'], loc['lon']) for loc in locations], dtype=np.float64).reshape(-1, 2)
+
+def create_distance_matrix(locations, dtype=np.float64, symmetric=False):
+    """Square distance matrix in km between location dicts, from the configured DISTANCE_PROVIDER"""
+    from .road_network import get_distance_provider
+    provider = get_distance_provider()
+    if provider is not None:
+        # Road distances are not symmetric (one-way streets), so the hint does not apply
+        return provider.distance_matrix(location_coords(locations)).astype(dtype, copy=False)
+    return haversine_matrix(location_coords(locations), dtype=dtype, symmetric=symmetric)
+
+@dataclass
+class SolverSettings:
+    """Search budget for the routing solver, scaled to the number of nodes.
+
+    Instances up to exact_max_nodes are solved exactly by dynamic programming.
+    Larger ones get time_limit_per_node seconds per node (clamped to
+    [min_time_limit, max_time_limit]) and, from guided_local_search_min_nodes
+    on, guided local search. The search also stops once no better solution
+    was found for lack_of_improvement_seconds.
+    """
+    time_limit_per_node: float = 0.1
+    min_time_limit: float = 1.0
+    max_time_limit: float = 30.0
+    solutions_per_node: int = 0  # 0 = no solution limit
+    exact_max_nodes: int = 8
+    guided_local_search_min_nodes: int | None = 15  # None = never use guided local search
+    lack_of_improvement_seconds: float | None = 2.0
+
+    @classmethod
+    def from_settings(cls):
+        return cls(**getattr(settings, 'ORDER_SOLVER', {}))
+
+    def time_limit(self, size):
+        return min(self.max_time_limit, max(self.min_time_limit, self.time_limit_per_node * size))
+
+    def solution_limit(self, size):
+        return self.solutions_per_node * size if self.solutions_per_node else 0
+
+    def use_guided_local_search(self, size):
+        return self.guided_local_search_min_nodes is not None and size >= self.guided_local_search_min_nodes
+
+@dataclass(frozen=True)
+class VehicleProfile:
+    """Travel time model of one vehicle type: straight-line km x detour_factor at speed_kmh"""
+    speed_kmh: float
+    detour_factor: float = 1.3
+
+    @classmethod
+    def for_vehicle(cls, vehicle):
+        profiles = getattr(settings, 'VEHICLE_PROFILES', {})
+        default = getattr(settings, 'DEFAULT_VEHICLE_PROFILE', {'speed_kmh': 20.0})
+        profile = profiles.get(vehicle, default)
+        if getattr(settings, 'DISTANCE_PROVIDER', 'haversine') != 'haversine':
+            # Road distances already include the detours
+            profile = {**profile, 'detour_factor': 1.0}
+        return cls(**profile)
+
+    @property
+    def minutes_per_km(self):
+        return self.detour_factor / self.speed_kmh * 60
+
+class TravelTimes:
+    """Travel time matrices in minutes derived from one distance matrix, one cached per vehicle type"""
+
+    def __init__(self, distance_matrix):
+        self.distance_matrix = distance_matrix
+        self._matrices = {}
+
+    def for_vehicle(self, vehicle):
+        if vehicle not in self._matrices:
+            self._matrices[vehicle] = self.distance_matrix * VehicleProfile.for_vehicle(vehicle).minutes_per_km
+        return self._matrices[vehicle]
 
-def solve_tsp(distance_matrix):
+def _search_parameters(routing, solver_settings, size):
+    """Search parameters for a model of the given size, with the early stop installed"""
+    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
+    search_parameters.first_solution_strategy = (
+        routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)
+    search_parameters.time_limit.FromMilliseconds(int(solver_settings.time_limit(size) * 1000))
+    if solver_settings.solution_limit(size):
+        search_parameters.solution_limit = solver_settings.solution_limit(size)
+    if solver_settings.use_guided_local_search(size):
+        search_parameters.local_search_metaheuristic = (
+            routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH)
+
+        if solver_settings.lack_of_improvement_seconds:
+            # Guided local search runs until the time limit unless stopped
+            state = {'best': None, 'improved_at': time.monotonic()}
+
+            def on_solution():
+                cost = routing.CostVar().Value()
+                if state['best'] is None or cost < state['best']:
+                    state['best'] = cost
+                    state['improved_at'] = time.monotonic()
+                elif time.monotonic() - state['improved_at'] > solver_settings.lack_of_improvement_seconds:
+                    routing.solver().FinishCurrentSearch()
+
+            routing.AddAtSolutionCallback(on_solution)
+    return search_parameters
+
+def solve_tsp_exact(distance_matrix):
+    """Optimal closed tour from node 0 by Held-Karp dynamic programming (small instances only)"""
+    size = len(distance_matrix)
+    matrix = np.asarray(distance_matrix, dtype=np.float64).tolist()
+    full = (1 << (size - 1)) - 1
+    # cost[mask][last]: shortest path from 0 through the nodes in mask, ending at last
+    cost = [[float('inf')] * size for _ in range(full + 1)]
+    parent = [[0] * size for _ in range(full + 1)]
+    for node in range(1, size):
+        cost[1 << (node - 1)][node] = matrix[0][node]
+
+    for mask in range(1, full + 1):
+        for last in range(1, size):
+            base = cost[mask][last]
+            if base == float('inf'):
+                continue
+            for nxt in range(1, size):
+                bit = 1 << (nxt - 1)
+                if mask & bit:
+                    continue
+                candidate = base + matrix[last][nxt]
+                if candidate < cost[mask | bit][nxt]:
+                    cost[mask | bit][nxt] = candidate
+                    parent[mask | bit][nxt] = last
+
+    last = min(range(1, size), key=lambda node: cost[full][node] + matrix[node][0])
+    path = []
+    mask = full
+    while last:
+        path.append(last)
+        mask, last = mask & ~(1 << (last - 1)), parent[mask][last]
+    return [0] + path[::-1] + [0]
+
+def _complete_route(route, distance_matrix):
+    """Extend a partial visiting order to every node by cheapest insertion into the tour from node 0"""
+    matrix = np.asarray(distance_matrix)
+    size = len(matrix)
+    tour = []
+    for node in route:
+        if 0 < node < size and node not in tour:
+            tour.append(node)
+    for node in range(1, size):
+        if node in tour:
+            continue
+        stops = np.array([0, *tour, 0])
+        costs = matrix[stops[:-1], node] + matrix[node, stops[1:]] - matrix[stops[:-1], stops[1:]]
+        tour.insert(int(np.argmin(costs)), node)
+    return tour
+
+def _record_solve(routing, solution, warm_start):
+    """Report the search status and objective to the running dispatch trace"""
+    status = routing_enums_pb2.RoutingSearchStatus.Value.Name(routing.status()).lower()
+    current_trace().record(
+        'solve',
+        models=1,
+        warm_starts=int(warm_start),
+        objective=solution.ObjectiveValue() / 1000 if solution else 0.0,
+        **{status: 1}
+    )
+
+def _solve_from(routing, manager, search_parameters, initial_routes):
+    """Solve, warm-starting from initial_routes (node lists per vehicle) when they are feasible"""
+    if initial_routes:
+        # The metaheuristic is fixed when the model is closed, so close it with our parameters
+        routing.CloseModelWithParameters(search_parameters)
+        # The solver reads routes as variable indices, which differ from nodes once the depot is only an end
+        indices = [[manager.NodeToIndex(node) for node in route] for route in initial_routes]
+        initial = routing.ReadAssignmentFromRoutes(indices, True)
+        if initial:
+            solution = routing.SolveFromAssignmentWithParameters(initial, search_parameters)
+            _record_solve(routing, solution, True)
+            return solution
+        logger.info("Stored route is not feasible any more, solving from scratch")
+    solution = routing.SolveWithParameters(search_parameters)
+    _record_solve(routing, solution, False)
+    return solution
+
+def solve_tsp(distance_matrix, solver_settings=None, initial_route=None):
+    """Closed tour from node 0 as a node list starting and ending with 0, or None.
+
+    initial_route, e.g. the courier's stored route, is a visiting order of
+    some of the nodes; the solver starts from it instead of from scratch.
+    """
+    solver_settings = solver_settings or SolverSettings.from_settings()
     try:
         # Check matrix size
         size = len(distance_matrix)
         if size <= 1:
             return [0] if size == 1 else None
-            
+
+        # Tiny routes are solved exactly in microseconds, no solver needed
+        if size <= solver_settings.exact_max_nodes:
+            route = solve_tsp_exact(distance_matrix)
+            current_trace().record('solve', exact=1, objective=float(sum(
+                distance_matrix[a][b] for a, b in zip(route, route[1:])
+            )))
+            return route
+
         # Convert distances to integers to avoid floating point issues
         int_matrix = np.array(distance_matrix * 1000, dtype=np.int64)
         
@@ -86,13 +303,11 @@ def solve_tsp(distance_matrix):
         routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
 
         # Set search parameters
-        search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-        search_parameters.first_solution_strategy = (
-            routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)
-        search_parameters.time_limit.FromSeconds(30)  # Add time limit
+        search_parameters = _search_parameters(routing, solver_settings, size)
 
         # Solve the problem
-        solution = routing.SolveWithParameters(search_parameters)
+        initial_routes = [_complete_route(initial_route, distance_matrix)] if initial_route else None
+        solution = _solve_from(routing, manager, search_parameters, initial_routes)
         
         if solution:
             index = routing.Start(0)
@@ -107,137 +322,1305 @@ def solve_tsp(distance_matrix):
         logger.error(f"Error in solve_tsp: {str(e)}")
         return None
 
-def distribute_orders():
-    try:
-        # Get all available couriers (those with less than 5 active orders)
-        available_couriers = Courier.objects.annotate(
-            active_orders_count=Count(
-                'orders',
-                filter=Q(orders__status='In Progress')
-            )
-        ).filter(active_orders_count__lt=5)
+class GridIndex:
+    """Uniform grid over order coordinates for k-nearest queries within a radius.
 
-        if not available_couriers.exists():
-            logger.info("No available couriers found")
-            return
+    Cells are cell_km wide; a query scans rings of cells around the point
+    until k candidates are closer than any unscanned cell could be.
+    """
+
+    def __init__(self, coords, ids, cell_km=1.0):
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        self.ids = list(ids)
+        self.cell_km = cell_km
+        mean_lat = float(self.coords[:, 0].mean()) if len(self.coords) else 0.0
+        self.lat_step = cell_km / KM_PER_DEGREE
+        self.lon_step = cell_km / (KM_PER_DEGREE * max(cos(radians(mean_lat)), 0.01))
+        self.alive = np.ones(len(self.ids), dtype=bool)
+        self._rows = {order_id: row for row, order_id in enumerate(self.ids)}
+        self.cells = {}
+        for row, cell in enumerate(map(tuple, self._cells_of(self.coords))):
+            self.cells.setdefault(cell, []).append(row)
+
+    def _cells_of(self, coords):
+        return np.stack([
+            np.floor(coords[:, 0] / self.lat_step),
+            np.floor(coords[:, 1] / self.lon_step)
+        ], axis=1).astype(np.int64)
+
+    def __len__(self):
+        return int(self.alive.sum())
 
-        # Get all unassigned orders
-        unassigned_orders = Order.objects.filter(courier__isnull=True)
-        if not unassigned_orders.exists():
-            logger.info("No unassigned orders found")
+    def remove(self, order_id):
+        row = self._rows.get(order_id)
+        if row is not None:
+            self.alive[row] = False
+
+    def _ring(self, center, ring):
+        ci, cj = center
+        if ring == 0:
+            yield ci, cj
             return
+        for dj in range(-ring, ring + 1):
+            yield ci - ring, cj + dj
+            yield ci + ring, cj + dj
+        for di in range(-ring + 1, ring):
+            yield ci + di, cj - ring
+            yield ci + di, cj + ring
+
+    def first(self, k):
+        """Ids of the first k alive points in insertion order"""
+        return [self.ids[row] for row in np.flatnonzero(self.alive)[:max(k, 0)]]
+
+    def nearest(self, lat, lon, k, radius_km):
+        """Ids of up to k alive points within radius_km, closest first"""
+        if k <= 0 or not len(self):
+            return []
+        center = tuple(self._cells_of(np.array([[lat, lon]]))[0])
+        max_ring = int(np.ceil(radius_km / self.cell_km)) + 1
+        rows = []
+        for ring in range(max_ring + 1):
+            for cell in self._ring(center, ring):
+                rows.extend(self.cells.get(cell, ()))
+            # Anything outside the scanned rings is at least ring * cell_km away
+            if len(rows) >= k and ring > 0:
+                candidates = np.array(rows)
+                candidates = candidates[self.alive[candidates]]
+                distances = haversine_matrix([[lat, lon]], self.coords[candidates])[0]
+                if np.count_nonzero(distances <= ring * self.cell_km) >= k:
+                    break
+        if not rows:
+            return []
+        candidates = np.array(rows)
+        candidates = candidates[self.alive[candidates]]
+        distances = haversine_matrix([[lat, lon]], self.coords[candidates])[0]
+        within = distances <= radius_km
+        candidates, distances = candidates[within], distances[within]
+        closest = candidates[np.argsort(distances, kind='stable')[:k]]
+        return [self.ids[row] for row in closest]
+
+def build_order_index(orders):
+    """GridIndex over the orders that have coordinates"""
+    located = [order for order in orders if order.lat is not None and order.lon is not None]
+    coords = [(float(order.lat), float(order.lon)) for order in located]
+    return GridIndex(coords, [order.id for order in located], cell_km=getattr(settings, 'ORDER_GRID_CELL_KM', 1.0))
+
+def kmeans(points, k, iterations=25, seed=0):
+    """Vectorized k-means of an (n, 2) array of coordinates; returns (labels, centroids).
+
+    Points are projected onto a local plane in km, seeded with k-means++ and
+    refined by Lloyd iterations until no label changes. The seed is fixed so
+    the same backlog is always split the same way. Centroids are lat/lon.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    k = max(1, min(k, len(points)))
+    lon_scale = max(cos(radians(float(points[:, 0].mean()))), 0.01)
+    xy = points * KM_PER_DEGREE
+    xy[:, 1] *= lon_scale
 
+    rng = np.random.default_rng(seed)
+    centroids = np.empty((k, 2))
+    centroids[0] = xy[rng.integers(len(xy))]
+    closest = ((xy - centroids[0]) ** 2).sum(axis=1)
+    for i in range(1, k):
+        total = closest.sum()
+        centroids[i] = xy[rng.choice(len(xy), p=closest / total) if total > 0 else rng.integers(len(xy))]
+        closest = np.minimum(closest, ((xy - centroids[i]) ** 2).sum(axis=1))
+
+    # |x - c|^2 = |x|^2 - 2 x.c + |c|^2 keeps the work at one (n, k) array per iteration
+    squared = (xy ** 2).sum(axis=1)[:, None]
+    labels = None
+    for _ in range(iterations):
+        distances = squared - 2 * xy @ centroids.T + (centroids ** 2).sum(axis=1)[None, :]
+        new_labels = distances.argmin(axis=1)
+        if labels is not None and np.array_equal(labels, new_labels):
+            break
+        labels = new_labels
+        counts = np.bincount(labels, minlength=k)
+        filled = counts > 0
+        for axis in (0, 1):
+            sums = np.bincount(labels, weights=xy[:, axis], minlength=k)
+            centroids[filled, axis] = sums[filled] / counts[filled]
+
+    centroids = centroids / KM_PER_DEGREE
+    centroids[:, 1] /= lon_scale
+    return labels, centroids
+
+def order_location(order):
+    """Location entry for an order with stored coordinates, None if it has none"""
+    if order.lat is None or order.lon is None:
+        return None
+    return {
+        'order_id': order.id,
+        'lat': float(order.lat),
+        'lon': float(order.lon)
+    }
+
+def geocode_pending_orders(orders):
+    """Resolve orders the background geocoding pipeline has not reached yet"""
+    pending = [order for order in orders if order.geocode_status == 'pending']
+    if pending:
+        geocode_orders(pending)
+
+def solve_vrp(distance_matrix, vehicle_starts, capacities, pinned=None, optional_nodes=(), drop_penalty=None,
+              solver_settings=None, initial_routes=None, vehicle_matrices=None, drop_weights=None):
+    """Solve one routing model for several couriers at once.
+
+    Node 0 is a virtual depot with zero-cost arcs: every vehicle ends there
+    (routes are open) and vehicles without a known position start there.
+    Every node other than the depot and the start nodes is one order and
+    uses one unit of the vehicle capacity. pinned maps nodes to the vehicle
+    that must keep them; optional_nodes may be left out at drop_penalty,
+    scaled per node by drop_weights (so urgent orders are dropped last).
+    initial_routes, one node list per vehicle without its start node, seeds
+    the search. vehicle_matrices gives each vehicle its own cost matrix
+    (e.g. travel times of its vehicle type; vehicles may share one), in
+    place of distance_matrix. Returns the visited nodes of each vehicle in
+    order, or None.
+    """
+    solver_settings = solver_settings or SolverSettings.from_settings()
+    try:
+        size = len(distance_matrix)
+        num_vehicles = len(vehicle_starts)
+        pinned = pinned or {}
+        if num_vehicles == 0:
+            return None
+
+        vehicle_matrices = vehicle_matrices or [distance_matrix] * num_vehicles
+        manager = pywrapcp.RoutingIndexManager(size, num_vehicles, list(vehicle_starts), [0] * num_vehicles)
+        routing = pywrapcp.RoutingModel(manager)
+
+        # One integer matrix and transit callback per distinct cost matrix; the
+        # callbacks list keeps the Python functions alive while the model uses them
+        callbacks = {}
+        int_matrices = []
+        cost_callbacks = []
+        for vehicle, matrix in enumerate(vehicle_matrices):
+            if id(matrix) not in callbacks:
+                int_matrix = np.array(matrix * 1000, dtype=np.int64)
+                int_matrix[:, 0] = 0
+                int_matrix[0, :] = 0
+                int_matrices.append(int_matrix)
+
+                def cost_callback(from_index, to_index, int_matrix=int_matrix):
+                    return int_matrix[manager.IndexToNode(from_index)][manager.IndexToNode(to_index)]
+
+                cost_callbacks.append(cost_callback)
+                callbacks[id(matrix)] = routing.RegisterTransitCallback(cost_callback)
+            routing.SetArcCostEvaluatorOfVehicle(callbacks[id(matrix)], vehicle)
+
+        if drop_penalty is None:
+            drop_penalty = max(int(int_matrix.max()) for int_matrix in int_matrices) * 4 + 1
+
+        start_nodes = set(vehicle_starts)
+        demands = [0 if node == 0 or node in start_nodes else 1 for node in range(size)]
+
+        def demand_callback(from_index):
+            return demands[manager.IndexToNode(from_index)]
+
+        demand_callback_index = routing.RegisterUnaryTransitCallback(demand_callback)
+        routing.AddDimensionWithVehicleCapacity(
+            demand_callback_index, 0, [int(c) for c in capacities], True, 'Capacity')
+
+        for node, vehicle in pinned.items():
+            routing.VehicleVar(manager.NodeToIndex(node)).SetValues([vehicle])
+        drop_weights = drop_weights or {}
+        for node in optional_nodes:
+            routing.AddDisjunction([manager.NodeToIndex(node)], int(drop_penalty * drop_weights.get(node, 1.0)))
+
+        search_parameters = _search_parameters(routing, solver_settings, size)
+        solution = _solve_from(routing, manager, search_parameters, initial_routes)
+        if not solution:
+            return None
+
+        routes = []
+        for vehicle in range(num_vehicles):
+            index = solution.Value(routing.NextVar(routing.Start(vehicle)))
+            route = []
+            while not routing.IsEnd(index):
+                route.append(manager.IndexToNode(index))
+                index = solution.Value(routing.NextVar(index))
+            routes.append(route)
+        return routes
+    except Exception as e:
+        logger.error(f"Error in solve_vrp: {str(e)}")
+        return None
+
+def courier_location(courier):
+    if courier.current_location_lat is None or courier.current_location_lon is None:
+        return None
+    return {
+        'order_id': 'courier_start',
+        'lat': float(courier.current_location_lat),
+        'lon': float(courier.current_location_lon)
+    }
+
+def save_assignments(plan):
+    """Persist a whole dispatch plan in one transaction.
+
+    plan maps order id -> courier id. Orders that were taken by someone else
+    in the meantime are skipped. The work is done in chunks of
+    ASSIGNMENT_BATCH_SIZE with three queries each: one locks the rows that
+    are still unassigned, one gives those that are still unassigned when it
+    runs their couriers at once and one adds the orders it changed to the
+    couriers' active order counters. Returns the ids of the orders actually
+    assigned.
+    """
+    assigned = []
+    order_ids = list(plan)
+    with transaction.atomic():
+        for start in range(0, len(order_ids), ASSIGNMENT_BATCH_SIZE):
+            chunk = order_ids[start:start + ASSIGNMENT_BATCH_SIZE]
+            claimable = list(Order.objects.select_for_update().filter(
+                id__in=chunk,
+                courier__isnull=True
+            ).values_list('id', flat=True))
+            if claimable:
+                # The lock is a no-op on SQLite, so the update checks again that the orders are free
+                claimable = _update_returning_ids(
+                    Order.objects.filter(id__in=claimable, courier__isnull=True),
+                    courier_id=Case(*[When(id=order_id, then=Value(plan[order_id])) for order_id in claimable]),
+                    status='In Progress',
+                    batch_due_at=None
+                )
+                loads = {}
+                for order_id in claimable:
+                    loads[plan[order_id]] = loads.get(plan[order_id], 0) + 1
+                adjust_active_orders(loads)
+            assigned.extend(claimable)
+
+    skipped = len(order_ids) - len(assigned)
+    if skipped:
+        logger.warning(f"{skipped} orders were already assigned to another courier")
+    logger.info(f"Assigned {len(assigned)} orders")
+    return assigned
+
+def _update_returning_ids(queryset, **values):
+    """queryset.update(**values) that returns the ids of the rows it changed.
+
+    Uses UPDATE ... RETURNING where the backend has it (PostgreSQL, SQLite);
+    elsewhere the ids are selected first and the rows must already be locked.
+    """
+    connection = connections[queryset.db]
+    if not connection.features.can_return_columns_from_insert:
+        ids = list(queryset.values_list('id', flat=True))
+        queryset.model.objects.filter(id__in=ids).update(**values)
+        return ids
+    query = queryset.query.chain(UpdateQuery)
+    query.add_update_values(values)
+    statement, params = query.get_compiler(queryset.db).as_sql()
+    column = connection.ops.quote_name(queryset.model._meta.pk.column)
+    with connection.cursor() as cursor:
+        cursor.execute(f'{statement} RETURNING {column}', params)
+        return [row[0] for row in cursor.fetchall()]
+
+def assign_orders(courier, orders):
+    """Give orders to a courier if they are still unassigned; returns the ids assigned"""
+    return save_assignments({order.id: courier.id for order in orders})
+
+def active_orders_by_courier(couriers):
+    """Map courier id -> list of its 'In Progress' orders, loaded with one query"""
+    current_orders = {courier.id: [] for courier in couriers}
+    for order in Order.objects.filter(courier_id__in=current_orders, status='In Progress'):
+        current_orders[order.courier_id].append(order)
+    return current_orders
+
+def stored_routes(courier_ids):
+    """Map courier id -> stored visiting order (order ids), loaded with one query"""
+    return dict(CourierRoute.objects.filter(courier_id__in=list(courier_ids)).values_list('courier_id', 'stops'))
+
+@dataclass
+class DispatchState:
+    """Claimed couriers with their orders in progress, loaded with a fixed number of queries.
+
+    Row i of the arrays describes couriers[i]: its id, its position (NaN
+    when unknown) and its load, the number of orders it has in progress.
+    active_orders and stored_routes are keyed by courier id.
+    """
+    couriers: list
+    courier_ids: np.ndarray
+    positions: np.ndarray
+    loads: np.ndarray
+    active_orders: dict
+    stored_routes: dict
+
+    @classmethod
+    def load(cls, couriers):
+        """State of the given couriers in two queries: their orders in progress and their stored routes"""
+        couriers = list(couriers)
+        active_orders = active_orders_by_courier(couriers)
+        positions = np.full((len(couriers), 2), np.nan)
+        for row, courier in enumerate(couriers):
+            if courier_location(courier):
+                positions[row] = float(courier.current_location_lat), float(courier.current_location_lon)
+        return cls(
+            couriers=couriers,
+            courier_ids=np.array([courier.id for courier in couriers], dtype=np.int64),
+            positions=positions,
+            loads=np.array([len(active_orders[courier.id]) for courier in couriers], dtype=np.int64),
+            active_orders=active_orders,
+            stored_routes=stored_routes(active_orders),
+        )
+
+    def __len__(self):
+        return len(self.couriers)
+
+    @property
+    def free_slots(self):
+        return MAX_ACTIVE_ORDERS - self.loads
+
+    @property
+    def located(self):
+        """Mask of the couriers whose position is known"""
+        return ~np.isnan(self.positions).any(axis=1)
+
+    def subset(self, rows):
+        """State of some of the couriers, without further queries"""
+        rows = np.asarray(rows, dtype=np.int64)
+        ids = set(self.courier_ids[rows].tolist())
+        return DispatchState(
+            couriers=[self.couriers[row] for row in rows],
+            courier_ids=self.courier_ids[rows],
+            positions=self.positions[rows],
+            loads=self.loads[rows],
+            active_orders={courier_id: self.active_orders[courier_id] for courier_id in ids},
+            stored_routes={courier_id: stops for courier_id, stops in self.stored_routes.items() if courier_id in ids},
+        )
+
+def leg_lengths(points):
+    """km of each leg of an open path through an (n, 2) array of coordinates, from the DISTANCE_PROVIDER"""
+    from .road_network import get_distance_provider
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(points) < 2:
+        return np.zeros(0)
+    provider = get_distance_provider()
+    if provider is not None:
+        return provider.path_lengths(points)
+    lat, lon = np.radians(points[:, 0]), np.radians(points[:, 1])
+    return _haversine(lat[:-1], lon[:-1], lat[1:], lon[1:])
+
+def route_stops(courier, orders):
+    """(order ids, stop coordinates) of a visiting order that starts at the courier's position"""
+    points = []
+    start = courier_location(courier)
+    if start:
+        points.append((start['lat'], start['lon']))
+    points.extend((float(order.lat), float(order.lon)) for order in orders if order.lat is not None and order.lon is not None)
+    return [order.id for order in orders], points
+
+def save_routes(routes):
+    """Upsert stored routes with their length and ETAs.
+
+    routes maps courier -> (order ids in visiting order, stop coordinates).
+    The coordinates start with the courier's position when it is known and
+    then follow the orders that have coordinates, which lead the id list;
+    orders without coordinates get no ETA.
+    """
+    entries = []
+    for courier, (stops, points) in routes.items():
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        offset = 1 if courier_location(courier) else 0
+        legs = leg_lengths(points)
+        # Minutes from now until the courier reaches each point
+        arrivals = np.concatenate([[0.0], np.cumsum(legs)]) * VehicleProfile.for_vehicle(courier.vehicle).minutes_per_km
+        etas = [round(float(minutes), 1) for minutes in arrivals[offset:len(points)]]
+        etas.extend([None] * (len(stops) - len(etas)))
+        entries.append(CourierRoute(
+            courier_id=courier.id,
+            stops=list(stops),
+            length_km=round(float(legs.sum()), 3),
+            duration_min=round(float(arrivals[-1]), 1) if len(points) else 0.0,
+            eta_minutes=etas,
+        ))
+    if not entries:
+        return
+    CourierRoute.objects.bulk_create(
+        entries,
+        update_conflicts=True,
+        unique_fields=['courier'],
+        update_fields=['stops', 'length_km', 'duration_min', 'eta_minutes', 'updated_at'],
+    )
+
+def _candidate_orders(order_index, courier, k):
+    """Ids of up to k unassigned orders worth offering to a courier, closest first"""
+    start = courier_location(courier)
+    if start is None:
+        # Without a known position every order is equally close
+        return order_index.first(k)
+    radius_km = getattr(settings, 'ORDER_CANDIDATE_RADIUS_KM', 15.0)
+    return order_index.nearest(start['lat'], start['lon'], k, radius_km)
+
+def _distribute_per_courier(state, unassigned_orders):
+    """Greedy mode: offer each courier its nearest unassigned orders and solve one TSP per courier"""
+    trace = current_trace()
+    with trace.phase('candidates'):
         # Group couriers by vehicle type
-        couriers_by_vehicle = {
-            'Автомобиль': [],
-            'Мотоцикл': [],
-            'Велосипед': []
-        }
-        
-        for courier in available_couriers:
-            couriers_by_vehicle[courier.vehicle].append(courier)
+        couriers_by_vehicle = {vehicle: [] for vehicle in VEHICLE_TYPES}
+        for courier, free_slots in zip(state.couriers, state.free_slots.tolist()):
+            couriers_by_vehicle[courier.vehicle].append((courier, free_slots))
 
-        # Process orders for each vehicle type
-        for vehicle_type, couriers in couriers_by_vehicle.items():
-            if not couriers:
-                continue
+        orders_by_id = {order.id: order for order in unassigned_orders}
+        order_index = build_order_index(unassigned_orders)
+        current_orders_by_courier = state.active_orders
+        routes_by_courier = state.stored_routes
+        plan = {}
 
-            # Get orders for this vehicle type
-            vehicle_orders = list(unassigned_orders)
-            
+        # Candidates are reserved courier by courier first, which is cheap and
+        # sequential; the routes are then independent and solved in parallel
+        subproblems = []
+        for vehicle_type, couriers in couriers_by_vehicle.items():
             # For each courier of this type
-            for courier in couriers:
-                if not vehicle_orders:
+            for courier, remaining_capacity in couriers:
+                if not len(order_index):
                     break
 
-                # Get current orders for this courier
-                current_orders = list(Order.objects.filter(
-                    courier=courier,
-                    status='In Progress'
-                ))
-
-                # Calculate remaining capacity
-                remaining_capacity = 5 - len(current_orders)
+                current_orders = current_orders_by_courier[courier.id]
                 if remaining_capacity <= 0:
                     continue
 
+                # Add the nearest unassigned orders if courier has capacity
+                new_orders = [orders_by_id[order_id] for order_id in _candidate_orders(order_index, courier, remaining_capacity)]
+                if not new_orders:
+                    continue
+                for order in new_orders:
+                    order_index.remove(order.id)
+
                 # Get locations for current orders and courier
                 locations = []
-                
+
                 # Add courier's current location as the starting point
-                if courier.current_location_lat is not None and courier.current_location_lon is not None:
-                    locations.append({
-                        'order_id': 'courier_start',
-                        'lat': float(courier.current_location_lat),
-                        'lon': float(courier.current_location_lon)
-                    })
-                    logger.info(f"Added courier {courier.id} current location to locations")
+                start = courier_location(courier)
+                if start:
+                    locations.append(start)
 
                 # Add current orders to locations
                 for order in current_orders:
-                    coords = geocode_address(order.address)
-                    if coords:
-                        lat, lon = coords
-                        locations.append({
-                            'order_id': order.id,
-                            'lat': lat,
-                            'lon': lon
-                        })
-                        logger.info(f"Added current order {order.id} to locations")
-
-                # Add new orders if courier has capacity
-                new_orders = vehicle_orders[:remaining_capacity]
-                
+                    location = order_location(order)
+                    if location:
+                        locations.append(location)
+
                 for order in new_orders:
-                    coords = geocode_address(order.address)
-                    if coords:
-                        lat, lon = coords
-                        locations.append({
-                            'order_id': order.id,
-                            'lat': lat,
-                            'lon': lon
-                        })
-                        logger.info(f"Added new order {order.id} to locations")
-
-                if len(locations) > 1:  # Need at least 2 locations for TSP
-                    try:
-                        distance_matrix = create_distance_matrix(locations)
-                        route = solve_tsp(distance_matrix)
-                        
-                        if route:
-                            # Assign new orders to courier
-                            for i in route:
-                                # Skip the first location if it's the courier's current location
-                                if i == 0 and locations[0]['order_id'] == 'courier_start':
-                                    continue
-                                    
-                                # Calculate the index for new orders
-                                new_order_index = i - (1 if locations[0]['order_id'] == 'courier_start' else 0) - len(current_orders)
-                                
-                                # Only process if this is a new order
-                                if new_order_index >= 0 and new_order_index < len(new_orders):
-                                    order = new_orders[new_order_index]
-                                    # Use transaction to ensure atomic update
-                                    with transaction.atomic():
-                                        # Try to update the order only if it's still unassigned
-                                        updated = Order.objects.filter(
-                                            id=order.id,
-                                            courier__isnull=True
-                                        ).update(
-                                            courier=courier,
-                                            status='In Progress'
-                                        )
-                                        if updated:
-                                            logger.info(f"Assigned order {order.id} to courier {courier.id}")
-                                            # Remove the assigned order from vehicle_orders
-                                            vehicle_orders.remove(order)
-                                        else:
-                                            logger.warning(f"Order {order.id} was already assigned to another courier")
-                    except Exception as e:
-                        logger.error(f"Error solving TSP for courier {courier.id}: {str(e)}")
-                        continue
-
-        return {"message": "Заказы успешно распределены"}
+                    locations.append(order_location(order))
+
+                subproblems.append((courier, locations, current_orders, new_orders))
+        trace.record('candidates', couriers=len(subproblems), orders=sum(len(sub[3]) for sub in subproblems))
+
+    solver_settings = SolverSettings.from_settings()
+    with trace.phase('matrix'):
+        matrices = []
+        initial_routes = []
+        for courier, locations, _, _ in subproblems:
+            # Routes are optimised for travel time of the courier's vehicle
+            matrices.append(create_distance_matrix(locations) * VehicleProfile.for_vehicle(courier.vehicle).minutes_per_km)
+            # The stored route of the current orders seeds the solver
+            nodes = {location['order_id']: node for node, location in enumerate(locations)}
+            stored = [nodes[order_id] for order_id in routes_by_courier.get(courier.id, []) if order_id in nodes]
+            initial_routes.append(stored or None)
+        trace.record('matrix', matrices=len(matrices), cells=sum(len(matrix) ** 2 for matrix in matrices))
+    with trace.phase('solve'):
+        routes = solve_tsps(matrices, solver_settings, initial_routes)
+
+    visits = {}
+    for (courier, locations, current_orders, new_orders), route in zip(subproblems, routes):
+        if not route:
+            logger.error(f"No route found for courier {courier.id}")
+            continue
+        orders_by_id = {order.id: order for order in [*current_orders, *new_orders]}
+        new_ids = {order.id for order in new_orders}
+        visits[courier] = []
+        for i in route:
+            order = orders_by_id.pop(locations[i]['order_id'], None)
+            if order is not None:
+                visits[courier].append(order)
+                if order.id in new_ids:
+                    plan[order.id] = courier.id
+        # Current orders without coordinates go last
+        visits[courier].extend(order for order in current_orders if order.id in orders_by_id)
+
+    with trace.phase('persist'):
+        assigned = save_assignments(plan)
+        _save_planned_routes(visits, plan, assigned)
+    return assigned
+
+def _save_planned_routes(visits, plan, assigned):
+    """Store the planned visiting order of each courier, without orders that could not be claimed"""
+    claimed = set(assigned)
+    current_trace().record('persist', planned=len(plan), assigned=len(assigned), routes=len(visits))
+    save_routes({
+        courier: route_stops(courier, [order for order in orders if order.id not in plan or order.id in claimed])
+        for courier, orders in visits.items()
+    })
+
+@dataclass
+class GlobalModel:
+    """The routing model of global mode: solve_vrp() arguments and the orders behind its nodes"""
+    couriers: list
+    current_orders: dict
+    pinned_orders: dict
+    new_orders: dict
+    problem: dict
+
+def _distribute_global(state, unassigned_orders):
+    """Global mode: one routing model with every available courier as a vehicle"""
+    model = _global_model(state, unassigned_orders)
+    if model is None:
+        return []
+    with current_trace().phase('solve'):
+        routes = solve_vrp(**model.problem)
+    return _save_global_plan(model, routes)
+
+def _global_model(state, unassigned_orders):
+    """Build the routing model of global mode; None when no order is near a courier"""
+    trace = current_trace()
+    couriers = state.couriers
+    current_orders = state.active_orders
+    free_slots = state.free_slots.tolist()
+
+    # Node 0 is the virtual depot; it has no place, so it only gets a zero row and column in the matrix
+    locations = [None]
+    vehicle_starts = []
+    capacities = []
+    pinned = {}
+    pinned_orders = {}
+    for vehicle, courier in enumerate(couriers):
+        start = courier_location(courier)
+        if start:
+            vehicle_starts.append(len(locations))
+            locations.append(start)
+        else:
+            vehicle_starts.append(0)
+
+        pinned_count = 0
+        for order in current_orders[courier.id]:
+            location = order_location(order)
+            if location:
+                pinned[len(locations)] = vehicle
+                pinned_orders[len(locations)] = order
+                locations.append(location)
+                pinned_count += 1
+        # Orders without coordinates still use capacity but are not routed
+        capacities.append(free_slots[vehicle] + pinned_count)
+
+    with trace.phase('candidates'):
+        # Only orders near some courier enter the model, which keeps it small and local
+        order_index = build_order_index(unassigned_orders)
+        per_slot = getattr(settings, 'ORDER_CANDIDATES_PER_SLOT', 3)
+        candidate_ids = set()
+        for courier, slots in zip(couriers, free_slots):
+            candidate_ids.update(_candidate_orders(order_index, courier, slots * per_slot))
+
+        new_orders = {}
+        for order in unassigned_orders:
+            if order.id in candidate_ids:
+                new_orders[len(locations)] = order
+                locations.append(order_location(order))
+        trace.record('candidates', couriers=len(couriers), orders=len(new_orders))
+
+    if not new_orders:
+        logger.info("No unassigned orders with coordinates")
+        return None
+
+    # Stored routes seed the search; new orders are optional, so leaving them out keeps it feasible
+    routes_by_courier = state.stored_routes
+    initial_routes = None
+    if routes_by_courier:
+        nodes = {order.id: node for node, order in pinned_orders.items()}
+        initial_routes = []
+        for vehicle, courier in enumerate(couriers):
+            stored = [nodes[order_id] for order_id in routes_by_courier.get(courier.id, []) if order_id in nodes]
+            stored.extend(node for node, owner in pinned.items() if owner == vehicle and node not in stored)
+            initial_routes.append(stored)
+
+    with trace.phase('matrix'):
+        # Each vehicle type is costed in its own travel time, so far orders go to faster vehicles
+        travel_times = TravelTimes(np.pad(create_distance_matrix(locations[1:], symmetric=True), ((1, 0), (1, 0))))
+        vehicle_matrices = [travel_times.for_vehicle(courier.vehicle) for courier in couriers]
+        trace.record('matrix', matrices=len(set(map(id, vehicle_matrices))), cells=len(locations) ** 2)
+    # When capacity runs short the orders closest to (or past) their due time stay in
+    now = timezone.now()
+    drop_weights = {node: 1.0 + urgency(order, now) for node, order in new_orders.items()}
+    return GlobalModel(couriers, current_orders, pinned_orders, new_orders, {
+        'distance_matrix': travel_times.distance_matrix,
+        'vehicle_starts': vehicle_starts,
+        'capacities': capacities,
+        'pinned': pinned,
+        'optional_nodes': list(new_orders),
+        'initial_routes': initial_routes,
+        'vehicle_matrices': vehicle_matrices,
+        'drop_weights': drop_weights,
+    })
+
+def _save_global_plan(model, routes):
+    """Assign the orders on the solved routes of a global model and store the routes; returns the ids assigned"""
+    if routes is None:
+        logger.error("Global routing model has no solution")
+        return []
+
+    trace = current_trace()
+    couriers, current_orders = model.couriers, model.current_orders
+    new_orders, pinned_orders = model.new_orders, model.pinned_orders
+    plan = {}
+    visits = {}
+    for courier, route in zip(couriers, routes):
+        visits[courier] = []
+        for node in route:
+            if node in new_orders:
+                plan[new_orders[node].id] = courier.id
+                visits[courier].append(new_orders[node])
+            elif node in pinned_orders:
+                visits[courier].append(pinned_orders[node])
+        # Current orders without coordinates go last
+        visits[courier].extend(order for order in current_orders[courier.id] if order.lat is None or order.lon is None)
+
+    with trace.phase('persist'):
+        assigned = save_assignments(plan)
+        _save_planned_routes(visits, plan, assigned)
+    return assigned
+
+def _distribute_clustered(state, unassigned_orders):
+    """Cluster mode: split a large backlog into areas, solve each as a global model, then repair the borders.
+
+    Orders are split by k-means into areas of about DISPATCH_CLUSTER_ORDERS
+    orders and every courier joins the area whose centre is nearest, so each
+    routing model stays small and the whole run grows linearly with the
+    backlog. The area models are solved as one batch, in parallel with
+    ORDER_SOLVER_PROCESSES > 1. Orders no area could serve are then offered
+    across area borders by cheapest insertion.
+    """
+    trace = current_trace()
+    located = [order for order in unassigned_orders if order.lat is not None and order.lon is not None]
+    positioned = np.flatnonzero(state.located)
+    k = min(ceil(len(located) / getattr(settings, 'DISPATCH_CLUSTER_ORDERS', 150)), len(positioned))
+    if k <= 1:
+        return _distribute_global(state, unassigned_orders)
+
+    with trace.phase('cluster'):
+        labels, centroids = kmeans([(float(order.lat), float(order.lon)) for order in located], k)
+        order_groups = [[] for _ in centroids]
+        for order, label in zip(located, labels):
+            order_groups[label].append(order)
+        courier_groups = [[] for _ in centroids]
+        for row, label in zip(positioned, haversine_matrix(state.positions[positioned], centroids).argmin(axis=1)):
+            courier_groups[label].append(row)
+        # Couriers without a position help where there are the most orders per courier
+        for row in np.flatnonzero(~state.located):
+            label = max(range(len(centroids)), key=lambda i: len(order_groups[i]) / (len(courier_groups[i]) + 1))
+            courier_groups[label].append(row)
+        trace.record('cluster', clusters=len(centroids), largest=max(map(len, order_groups)),
+                     without_couriers=sum(1 for group in courier_groups if not group))
+
+    # The areas are independent, so their models are solved together, in the solver pool when there is one
+    models = [
+        _global_model(state.subset(rows), group_orders)
+        for rows, group_orders in zip(courier_groups, order_groups) if rows and group_orders
+    ]
+    models = [model for model in models if model is not None]
+    with trace.phase('solve'):
+        solved = solve_vrps([model.problem for model in models], SolverSettings.from_settings())
+    assigned = []
+    for model, routes in zip(models, solved):
+        assigned.extend(_save_global_plan(model, routes))
+
+    taken = set(assigned)
+    leftover = [order for order in located if order.id not in taken]
+    if leftover:
+        with trace.phase('repair'):
+            assigned.extend(_repair_boundaries(state.couriers, leftover))
+    return assigned
+
+def _repair_boundaries(couriers, orders):
+    """Give orders with coordinates to couriers with free capacity by cheapest insertion into their routes"""
+    routes, loads, sequences = courier_routes(couriers)
+    order_index = build_order_index(orders)
+    points_by_id = {order.id: (float(order.lat), float(order.lon)) for order in orders}
+    per_slot = getattr(settings, 'ORDER_CANDIDATES_PER_SLOT', 3)
+    plan = {}
+    planned = {}
+    for courier in couriers:
+        if not len(order_index):
+            break
+        free_slots = MAX_ACTIVE_ORDERS - loads[courier.id]
+        if free_slots <= 0 or len(routes[courier.id]) == 0:
+            continue
+        candidates = _candidate_orders(order_index, courier, free_slots * per_slot)
+        if not candidates:
+            continue
+        offset = 1 if courier_location(courier) else 0
+        chosen, route = _insert_cheapest(
+            routes[courier.id], sequences[courier.id], offset,
+            np.array(candidates), np.array([points_by_id[order_id] for order_id in candidates]), free_slots
+        )
+        for order_id in chosen:
+            plan[order_id] = courier.id
+            order_index.remove(order_id)
+        planned[courier] = (sequences[courier.id], route, offset)
+
+    assigned = save_assignments(plan)
+    lost = set(plan) - set(assigned)
+    save_routes({
+        courier: _without_orders(sequence, route, offset, lost)
+        for courier, (sequence, route, offset) in planned.items()
+    })
+    current_trace().record('repair', orders=len(orders), assigned=len(assigned), routes=len(planned))
+    return assigned
+
+DISTRIBUTION_PHASES = ('geocoding', 'couriers', 'orders', 'cluster', 'candidates', 'matrix', 'solve', 'repair', 'persist')
+
+@dataclass(frozen=True)
+class DispatchPartition:
+    """A slice of the dispatch problem one worker can claim: a vehicle type or a zone.
+
+    bbox is (min_lat, min_lon, max_lat, max_lon). Couriers belong to a zone
+    by their current position and orders by their coordinates, so couriers
+    without a position and orders without coordinates are left to vehicle
+    partitions and plain distribute_orders() runs. A vehicle partition only
+    claims orders within ORDER_CANDIDATE_RADIUS_KM of its couriers' bounding
+    box, so it does not lock orders none of its couriers could take; vehicle
+    partitions in the same area still compete for orders, zones do not.
+    """
+    name: str
+    vehicle: str = None
+    bbox: tuple = None
+
+    def courier_filter(self):
+        if self.vehicle:
+            return Q(vehicle=self.vehicle)
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        return Q(
+            current_location_lat__gte=min_lat, current_location_lat__lte=max_lat,
+            current_location_lon__gte=min_lon, current_location_lon__lte=max_lon
+        )
+
+    def order_filter(self, positions=None):
+        """Orders of the partition; positions, an (n, 2) array of its claimed couriers, bound a vehicle partition"""
+        if self.vehicle:
+            return Q() if positions is None else reach_filter(positions)
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        return Q(lat__gte=min_lat, lat__lte=max_lat, lon__gte=min_lon, lon__lte=max_lon)
+
+def reach_filter(positions):
+    """Orders within ORDER_CANDIDATE_RADIUS_KM of the bounding box of the known positions, plus unlocated ones.
+
+    Q() when no position is known: couriers without one may start anywhere.
+    """
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    positions = positions[~np.isnan(positions).any(axis=1)]
+    if not len(positions):
+        return Q()
+    radius_km = getattr(settings, 'ORDER_CANDIDATE_RADIUS_KM', 15.0)
+    (min_lat, min_lon), (max_lat, max_lon) = positions.min(axis=0).tolist(), positions.max(axis=0).tolist()
+    lat_margin = radius_km / KM_PER_DEGREE
+    lon_margin = radius_km / (KM_PER_DEGREE * max(cos(radians(max(abs(min_lat), abs(max_lat)))), 0.01))
+    return Q(lat__isnull=True) | Q(
+        lat__gte=min_lat - lat_margin, lat__lte=max_lat + lat_margin,
+        lon__gte=min_lon - lon_margin, lon__lte=max_lon + lon_margin
+    )
+
+def dispatch_partitions():
+    """Partitions configured by DISPATCH_PARTITION_BY ('vehicle' or 'zone' with DISPATCH_ZONES)"""
+    if getattr(settings, 'DISPATCH_PARTITION_BY', 'vehicle') == 'zone':
+        return [
+            DispatchPartition(name, bbox=tuple(bbox))
+            for name, bbox in getattr(settings, 'DISPATCH_ZONES', {}).items()
+        ]
+    return [DispatchPartition(vehicle, vehicle=vehicle) for vehicle in VEHICLE_TYPES]
+
+def claim_couriers(partition=None, courier_ids=None):
+    """Lock available couriers no other dispatcher holds (FOR UPDATE SKIP LOCKED)"""
+    couriers = available_couriers_queryset().select_for_update(skip_locked=True)
+    if partition is not None:
+        couriers = couriers.filter(partition.courier_filter())
+    if courier_ids is not None:
+        couriers = couriers.filter(id__in=courier_ids)
+    return list(couriers.order_by('id'))
+
+def claim_orders(partition=None, order_ids=None, positions=None):
+    """Lock up to DISPATCH_ORDER_BATCH_SIZE unassigned orders no other dispatcher holds, most urgent first.
+
+    positions are those of the claimed couriers, which bound a vehicle partition.
+    """
+    orders = Order.objects.select_for_update(skip_locked=True).filter(courier__isnull=True)
+    if partition is not None:
+        orders = orders.filter(partition.order_filter(positions))
+    if order_ids is not None:
+        orders = orders.filter(id__in=order_ids)
+    return OrderQueue(orders).take(getattr(settings, 'DISPATCH_ORDER_BATCH_SIZE', None) or None)
+
+def distribute_orders(mode=None, progress=None, partition=None, profile=None, order_ids=None, dry_run=False,
+                      courier_ids=None):
+    """Assign unassigned orders to available couriers.
+
+    Couriers and orders are claimed with SELECT ... FOR UPDATE SKIP LOCKED
+    and held until the plan is saved, so concurrent runs work on disjoint
+    sets; with a partition a run only takes that vehicle type or zone, and
+    with order_ids only those orders (e.g. one batch of new orders) and with
+    courier_ids only those couriers.
+    progress, if given, is called with the name of each phase from
+    DISTRIBUTION_PHASES as it starts. profile ('cpu' or 'memory', default
+    DISPATCH_PROFILE) captures a cProfile or tracemalloc report of the run.
+    The result carries a message, the number of orders assigned, the wall
+    time of each phase in seconds and the id of the DispatchRun record.
+    With dry_run everything from the couriers phase on is rolled back and
+    the result carries the plan it would have saved (see proposed_plan())
+    for apply_plan(); coordinates found by the geocoding phase are kept.
+    """
+    mode = mode or getattr(settings, 'ORDER_DISTRIBUTION_MODE', 'per_courier')
+    if mode not in DISTRIBUTION_MODES:
+        return {"message": f"Неизвестный режим распределения: {mode}", "error": f"Unknown mode {mode}"}
+    profile = profile or getattr(settings, 'DISPATCH_PROFILE', None)
+    if profile and profile not in PROFILE_MODES:
+        return {"message": f"Неизвестный режим профилирования: {profile}", "error": f"Unknown profile {profile}"}
+
+    trace = DispatchTrace(progress, profile)
+    distances_before = distance_cache.cache_stats()
+    with trace.run():
+        result = _distribute(mode, partition, trace, order_ids, dry_run, courier_ids)
+    if distance_cache.cache_enabled():
+        trace.record('matrix', **distance_cache.cache_usage(distances_before, distance_cache.cache_stats()))
+        distance_cache.persist_caches()
+    result['phase_timings'] = trace.timings
+    result['run_id'] = _record_run(trace, mode, partition, result, dry_run)
+    return result
+
+def _distribute(mode, partition, trace, order_ids=None, dry_run=False, courier_ids=None):
+    try:
+        # Get all available couriers (those with less than 5 active orders)
+        available_couriers = available_couriers_queryset()
+        if partition is not None:
+            available_couriers = available_couriers.filter(partition.courier_filter())
+        if courier_ids is not None:
+            available_couriers = available_couriers.filter(id__in=courier_ids)
+        if not available_couriers.exists():
+            logger.info("No available couriers found")
+            return {"message": "Нет свободных курьеров", "assigned": 0}
+
+        with trace.phase('geocoding'):
+            # Coordinates are normally filled in at order creation; catch up on the
+            # stragglers before anything is locked so no row is held over network I/O
+            cache_before = get_cache_stats()
+            pending = Order.objects.filter(courier__isnull=True, geocode_status='pending')
+            if order_ids is not None:
+                pending = pending.filter(id__in=order_ids)
+            geocode_pending_orders(pending)
+            geocode_pending_orders(Order.objects.filter(
+                courier_id__in=available_couriers.values('id'),
+                status='In Progress',
+                geocode_status='pending'
+            ))
+            trace.record('geocoding', **_cache_usage(cache_before, get_cache_stats()))
+
+        with transaction.atomic():
+            with trace.phase('couriers'):
+                couriers = claim_couriers(partition, courier_ids)
+                trace.record('couriers', claimed=len(couriers))
+                if couriers:
+                    # Everything the solvers need about the couriers, in a fixed number of queries
+                    state = DispatchState.load(couriers)
+
+            if not couriers:
+                logger.info("All available couriers are being dispatched by other workers")
+                return {"message": "Нет свободных курьеров", "assigned": 0}
+
+            with trace.phase('orders'):
+                unassigned_orders = claim_orders(partition, order_ids, state.positions)
+                trace.record('orders', claimed=len(unassigned_orders))
+
+            if not unassigned_orders:
+                logger.info("No unassigned orders found")
+                return {"message": "Нет нераспределенных заказов", "assigned": 0}
+
+            _record_snapshot(trace, state, unassigned_orders, mode, partition)
+
+            if mode == 'global':
+                assigned = _distribute_global(state, unassigned_orders)
+            elif mode == 'cluster':
+                assigned = _distribute_clustered(state, unassigned_orders)
+            else:
+                assigned = _distribute_per_courier(state, unassigned_orders)
+
+            if dry_run:
+                # The run wrote as usual; only the plan leaves the rolled-back transaction
+                plan = proposed_plan(state, assigned)
+                transaction.set_rollback(True)
+                return {
+                    "message": "План распределения рассчитан, заказы не назначены",
+                    "assigned": len(assigned),
+                    "plan": plan,
+                }
+
+        return {
+            "message": "Заказы успешно распределены",
+            "assigned": len(assigned),
+        }
     except Exception as e:
         logger.error(f"Error in distribute_orders: {str(e)}")
-        return {"message": f"Ошибка при распределении заказов: {str(e)}"}
\ No newline at end of file
+        return {
+            "message": f"Ошибка при распределении заказов: {str(e)}",
+            "error": str(e),
+        }
+
+def proposed_plan(state, assigned):
+    """What a run wrote for its assigned orders, in a form apply_plan() can replay without solving again.
+
+    assignments maps order id -> courier id, routes holds the stored route
+    of every courier that gets orders and snapshot the orders each of those
+    couriers had in progress when the plan was made. Keys are strings, as
+    the plan is stored as JSON.
+    """
+    assignments = dict(Order.objects.filter(id__in=assigned).values_list('id', 'courier_id'))
+    couriers = sorted(set(assignments.values()))
+    routes = CourierRoute.objects.filter(courier_id__in=couriers).order_by('courier_id').values(
+        'courier_id', 'stops', 'length_km', 'duration_min', 'eta_minutes'
+    )
+    return {
+        'assignments': {str(order_id): courier_id for order_id, courier_id in sorted(assignments.items())},
+        'routes': [
+            {'courier': route.pop('courier_id'), **route}
+            for route in routes
+        ],
+        'snapshot': {
+            str(courier_id): sorted(order.id for order in state.active_orders[courier_id])
+            for courier_id in couriers
+        },
+    }
+
+def apply_plan(plan):
+    """Save a plan from a dry run exactly as it was proposed.
+
+    Nothing is written unless every courier in the plan still has the
+    orders in progress it had then and every order is still unassigned.
+    Returns a result like distribute_orders().
+    """
+    assignments = {int(order_id): courier_id for order_id, courier_id in plan['assignments'].items()}
+    snapshot = {int(courier_id): order_ids for courier_id, order_ids in plan['snapshot'].items()}
+    stale = {"message": "План устарел: курьеры или заказы изменились, рассчитайте его заново", "error": "Stale plan"}
+    with transaction.atomic():
+        couriers = list(Courier.objects.select_for_update().filter(id__in=list(snapshot)).order_by('id'))
+        current = active_orders_by_courier(couriers)
+        if len(couriers) != len(snapshot) or any(
+                sorted(order.id for order in current[courier_id]) != order_ids
+                for courier_id, order_ids in snapshot.items()):
+            return stale
+        assigned = save_assignments(assignments)
+        if len(assigned) != len(assignments):
+            transaction.set_rollback(True)
+            return stale
+        CourierRoute.objects.bulk_create(
+            [
+                CourierRoute(courier_id=route['courier'], stops=route['stops'], length_km=route['length_km'],
+                             duration_min=route['duration_min'], eta_minutes=route['eta_minutes'])
+                for route in plan['routes']
+            ],
+            update_conflicts=True,
+            unique_fields=['courier'],
+            update_fields=['stops', 'length_km', 'duration_min', 'eta_minutes', 'updated_at'],
+        )
+    logger.info(f"Applied a dispatch plan of {len(assigned)} orders")
+    return {"message": "План распределения применён", "assigned": len(assigned)}
+
+def _cache_usage(before, after):
+    """Geocode cache lookups between two get_cache_stats() snapshots"""
+    delta = {name: after[name] - before[name] for name in after}
+    hits = delta['memory_hits'] + delta['db_hits']
+    lookups = hits + delta['misses']
+    return {
+        'lookups': lookups,
+        'cache_hits': hits,
+        'cache_misses': delta['misses'],
+        'errors': delta['errors'],
+        'hit_ratio': round(hits / lookups, 4) if lookups else None,
+    }
+
+def _record_snapshot(trace, state, orders, mode, partition):
+    """Write the claimed inputs of the run to DISPATCH_SNAPSHOT_DIR, if set, for manage.py replay_dispatch"""
+    from .dispatch_snapshot import record_snapshot, snapshot_dir
+
+    if not snapshot_dir():
+        return
+    try:
+        path = record_snapshot(state, orders, mode, partition)
+    except Exception as e:
+        logger.error(f"Error writing dispatch snapshot: {str(e)}")
+        return
+    trace.record('orders', snapshot=path)
+
+def _record_run(trace, mode, partition, result, dry_run=False):
+    """Feed the dispatch histograms, log a one-line summary and store a DispatchRun; returns its id"""
+    assigned = result.get('assigned', 0)
+    observe_run(trace, mode, assigned)
+    phases = ', '.join(f"{phase} {seconds:.3f}s" for phase, seconds in trace.timings.items())
+    logger.info(
+        f"Dispatch {'dry run' if dry_run else 'run'} ({mode}{f', {partition.name}' if partition else ''}): "
+        f"{assigned} assigned in {trace.duration:.3f}s [{phases}]",
+        extra={'dispatch_run': trace.summary()}
+    )
+    try:
+        run = DispatchRun.objects.create(
+            mode=mode,
+            dry_run=dry_run,
+            partition=partition.name if partition else '',
+            duration_s=trace.duration,
+            assigned_count=assigned,
+            error=result.get('error', ''),
+            phase_timings=trace.timings,
+            stats=trace.summary()['attributes'],
+            profile_mode=trace.profile_mode or '',
+            profile=trace.profile,
+        )
+    except Exception as e:
+        logger.error(f"Error saving dispatch run summary: {str(e)}")
+        return None
+    return run.id
+
+def available_couriers_queryset():
+    """Couriers with fewer than MAX_ACTIVE_ORDERS orders in progress, by the indexed Courier.active_orders counter"""
+    return Courier.objects.filter(active_orders__lt=MAX_ACTIVE_ORDERS)
+
+def courier_routes(couriers):
+    """Current stops of each courier as (n, 2) coordinate arrays: position first, then active orders.
+
+    Orders follow the courier's stored route. Returns ({courier_id: stops},
+    {courier_id: active order count}, {courier_id: active order ids}) with
+    one query for the routes and one for all orders; the ids list the
+    orders with coordinates in stop order, then the ones without.
+    """
+    couriers = list(couriers)
+    stops = {}
+    for courier in couriers:
+        start = courier_location(courier)
+        stops[courier.id] = [(start['lat'], start['lon'])] if start else []
+    stored = stored_routes(stops)
+    active = {courier_id: [] for courier_id in stops}
+    for order_id, courier_id, lat, lon in Order.objects.filter(
+        courier_id__in=list(stops),
+        status='In Progress'
+    ).order_by('id').values_list('id', 'courier_id', 'lat', 'lon'):
+        active[courier_id].append((order_id, lat, lon))
+
+    loads = {}
+    sequences = {}
+    for courier_id, orders in active.items():
+        position = {order_id: i for i, order_id in enumerate(stored.get(courier_id, []))}
+        orders.sort(key=lambda order: position.get(order[0], len(position)))
+        located = [order for order in orders if order[1] is not None and order[2] is not None]
+        stops[courier_id].extend((float(lat), float(lon)) for _, lat, lon in located)
+        loads[courier_id] = len(orders)
+        sequences[courier_id] = [order_id for order_id, _, _ in located]
+        sequences[courier_id].extend(order_id for order_id, lat, lon in orders if lat is None or lon is None)
+    routes = {courier_id: np.array(route, dtype=np.float64).reshape(-1, 2) for courier_id, route in stops.items()}
+    return routes, loads, sequences
+
+def cheapest_insertion(route, points):
+    """Extra km and position of the cheapest insertion of each point into an open route.
+
+    route is an (m, 2) array of stops, points an (n, 2) array. A point can go
+    between two consecutive stops or after the last one; returns two arrays
+    of length n (cost, index the point would take in the route).
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(route) == 0:
+        return np.full(len(points), np.inf), np.zeros(len(points), dtype=np.int64)
+    to_stops = haversine_matrix(points, route)
+    # Appending after the last stop
+    costs = [to_stops[:, -1:]]
+    if len(route) > 1:
+        lat, lon = np.radians(route[:, 0]), np.radians(route[:, 1])
+        legs = _haversine(lat[:-1], lon[:-1], lat[1:], lon[1:])
+        costs.insert(0, to_stops[:, :-1] + to_stops[:, 1:] - legs[None, :])
+    costs = np.concatenate(costs, axis=1)
+    positions = np.argmin(costs, axis=1)
+    return costs[np.arange(len(points)), positions], positions + 1
+
+def _insert_cheapest(route, sequence, offset, ids, points, slots):
+    """Insert up to slots of the points into an open route one by one, cheapest first.
+
+    ids and points are arrays of the candidate orders; sequence, the order
+    ids of the route after its offset leading stops, is updated in place.
+    Returns the chosen ids and the new route.
+    """
+    chosen = []
+    for _ in range(min(slots, len(ids))):
+        costs, positions = cheapest_insertion(route, points)
+        best = int(np.argmin(costs))
+        chosen.append(int(ids[best]))
+        sequence.insert(int(positions[best]) - offset, int(ids[best]))
+        route = np.insert(route, positions[best], points[best], axis=0)
+        ids, points = np.delete(ids, best), np.delete(points, best, axis=0)
+    return chosen, route
+
+def _without_orders(sequence, route, offset, order_ids):
+    """(sequence, stops) of a route with some of its located orders taken out"""
+    if not order_ids:
+        return sequence, route
+    stops = [stop for order_id, stop in zip(sequence, route[offset:]) if order_id not in order_ids]
+    return [order_id for order_id in sequence if order_id not in order_ids], [*route[:offset], *stops]
+
+def dispatch_order(order, requeue=True):
+    """Incremental mode: insert one new order into the cheapest existing courier route.
+
+    Costs O(couriers x route length); returns the courier that got the order or None.
+    When a batch run holds the chosen courier the order is retried once on the
+    'distribution' queue (with requeue) instead of waiting for the lock.
+    """
+    if order.courier_id is not None or order.lat is None or order.lon is None:
+        return None
+
+    couriers = {courier.id: courier for courier in available_couriers_queryset()}
+    if not couriers:
+        return None
+    routes, loads, sequences = courier_routes(couriers.values())
+    point = [(float(order.lat), float(order.lon))]
+    radius_km = getattr(settings, 'ORDER_CANDIDATE_RADIUS_KM', 15.0)
+
+    best_courier, best_cost, best_position = None, np.inf, 0
+    for courier_id, route in routes.items():
+        if loads[courier_id] >= MAX_ACTIVE_ORDERS or len(route) == 0:
+            continue
+        # Couriers with no stop near the order are not worth asking
+        if haversine_matrix(point, route).min() > radius_km:
+            continue
+        cost, position = cheapest_insertion(route, point)
+        # Extra travel time, so a faster vehicle wins over a slightly closer slow one
+        minutes = cost[0] * VehicleProfile.for_vehicle(couriers[courier_id].vehicle).minutes_per_km
+        if minutes < best_cost:
+            best_courier, best_cost, best_position = couriers[courier_id], minutes, int(position[0])
+
+    if best_courier is None:
+        logger.info(f"Order {order.id} left for the next batch distribution")
+        return None
+
+    with transaction.atomic():
+        courier = lock_courier(best_courier.id)
+        if courier is None:
+            if requeue:
+                logger.info(f"Courier {best_courier.id} is being dispatched, order {order.id} requeued")
+                run_in_background(dispatch_order_task, order.id, queue='distribution')
+            else:
+                logger.info(f"Courier {best_courier.id} is being dispatched, order {order.id} left for the next batch distribution")
+            return None
+        # Another dispatch may have filled the courier since its load was read
+        if courier.active_orders >= MAX_ACTIVE_ORDERS:
+            logger.info(f"Courier {best_courier.id} is full, order {order.id} left for the next batch distribution")
+            return None
+        routes, _, sequences = courier_routes([courier])
+        route = routes[courier.id]
+        if len(route) == 0:
+            return None
+        _, position = cheapest_insertion(route, point)
+        if not assign_orders(courier, [order]):
+            logger.info(f"Order {order.id} left for the next batch distribution")
+            return None
+        logger.info(f"Order {order.id} inserted into the route of courier {courier.id} (+{best_cost:.1f} min)")
+
+        best_position = int(position[0])
+        route = np.insert(route, best_position, point[0], axis=0)
+        sequence = sequences[courier.id]
+        # Stop positions count the courier's own position, order ids do not
+        sequence.insert(best_position - (1 if courier_location(courier) else 0), order.id)
+        save_routes({courier: (sequence, route)})
+    return courier
+
+def lock_courier(courier_id):
+    """Lock a courier until the transaction ends (FOR UPDATE SKIP LOCKED); None when another dispatch holds it or it is gone.
+
+    Incremental dispatch runs on the background queue that also geocodes, so
+    it never waits for a batch run's locks.
+    """
+    return Courier.objects.select_for_update(skip_locked=True).filter(pk=courier_id).first()
+
+def dispatch_to_courier(courier, requeue=True):
+    """Incremental mode: fill a courier's free capacity from the most urgent nearby orders, cheapest insertion first.
+
+    Returns the ids assigned, or None when a batch run holds the courier; the
+    courier is then retried once on the 'distribution' queue (with requeue).
+    """
+    with transaction.atomic():
+        # Locked so concurrent dispatches cannot push the courier past MAX_ACTIVE_ORDERS
+        locked = lock_courier(courier.id)
+        if locked is None:
+            if requeue:
+                logger.info(f"Courier {courier.id} is being dispatched, requeued")
+                run_in_background(courier_freed_task, courier.id, False, queue='distribution')
+            return None
+        return _fill_courier(locked)
+
+def _fill_courier(courier):
+    routes, _, sequences = courier_routes([courier])
+    route = routes[courier.id]
+    sequence = sequences[courier.id]
+    offset = 1 if courier_location(courier) else 0
+    free_slots = MAX_ACTIVE_ORDERS - courier.active_orders
+    if free_slots <= 0 or len(route) == 0:
+        return []
+
+    # The most urgent orders near the route, read window by window until there are enough
+    radius_km = getattr(settings, 'ORDER_CANDIDATE_RADIUS_KM', 15.0)
+    wanted = free_slots * getattr(settings, 'ORDER_CANDIDATES_PER_SLOT', 3)
+    queue = OrderQueue(Order.objects.filter(
+        courier__isnull=True,
+        lat__isnull=False,
+        lon__isnull=False
+    ).only('id', 'lat', 'lon', 'created_at', 'deliver_by'))
+    ids, points = [], []
+    for window in queue.windows():
+        window_points = np.array([(float(order.lat), float(order.lon)) for order in window])
+        near = haversine_matrix(window_points, route).min(axis=1) <= radius_km
+        ids.extend(order.id for order, is_near in zip(window, near) if is_near)
+        points.extend(window_points[near])
+        if len(ids) >= wanted:
+            break
+    if not ids:
+        return []
+    ids, points = np.array(ids[:wanted]), np.array(points[:wanted])
+
+    chosen, route = _insert_cheapest(route, sequence, offset, ids, points, free_slots)
+    orders = Order.objects.in_bulk(chosen)
+    assigned = assign_orders(courier, [orders[order_id] for order_id in chosen])
+    if assigned:
+        save_routes({courier: _without_orders(sequence, route, offset, set(chosen) - set(assigned))})
+    return assigned
+
+def incremental_dispatch_enabled():
+    return getattr(settings, 'ORDER_INCREMENTAL_DISPATCH', False)
+
+def order_created_task(order_id):
+    """Background task for a new order: geocode it and, in incremental mode, assign it.
+
+    With ORDER_BATCH_DISPATCH the order waits for its batch; it is inserted on
+    its own only when the batch backlog is full.
+    """
+    order = Order.objects.filter(pk=order_id).first()
+    if order is None:
+        return
+    if order.geocode_status == 'pending':
+        geocode_order(order)
+    if not incremental_dispatch_enabled():
+        return
+    if batching_enabled():
+        if enqueue_order(order.id):
+            return
+        logger.warning(f"Batch dispatch backlog is full, inserting order {order.id} on its own")
+    dispatch_order(order)
+
+def dispatch_order_task(order_id):
+    """Background retry of dispatch_order() for an order whose courier was held by a batch run"""
+    order = Order.objects.filter(pk=order_id).first()
+    if order is not None:
+        dispatch_order(order, requeue=False)
+
+def refresh_route(courier):
+    """Drop orders that are no longer in progress from a courier's stored route"""
+    routes, _, sequences = courier_routes([courier])
+    save_routes({courier: (sequences[courier.id], routes[courier.id])})
+
+def courier_freed_task(courier_id, requeue=True):
+    """Background task for a courier whose order left 'In Progress'"""
+    courier = Courier.objects.filter(pk=courier_id).first()
+    if courier is None:
+        return
+    if incremental_dispatch_enabled():
+        assigned = dispatch_to_courier(courier, requeue)
+        # None: the batch run holding the courier stores its route
+        if assigned is None or assigned:
+            return
+    refresh_route(courier)
@@ -0,0 +1,73 @@
+"""Unassigned orders in the order they should be served.
+
+An order is due at its deliver_by time or, without one, ORDER_SLA_MINUTES
+after it was created. The queue serves the earliest due order first, so old
+orders move to the front instead of starving behind new ones. It reads the
+database in keyset windows of ORDER_QUEUE_WINDOW rows, so memory stays flat
+however large the backlog grows.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import DateTimeField, ExpressionWrapper, F, Q
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+
+def order_sla():
+    return timedelta(minutes=getattr(settings, 'ORDER_SLA_MINUTES', 60))
+
+
+def due_expression():
+    """When an order is due, as a database expression"""
+    return Coalesce(
+        'deliver_by',
+        ExpressionWrapper(F('created_at') + order_sla(), output_field=DateTimeField()),
+        output_field=DateTimeField()
+    )
+
+
+def urgency(order, now=None):
+    """0 for an order just created, 1 once it is due, growing while it is overdue"""
+    sla = order_sla()
+    due = order.deliver_by or order.created_at + sla
+    remaining = due - (now or timezone.now())
+    return max(0.0, 1.0 - remaining / sla)
+
+
+class OrderQueue:
+    """Iterates a queryset of orders by due time, then id, in windows of bounded size.
+
+    Each window is one query that continues after the last (due, id) seen,
+    so a select_for_update() queryset locks the rows window by window.
+    """
+
+    def __init__(self, queryset, window=None):
+        self.queryset = queryset.annotate(due=due_expression())
+        self.window = window or getattr(settings, 'ORDER_QUEUE_WINDOW', 500)
+
+    def windows(self, limit=None):
+        """Lists of up to window orders from the front of the queue, at most limit orders in all"""
+        last = None
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = self.window if remaining is None else min(self.window, remaining)
+            page = self.queryset
+            if last is not None:
+                page = page.filter(Q(due__gt=last.due) | Q(due=last.due, id__gt=last.id))
+            rows = list(page.order_by('due', 'id')[:size])
+            if rows:
+                yield rows
+            if len(rows) < size:
+                return
+            last = rows[-1]
+            if remaining is not None:
+                remaining -= len(rows)
+
+    def __iter__(self):
+        for rows in self.windows():
+            yield from rows
+
+    def take(self, limit=None):
+        """Up to limit orders from the front of the queue"""
+        return [order for rows in self.windows(limit) for order in rows]
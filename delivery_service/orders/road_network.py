@@ -0,0 +1,401 @@
+"""Offline road-network distances from a local OSM extract.
+
+The road graph is kept as compressed sparse rows (CSR): indptr, indices and
+weights arrays, one row of outgoing edges per node, weights in km. Points
+are snapped to their nearest graph node and distance matrices come from
+one early-stopping Dijkstra per distinct source node. Parsing the extract
+is the slow part, so the parsed graph is cached to disk as .npz next to it.
+
+Select it with DISTANCE_PROVIDER = 'road_network' and
+ROAD_NETWORK = {'path': ...}; create_distance_matrix() then returns road
+distances instead of straight-line ones.
+"""
+import hashlib
+import heapq
+import json
+import logging
+import os
+import threading
+from math import cos, inf, radians
+
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .distance_cache import CachedDistances, cache_enabled, get_distance_cache
+from .order_distribution import KM_PER_DEGREE, _haversine, haversine_matrix
+
+logger = logging.getLogger(__name__)
+
+CACHE_FORMAT_VERSION = 1
+SNAP_CELL_KM = 0.25
+ONEWAY_FORWARD = ('yes', 'true', '1')
+ONEWAY_REVERSE = ('-1', 'reverse')
+
+
+def _segment_lengths(src_coords, dst_coords):
+    """Great-circle km between matching rows of two (n, 2) arrays of (lat, lon) degrees"""
+    src, dst = np.radians(src_coords), np.radians(dst_coords)
+    return _haversine(src[:, 0], src[:, 1], dst[:, 0], dst[:, 1])
+
+
+def _oneway(value):
+    """1 for a forward one-way way, -1 for a reversed one, 0 for two-way"""
+    value = str(value).lower() if value is not None else ''
+    if value in ONEWAY_FORWARD:
+        return 1
+    if value in ONEWAY_REVERSE:
+        return -1
+    return 0
+
+
+class _GraphBuilder:
+    """Collects ways as coordinate lists and merges vertices shared between them"""
+
+    def __init__(self):
+        self.nodes = {}
+        self.coords = []
+        self.src = []
+        self.dst = []
+
+    def node(self, lat, lon):
+        key = (round(lat, 7), round(lon, 7))
+        node = self.nodes.get(key)
+        if node is None:
+            node = self.nodes[key] = len(self.coords)
+            self.coords.append(key)
+        return node
+
+    def add_way(self, points, oneway=0):
+        nodes = [self.node(lat, lon) for lat, lon in points]
+        for a, b in zip(nodes, nodes[1:]):
+            if a == b:
+                continue
+            if oneway >= 0:
+                self.src.append(a)
+                self.dst.append(b)
+            if oneway <= 0:
+                self.src.append(b)
+                self.dst.append(a)
+
+    def build(self, **options):
+        coords = np.array(self.coords, dtype=np.float64).reshape(-1, 2)
+        src = np.array(self.src, dtype=np.int64)
+        dst = np.array(self.dst, dtype=np.int64)
+        weights = _segment_lengths(coords[src], coords[dst]) if len(src) else np.zeros(0)
+        return RoadNetwork.from_edges(coords, src, dst, weights, **options)
+
+
+class RoadNetwork:
+    """Directed road graph in CSR form with nearest-node snapping and shortest-path matrices"""
+
+    def __init__(self, coords, indptr, indices, weights, snap_radius_km=0.5):
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.snap_radius_km = snap_radius_km
+        self.fingerprint = None  # identifies the extract, e.g. for the distance cache
+        self._adjacency = None
+        self._reverse_adjacency = None
+        self._build_snap_index()
+
+    @classmethod
+    def from_edges(cls, coords, src, dst, weights, **options):
+        """Build the CSR arrays from parallel edge arrays (source node, target node, km)"""
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        order = np.argsort(src, kind='stable')
+        counts = np.bincount(np.asarray(src, dtype=np.int64)[order], minlength=len(coords))
+        indptr = np.concatenate([[0], np.cumsum(counts)])
+        return cls(coords, indptr, np.asarray(dst)[order], np.asarray(weights)[order], **options)
+
+    @classmethod
+    def from_geojson(cls, path, **options):
+        """Read LineString / MultiLineString features; a 'oneway' property restricts direction"""
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        builder = _GraphBuilder()
+        for feature in data.get('features', []):
+            geometry = feature.get('geometry') or {}
+            oneway = _oneway((feature.get('properties') or {}).get('oneway'))
+            if geometry.get('type') == 'LineString':
+                lines = [geometry['coordinates']]
+            elif geometry.get('type') == 'MultiLineString':
+                lines = geometry['coordinates']
+            else:
+                continue
+            for line in lines:
+                # GeoJSON positions are (lon, lat)
+                builder.add_way([(lat, lon) for lon, lat, *_ in line], oneway)
+        return builder.build(**options)
+
+    @classmethod
+    def from_pbf(cls, path, **options):
+        """Read the highway ways of an OSM PBF extract (needs the optional osmium package)"""
+        try:
+            import osmium
+        except ImportError:
+            raise ImproperlyConfigured("Reading .osm.pbf extracts requires the 'osmium' package")
+
+        builder = _GraphBuilder()
+
+        class WayHandler(osmium.SimpleHandler):
+            def way(self, way):
+                if 'highway' not in way.tags:
+                    return
+                points = [(node.lat, node.lon) for node in way.nodes if node.location.valid()]
+                builder.add_way(points, _oneway(way.tags.get('oneway')))
+
+        WayHandler().apply_file(str(path), locations=True)
+        return builder.build(**options)
+
+    @classmethod
+    def load(cls, path, cache_dir=None, **options):
+        """Load an extract through the on-disk cache, parsing it only when it changed"""
+        cache = cache_path(path, cache_dir)
+        if os.path.exists(cache):
+            with np.load(cache) as data:
+                network = cls(data['coords'], data['indptr'], data['indices'], data['weights'], **options)
+            logger.info(f"Loaded road network from {cache}: {network.node_count} nodes, {network.edge_count} edges")
+        else:
+            path = str(path)
+            if path.endswith('.pbf'):
+                network = cls.from_pbf(path, **options)
+            else:
+                network = cls.from_geojson(path, **options)
+            network.save(cache)
+            logger.info(f"Parsed road network {path}: {network.node_count} nodes, {network.edge_count} edges")
+        network.fingerprint = os.path.basename(cache)[:-len('.npz')]
+        return network
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Written under a temporary name so a concurrent reader never sees half a file
+        tmp = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp, coords=self.coords, indptr=self.indptr, indices=self.indices, weights=self.weights)
+        os.replace(tmp, path)
+
+    @property
+    def node_count(self):
+        return len(self.coords)
+
+    @property
+    def edge_count(self):
+        return len(self.indices)
+
+    def _build_snap_index(self):
+        """Nodes sorted by grid cell, with the slice of each occupied cell"""
+        mean_lat = float(self.coords[:, 0].mean()) if len(self.coords) else 0.0
+        self.lat_step = SNAP_CELL_KM / KM_PER_DEGREE
+        self.lon_step = SNAP_CELL_KM / (KM_PER_DEGREE * max(cos(radians(mean_lat)), 0.01))
+        cells = self._cells_of(self.coords)
+        self._cell_order = np.lexsort((cells[:, 1], cells[:, 0]))
+        self._cells = {}
+        if len(cells):
+            unique, starts, counts = np.unique(cells[self._cell_order], axis=0, return_index=True, return_counts=True)
+            self._cells = {(int(i), int(j)): (start, start + count) for (i, j), start, count in zip(unique, starts, counts)}
+
+    def _cells_of(self, coords):
+        return np.stack([
+            np.floor(coords[:, 0] / self.lat_step),
+            np.floor(coords[:, 1] / self.lon_step)
+        ], axis=1).astype(np.int64).reshape(-1, 2)
+
+    def snap(self, coords):
+        """Nearest node of each point within snap_radius_km (-1 if none) and its distance in km"""
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        nodes = np.full(len(coords), -1, dtype=np.int64)
+        offsets = np.zeros(len(coords))
+        reach = int(np.ceil(self.snap_radius_km / SNAP_CELL_KM))
+        for point, (ci, cj) in enumerate(self._cells_of(coords)):
+            rows = [
+                self._cell_order[start:stop]
+                for di in range(-reach, reach + 1)
+                for dj in range(-reach, reach + 1)
+                for start, stop in [self._cells.get((ci + di, cj + dj), (0, 0))]
+                if stop > start
+            ]
+            if not rows:
+                continue
+            candidates = np.concatenate(rows)
+            distances = _segment_lengths(np.broadcast_to(coords[point], (len(candidates), 2)), self.coords[candidates])
+            best = int(np.argmin(distances))
+            if distances[best] <= self.snap_radius_km:
+                nodes[point] = candidates[best]
+                offsets[point] = distances[best]
+        return nodes, offsets
+
+    def _lists(self, reverse=False):
+        # Python lists are several times faster than NumPy scalars in the Dijkstra loop
+        if self._adjacency is None:
+            self._adjacency = (self.indptr.tolist(), self.indices.tolist(), self.weights.tolist())
+        if not reverse:
+            return self._adjacency
+        if self._reverse_adjacency is None:
+            # Transposed CSR: the incoming edges of each node
+            sources = np.repeat(np.arange(self.node_count, dtype=np.int32), np.diff(self.indptr))
+            order = np.argsort(self.indices, kind='stable')
+            counts = np.bincount(self.indices, minlength=self.node_count)
+            indptr = np.concatenate([[0], np.cumsum(counts)])
+            self._reverse_adjacency = (indptr.tolist(), sources[order].tolist(), self.weights[order].tolist())
+        return self._reverse_adjacency
+
+    def _dijkstra(self, source, targets, reverse=False):
+        """km from source to each reachable target (to source from each target if reverse).
+
+        Stops once every target is settled. The search state only holds the
+        nodes it reached, so a short search costs nothing per graph node.
+        """
+        indptr, indices, weights = self._lists(reverse)
+        remaining = set(targets)
+        best = {source: 0.0}
+        settled = set()
+        heap = [(0.0, source)]
+        while heap and remaining:
+            distance, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            settled.add(node)
+            remaining.discard(node)
+            for edge in range(indptr[node], indptr[node + 1]):
+                neighbour = indices[edge]
+                candidate = distance + weights[edge]
+                if candidate < best.get(neighbour, inf):
+                    best[neighbour] = candidate
+                    heapq.heappush(heap, (candidate, neighbour))
+        return {target: best[target] for target in targets if target in settled}
+
+    def shortest_paths(self, sources, targets):
+        """(len(sources), len(targets)) km between graph nodes; inf where unreachable.
+
+        One search per distinct node on the smaller side: forward from the
+        sources, or backward over incoming edges from the targets.
+        """
+        matrix = np.full((len(sources), len(targets)), np.inf)
+        rows, columns = {}, {}
+        for row, source in enumerate(sources):
+            rows.setdefault(int(source), []).append(row)
+        for column, target in enumerate(targets):
+            columns.setdefault(int(target), []).append(column)
+        if len(columns) < len(rows):
+            for target, target_columns in columns.items():
+                for source, distance in self._dijkstra(target, rows, reverse=True).items():
+                    matrix[np.ix_(rows[source], target_columns)] = distance
+        else:
+            for source, source_rows in rows.items():
+                for target, distance in self._dijkstra(source, columns).items():
+                    matrix[np.ix_(source_rows, columns[target])] = distance
+        return matrix
+
+    def distance_block(self, origins, destinations=None):
+        """Road km from each origin to each destination (default: the origins themselves).
+
+        Pairs off the network or not connected by it fall back to straight-line km.
+        """
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 2)
+        origin_nodes, origin_offsets = self.snap(origins)
+        if destinations is None:
+            destinations, target_nodes, target_offsets = origins, origin_nodes, origin_offsets
+        else:
+            destinations = np.asarray(destinations, dtype=np.float64).reshape(-1, 2)
+            target_nodes, target_offsets = self.snap(destinations)
+
+        matrix = haversine_matrix(origins, destinations)
+        rows, columns = np.flatnonzero(origin_nodes >= 0), np.flatnonzero(target_nodes >= 0)
+        if len(rows) and len(columns):
+            sources, source_index = np.unique(origin_nodes[rows], return_inverse=True)
+            targets, target_index = np.unique(target_nodes[columns], return_inverse=True)
+            road = self.shortest_paths(sources, targets)[np.ix_(source_index, target_index)]
+            road += origin_offsets[rows][:, None] + target_offsets[columns][None, :]
+            block = np.ix_(rows, columns)
+            unreachable = ~np.isfinite(road)
+            if unreachable.any():
+                logger.debug(f"{int(unreachable.sum())} point pairs are not connected by the road network")
+            matrix[block] = np.where(unreachable, matrix[block], road)
+        return matrix
+
+    def distance_matrix(self, coords):
+        """Square road km matrix between points"""
+        matrix = self.distance_block(coords)
+        np.fill_diagonal(matrix, 0)
+        return matrix
+
+    def pair_distances(self, origins, destinations):
+        """Road km from each origin to the destination in the same row"""
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 2)
+        destinations = np.asarray(destinations, dtype=np.float64).reshape(-1, 2)
+        origin_nodes, origin_offsets = self.snap(origins)
+        target_nodes, target_offsets = self.snap(destinations)
+        distances = _segment_lengths(origins, destinations)
+        for row, (source, target) in enumerate(zip(origin_nodes.tolist(), target_nodes.tolist())):
+            if source < 0 or target < 0:
+                continue
+            distance = self._dijkstra(source, [target]).get(target)
+            if distance is not None:
+                distances[row] = distance + origin_offsets[row] + target_offsets[row]
+        return distances
+
+    def path_lengths(self, points):
+        """Road km of each leg of an open path through an (n, 2) array of points"""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if len(points) < 2:
+            return np.zeros(0)
+        return self.pair_distances(points[:-1], points[1:])
+
+
+def cache_path(path, cache_dir=None):
+    """Cache file of an extract; the name changes whenever the extract does"""
+    path = os.path.abspath(str(path))
+    stat = os.stat(path)
+    key = f"{path}:{stat.st_size}:{stat.st_mtime_ns}:{CACHE_FORMAT_VERSION}"
+    digest = hashlib.sha1(key.encode()).hexdigest()[:12]
+    cache_dir = cache_dir or os.path.dirname(path)
+    return os.path.join(cache_dir, f"{os.path.basename(path)}.{digest}.npz")
+
+
+_network = None
+_network_lock = threading.Lock()
+
+
+def distance_provider_name():
+    return getattr(settings, 'DISTANCE_PROVIDER', 'haversine')
+
+
+def get_road_network():
+    """The network configured by ROAD_NETWORK, loaded once per process"""
+    global _network
+    with _network_lock:
+        if _network is None:
+            options = dict(getattr(settings, 'ROAD_NETWORK', {}))
+            path = options.pop('path', None)
+            if not path:
+                raise ImproperlyConfigured("DISTANCE_PROVIDER 'road_network' requires ROAD_NETWORK['path']")
+            _network = RoadNetwork.load(path, **options)
+        return _network
+
+
+def get_distance_provider():
+    """The road network when DISTANCE_PROVIDER selects it, or None for straight-line distances.
+
+    With DISTANCE_CACHE enabled the network is wrapped in the distance cache,
+    one cache per extract.
+    """
+    name = distance_provider_name()
+    if name == 'haversine':
+        return None
+    if name == 'road_network':
+        network = get_road_network()
+        if cache_enabled():
+            return CachedDistances(network, get_distance_cache(network.fingerprint or 'default'))
+        return network
+    raise ImproperlyConfigured(f"Unknown distance provider: {name}")
+
+
+@receiver(setting_changed)
+def _reset_network(setting, **kwargs):
+    global _network
+    if setting in ('DISTANCE_PROVIDER', 'ROAD_NETWORK'):
+        with _network_lock:
+            _network = None
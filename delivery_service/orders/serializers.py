@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import Customer, Courier, Order, User, CourierRating
+from .models import Customer, Courier, Order, User, CourierRating, DistributionJob, CourierRoute
 from django.contrib.auth.hashers import make_password
 from django.db.models import Avg
 
@@ -77,8 +77,8 @@ class CourierSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Courier
-        fields = ('id', 'name', 'email', 'phone', 'vehicle', 'balance', 'monthly_orders', 'monthly_earnings', 'current_location_lat', 'current_location_lon')
-        read_only_fields = ('balance', 'monthly_orders', 'monthly_earnings')
+        fields = ('id', 'name', 'email', 'phone', 'vehicle', 'balance', 'active_orders', 'monthly_orders', 'monthly_earnings', 'current_location_lat', 'current_location_lon')
+        read_only_fields = ('balance', 'active_orders', 'monthly_orders', 'monthly_earnings')
 
     def get_monthly_orders(self, obj):
         return obj.get_monthly_orders_count()
@@ -143,9 +143,13 @@ class OrderSerializer(serializers.ModelSerializer):
             'description',
             'created_at',
             'updated_at',
-            'delivery_date'
+            'delivery_date',
+            'deliver_by',
+            'lat',
+            'lon',
+            'geocode_status'
         ]
-        read_only_fields = ['created_at', 'updated_at', 'delivery_date']
+        read_only_fields = ['created_at', 'updated_at', 'delivery_date', 'lat', 'lon', 'geocode_status']
 
     def to_representation(self, instance):
         representation = super().to_representation(instance)
@@ -182,4 +186,38 @@ class OrderSerializer(serializers.ModelSerializer):
         # For other users, validate all required fields
         if not self.partial and not data.get('address'):
             raise serializers.ValidationError({"address": "This field is required."})
-        return data
\ No newline at end of file
+        return data
+
+
+class DistributionJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DistributionJob
+        fields = [
+            'id', 'status', 'mode', 'dry_run', 'profile', 'run', 'phase', 'progress', 'phase_timings', 'assigned_count',
+            'plan', 'applied_at', 'message', 'error', 'created_at', 'started_at', 'finished_at'
+        ]
+        read_only_fields = fields
+
+
+class CourierRouteSerializer(serializers.ModelSerializer):
+    stops = serializers.SerializerMethodField()
+
+    class Meta:
+        model = CourierRoute
+        fields = ['courier', 'stops', 'length_km', 'duration_min', 'updated_at']
+
+    def get_stops(self, obj):
+        orders = Order.objects.in_bulk(obj.stops)
+        etas = dict(zip(obj.stops, obj.eta_minutes))
+        return [
+            {
+                'order_id': order.id,
+                'address': order.address,
+                'lat': order.lat,
+                'lon': order.lon,
+                'status': order.status,
+                'eta_min': etas.get(order.id),
+            }
+            for order in (orders.get(order_id) for order_id in obj.stops)
+            if order is not None
+        ]
@@ -0,0 +1,157 @@
+"""Process pool for CPU-bound route solving.
+
+This module imports nothing from Django at load time so spawned workers can
+unpickle its functions before Django is set up; _init_worker sets it up once
+per worker and the solver modules stay imported for the worker's lifetime.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .instrumentation import DispatchTrace, current_trace
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _setting(name, default):
+    from django.conf import settings
+    return getattr(settings, name, default)
+
+
+def _init_worker():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'delivery_service.settings')
+    import django
+    django.setup()
+
+
+def _solve_tsps_inline(matrices, solver_settings, initial_routes):
+    from .order_distribution import solve_tsp
+    return [solve_tsp(matrix, solver_settings, route) for matrix, route in zip(matrices, initial_routes)]
+
+
+def _solve_vrp_inline(problem, solver_settings):
+    from .order_distribution import solve_vrp
+    return solve_vrp(solver_settings=solver_settings, **problem)
+
+
+def _solve_tsps(matrices, solver_settings, initial_routes):
+    """Solve a share of the TSPs in a worker; returns the routes and the solver stats for the parent's trace"""
+    trace = DispatchTrace()
+    with trace.run():
+        routes = _solve_tsps_inline(matrices, solver_settings, initial_routes)
+    return routes, trace.attributes.get('solve', {})
+
+
+def _solve_vrp(problem, solver_settings):
+    """Solve one routing model in a worker; returns the routes and the solver stats for the parent's trace"""
+    trace = DispatchTrace()
+    with trace.run():
+        routes = _solve_vrp_inline(problem, solver_settings)
+    return routes, trace.attributes.get('solve', {})
+
+
+def get_pool():
+    """Shared pool of ORDER_SOLVER_PROCESSES workers, or None when solving inline.
+
+    Workers are spawned, not forked, because the pool is started from
+    threaded web and job processes. They are replaced after
+    ORDER_SOLVER_TASKS_PER_CHILD tasks, which keeps the memory of
+    long-running workers bounded.
+    """
+    global _pool
+    processes = _setting('ORDER_SOLVER_PROCESSES', 1)
+    if processes <= 1:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                max_tasks_per_child=_setting('ORDER_SOLVER_TASKS_PER_CHILD', 200),
+            )
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(cancel_futures=True)
+            _pool = None
+
+
+def _run_in_pool(func, tasks, inline):
+    """Results of func(*task) for every task from the pool, in task order; None without a pool.
+
+    func returns (result, solver stats); a task the pool fails on is solved
+    with inline(*task) instead.
+    """
+    pool = get_pool() if len(tasks) > 1 else None
+    if pool is None:
+        return None
+    try:
+        futures = [pool.submit(func, *task) for task in tasks]
+    except BrokenProcessPool:
+        shutdown_pool()
+        return None
+
+    results = []
+    for task, future in zip(tasks, futures):
+        try:
+            result, stats = future.result()
+            current_trace().record('solve', **stats)
+        except BrokenProcessPool:
+            logger.error("Solver pool broke, solving the rest inline")
+            shutdown_pool()
+            result = inline(*task)
+        except Exception as e:
+            logger.error(f"Error solving in the solver pool: {str(e)}")
+            result = inline(*task)
+        results.append(result)
+    return results
+
+
+def solve_tsps(matrices, solver_settings, initial_routes=None):
+    """Solve independent TSPs, in the pool when there is one; results keep the input order.
+
+    Routes small enough for the exact solver are cheaper to solve here than
+    to ship to a worker. The larger ones are dealt out to one task per
+    worker, so the pickling and IPC cost is paid per worker, not per route.
+    initial_routes, if given, holds a warm-start visiting order (or None) per matrix.
+    """
+    initial_routes = initial_routes or [None] * len(matrices)
+    remote = [i for i, matrix in enumerate(matrices) if len(matrix) > solver_settings.exact_max_nodes]
+    # Largest first, round-robin, so the workers get similar shares
+    remote.sort(key=lambda i: -len(matrices[i]))
+    workers = max(int(_setting('ORDER_SOLVER_PROCESSES', 1)), 1)
+    shares = [share for share in (remote[j::workers] for j in range(workers)) if share]
+    results = _run_in_pool(_solve_tsps, [
+        ([matrices[i] for i in share], solver_settings, [initial_routes[i] for i in share]) for share in shares
+    ], _solve_tsps_inline) if len(remote) > 1 else None
+
+    routes = {}
+    for share, share_routes in zip(shares, results or []):
+        routes.update(zip(share, share_routes))
+    for i, matrix in enumerate(matrices):
+        if i not in routes:
+            routes[i] = _solve_tsps_inline([matrix], solver_settings, [initial_routes[i]])[0]
+    return [routes[i] for i in range(len(matrices))]
+
+
+def solve_vrps(problems, solver_settings):
+    """Solve independent routing models, in the pool when there is one; results keep the input order.
+
+    Each problem holds the keyword arguments of solve_vrp() other than
+    solver_settings, e.g. one area of cluster mode.
+    """
+    results = _run_in_pool(_solve_vrp, [(problem, solver_settings) for problem in problems], _solve_vrp_inline)
+    if results is None:
+        results = [_solve_vrp_inline(problem, solver_settings) for problem in problems]
+    return results
@@ -0,0 +1,44 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+logger = logging.getLogger(__name__)
+
+_executors = {}
+_executor_lock = threading.Lock()
+
+
+def _get_executor(queue='default'):
+    with _executor_lock:
+        if queue not in _executors:
+            # A single worker per queue keeps background geocoding within Nominatim's
+            # rate limit and never runs two distribution passes at the same time
+            _executors[queue] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'orders-{queue}')
+        return _executors[queue]
+
+
+def _run(func, args):
+    close_old_connections()
+    try:
+        func(*args)
+    except Exception:
+        logger.exception(f"Background task {func.__name__} failed")
+    finally:
+        close_old_connections()
+
+
+def run_in_background(func, *args, queue='default'):
+    """Run func(*args) once the current transaction commits, outside the request thread.
+
+    Tasks on different queues do not wait for each other, so a long distribution
+    pass does not hold up geocoding of new orders. With ORDERS_BACKGROUND_TASKS
+    disabled the call runs synchronously on commit, which is convenient for
+    scripts and debugging.
+    """
+    if not getattr(settings, 'ORDERS_BACKGROUND_TASKS', True):
+        transaction.on_commit(lambda: _run(func, args))
+        return
+    transaction.on_commit(lambda: _get_executor(queue).submit(_run, func, args))
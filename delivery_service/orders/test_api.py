@@ -1,11 +1,19 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
 from rest_framework.test import APIClient
 from rest_framework import status
 from django.contrib.auth import get_user_model
-from orders.models import Customer, Courier, Order
+from orders.models import Customer, Courier, Order, DistributionJob, CourierRoute
+from datetime import timedelta
 from decimal import Decimal
+from unittest import mock
 from django.utils import timezone
+from orders import geocoding
+from orders.order_distribution import distribute_orders
+from django.core.management import call_command
+from django.db import DatabaseError
+from orders import jobs
+import queue
 
 User = get_user_model()
 
@@ -62,6 +70,10 @@ class APITests(TestCase):
             address='ул. Тверская, 1, Москва'
         )
 
+    def geocode_order(self):
+        """Give the pending order coordinates near the courier, as the geocoder would"""
+        Order.objects.filter(id=self.order.id).update(lat=Decimal('55.7570'), lon=Decimal('37.6150'), geocode_status='ok')
+
     def test_login(self):
         """Test user login"""
         url = reverse('login')
@@ -117,6 +129,204 @@ class APITests(TestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertEqual(Order.objects.count(), 2)
 
+    @override_settings(ORDERS_BACKGROUND_TASKS=False)
+    def test_create_order_geocodes_address(self):
+        """Test that a new order gets coordinates right after creation"""
+        geocoding.clear_memory_cache()
+        self.addCleanup(geocoding.clear_memory_cache)
+        self.client.force_authenticate(user=self.admin_user)
+
+        url = reverse('order-list')
+        data = {
+            'customer': self.customer.id,
+            'address': 'ул. Новый Арбат, 15, Москва'
+        }
+        with mock.patch('orders.geocoding.NominatimGeocoder._request', return_value=(55.752, 37.587)):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        response = self.client.get(reverse('order-detail', args=[response.data['id']]))
+        self.assertEqual(response.data['geocode_status'], 'ok')
+        self.assertEqual(Decimal(response.data['lat']), Decimal('55.752'))
+        self.assertEqual(Decimal(response.data['lon']), Decimal('37.587'))
+
+    @override_settings(ORDERS_BACKGROUND_TASKS=False, ORDER_INCREMENTAL_DISPATCH=True)
+    def test_delivered_order_frees_courier_slot(self):
+        """Test that delivering an order lets the courier pick up a waiting one"""
+        active = Order.objects.create(
+            customer=self.customer,
+            courier=self.courier,
+            address='Test Address',
+            status='In Progress',
+            lat=Decimal('55.7560'),
+            lon=Decimal('37.6180'),
+            geocode_status='ok'
+        )
+        self.geocode_order()
+        self.client.force_authenticate(user=self.courier_user)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(reverse('order-detail', args=[active.id]), {'status': 'Delivered'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.courier, self.courier)
+        self.assertEqual(self.order.status, 'In Progress')
+        self.assertEqual(CourierRoute.objects.get(courier=self.courier).stops, [self.order.id])
+
+    def test_courier_route(self):
+        """Test that the stored route is served in visiting order"""
+        first = Order.objects.create(customer=self.customer, courier=self.courier, address='Первый адрес',
+                                     status='In Progress', lat=Decimal('55.7560'), lon=Decimal('37.6180'))
+        second = Order.objects.create(customer=self.customer, courier=self.courier, address='Второй адрес',
+                                      status='In Progress', lat=Decimal('55.7600'), lon=Decimal('37.6200'))
+        CourierRoute.objects.create(courier=self.courier, stops=[second.id, first.id], length_km=1.5)
+        self.client.force_authenticate(user=self.courier_user)
+
+        response = self.client.get(reverse('courier-route', args=[self.courier.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([stop['order_id'] for stop in response.data['stops']], [second.id, first.id])
+        self.assertEqual(response.data['stops'][0]['address'], 'Второй адрес')
+        self.assertEqual(response.data['length_km'], 1.5)
+
+        # Other couriers' routes stay hidden from couriers, and all of them from customers
+        other = Courier.objects.create(name='Анна Белова', email='anna@example.com', phone='+79991234571', vehicle='Велосипед')
+        response = self.client.get(reverse('courier-route', args=[other.id]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.client.force_authenticate(user=self.customer_user)
+        response = self.client.get(reverse('courier-route', args=[self.courier.id]))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    @override_settings(ORDERS_BACKGROUND_TASKS=False, DISTRIBUTION_JOB_RUNNER='thread')
+    def test_distribute_orders_job(self):
+        """Test that distribution runs as a job whose status can be polled"""
+        self.geocode_order()
+        self.client.force_authenticate(user=self.admin_user)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('distribute-orders'), {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], 'queued')
+
+        response = self.client.get(reverse('distribution-job', args=[response.data['job_id']]))
+        self.assertEqual(response.data['status'], 'done')
+        self.assertEqual(response.data['assigned_count'], 1)
+        self.assertEqual(response.data['progress'], 1)
+        self.assertIn('solve', response.data['phase_timings'])
+        self.assertIsNotNone(response.data['run'])
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.courier, self.courier)
+
+    @override_settings(ORDERS_BACKGROUND_TASKS=False, DISTRIBUTION_JOB_RUNNER='thread')
+    def test_dry_run_job_previews_and_applies_the_plan(self):
+        """Test that a dry run proposes a plan without writing it and that applying saves that plan once"""
+        self.geocode_order()
+        self.client.force_authenticate(user=self.admin_user)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('distribute-orders'), {'dry_run': True, 'mode': 'global'}, format='json')
+        job_id = response.data['job_id']
+        response = self.client.get(reverse('distribution-job', args=[job_id]))
+        self.assertEqual(response.data['status'], 'done')
+        self.assertTrue(response.data['dry_run'])
+        plan = response.data['plan']
+        self.assertEqual(plan['assignments'], {str(self.order.id): self.courier.id})
+        self.assertEqual(plan['routes'][0]['stops'], [self.order.id])
+        self.assertGreater(plan['routes'][0]['length_km'], 0)
+        self.assertIsNone(Order.objects.get(id=self.order.id).courier)
+        self.assertFalse(CourierRoute.objects.exists())
+        self.assertEqual(Courier.objects.get(id=self.courier.id).active_orders, 0)
+
+        # Applying replays the stored plan; nothing is solved again
+        with mock.patch('orders.order_distribution._distribute') as distribute:
+            response = self.client.post(reverse('distribution-job-apply', args=[job_id]))
+        distribute.assert_not_called()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['assigned'], 1)
+        self.assertEqual(Order.objects.get(id=self.order.id).courier, self.courier)
+        self.assertEqual(CourierRoute.objects.get(courier=self.courier).length_km, plan['routes'][0]['length_km'])
+
+        response = self.client.post(reverse('distribution-job-apply', args=[job_id]))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_job_with_dead_runner_is_marked_failed(self):
+        """Test that a running job whose runner stopped sending heartbeats is reported as failed"""
+        stale = timezone.now() - timedelta(seconds=301)
+        job = DistributionJob.objects.create(status='running', started_at=stale, heartbeat_at=stale)
+        alive = DistributionJob.objects.create(status='running', started_at=stale, heartbeat_at=timezone.now())
+        self.client.force_authenticate(user=self.admin_user)
+
+        response = self.client.get(reverse('distribution-job', args=[job.id]))
+
+        self.assertEqual(response.data['status'], 'failed')
+        self.assertEqual(response.data['error'], 'Job runner stopped responding')
+        alive.refresh_from_db()
+        self.assertEqual(alive.status, 'running')
+
+    def test_failed_heartbeat_does_not_stop_the_next_ones(self):
+        """Test that the heartbeat thread keeps writing phases after one write fails"""
+        phases = queue.Queue()
+        for phase in ('couriers', 'solve', None):
+            phases.put(phase)
+        with mock.patch('orders.jobs.DistributionJob') as job_model, mock.patch('orders.jobs.connection') as connection:
+            update = job_model.objects.filter.return_value.update
+            update.side_effect = [DatabaseError('database is locked'), 1]
+            jobs._send_heartbeats(1, phases)
+
+        self.assertEqual(update.call_count, 2)
+        self.assertEqual(update.call_args.kwargs['phase'], 'solve')
+        connection.close.assert_called_once()
+
+    def test_stale_plan_is_not_applied(self):
+        """Test that a plan whose couriers changed since the preview is rejected as a whole"""
+        self.geocode_order()
+        result = distribute_orders(dry_run=True)
+        job = DistributionJob.objects.create(dry_run=True, status='done', plan=result['plan'])
+        Order.objects.create(customer=self.customer, courier=self.courier, status='In Progress', address='Новый адрес')
+        self.client.force_authenticate(user=self.admin_user)
+
+        response = self.client.post(reverse('distribution-job-apply', args=[job.id]))
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertIsNone(Order.objects.get(id=self.order.id).courier)
+        job.refresh_from_db()
+        self.assertIsNone(job.applied_at)
+
+    def test_dispatch_metrics(self):
+        """Test that dispatcher histograms are exposed to admins as JSON and Prometheus text"""
+        self.geocode_order()
+        distribute_orders()
+
+        self.client.force_authenticate(user=self.courier_user)
+        response = self.client.get(reverse('dispatch-metrics'))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(user=self.admin_user)
+        response = self.client.get(reverse('dispatch-metrics'))
+        names = [metric['name'] for metric in response.data['metrics']]
+        self.assertEqual(names, ['dispatch_phase_seconds', 'dispatch_run_seconds', 'dispatch_assigned_orders'])
+
+        response = self.client.get(reverse('dispatch-metrics'), {'output': 'prometheus'})
+        self.assertIn('dispatch_phase_seconds_bucket{mode="per_courier",phase="solve",le="+Inf"}', response.content.decode())
+
+    @override_settings(DISTRIBUTION_JOB_RUNNER='worker')
+    def test_distribution_worker_runs_queued_jobs(self):
+        """Test that queued jobs wait for the worker command"""
+        self.geocode_order()
+        self.client.force_authenticate(user=self.admin_user)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('distribute-orders'), {'mode': 'global'}, format='json')
+        job = DistributionJob.objects.get(id=response.data['job_id'])
+        self.assertEqual(job.status, 'queued')
+
+        call_command('run_distribution_worker', '--once', stdout=mock.Mock())
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(job.assigned_count, 1)
+        self.assertIsNotNone(job.finished_at)
+
     def test_update_order_status(self):
         """Test updating order status"""
         # Create an order first
@@ -1,8 +1,29 @@
 from django.test import TestCase
 from django.contrib.auth import get_user_model
-from orders.models import Customer, Courier, Order
-from orders.order_distribution import distribute_orders, calculate_distance
+from orders.models import Customer, Courier, Order, GeocodeCache, CourierRoute, DispatchRun
+from orders.order_distribution import (
+    distribute_orders, calculate_distance, create_distance_matrix, haversine_matrix,
+    solve_tsp, solve_tsp_exact, SolverSettings, GridIndex,
+    cheapest_insertion, dispatch_order, dispatch_to_courier, save_assignments, DispatchPartition,
+    VehicleProfile, TravelTimes, order_created_task, dispatch_order_task, courier_freed_task, kmeans, DISTRIBUTION_MODES, DispatchState, MAX_ACTIVE_ORDERS
+)
+import itertools
+from orders import batching, distance_cache, geocoding, instrumentation, road_network, solver_pool
+from orders.dispatch_snapshot import Snapshot
+from orders.order_queue import OrderQueue, urgency
+from orders.solver_pool import solve_tsps
 from decimal import Decimal
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+import json
+import os
+import tempfile
+import numpy as np
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 User = get_user_model()
@@ -136,6 +157,587 @@ class OrderDistributionTests(TestCase):
         for order in assigned_orders:
             self.assertEqual(order.status, 'In Progress')
 
+    def test_distribute_orders_uses_stored_coordinates(self):
+        """Test that geocoded orders are dispatched without calling the geocoder"""
+        Order.objects.filter(id=self.order1.id).update(lat=Decimal('55.7570'), lon=Decimal('37.6150'), geocode_status='ok')
+        Order.objects.filter(id=self.order2.id).update(lat=Decimal('55.7500'), lon=Decimal('37.5930'), geocode_status='ok')
+        Order.objects.filter(id=self.order3.id).update(geocode_status='failed')
+
+        with mock.patch('orders.geocoding.NominatimGeocoder._request') as request:
+            result = distribute_orders()
+        request.assert_not_called()
+        self.assertEqual(result['assigned'], 2)
+        self.assertEqual(
+            set(result['phase_timings']),
+            {'geocoding', 'couriers', 'orders', 'candidates', 'matrix', 'solve', 'persist'}
+        )
+
+        self.assertEqual(
+            set(Order.objects.filter(courier__isnull=False).values_list('id', flat=True)),
+            {self.order1.id, self.order2.id}
+        )
+
+    def test_dry_run_keeps_geocoded_coordinates(self):
+        """Test that a dry run rolls back the plan but not the coordinates its geocoding phase found"""
+        Order.objects.filter(id__in=[self.order2.id, self.order3.id]).update(geocode_status='failed')
+        geocoding.clear_memory_cache()
+        self.addCleanup(geocoding.clear_memory_cache)
+
+        with mock.patch('orders.geocoding.NominatimGeocoder._request', return_value=(55.757, 37.615)):
+            result = distribute_orders(mode='global', dry_run=True)
+
+        self.assertEqual(result['assigned'], 1)
+        self.order1.refresh_from_db()
+        self.assertIsNone(self.order1.courier)
+        self.assertEqual((self.order1.geocode_status, self.order1.lat), ('ok', Decimal('55.757')))
+        self.assertTrue(GeocodeCache.objects.exists())
+
+    def test_global_mode_gives_couriers_nearby_orders(self):
+        """Test that the global routing model assigns orders to the closest courier"""
+        self.moto_courier.delete()
+        self.bike_courier.delete()
+        far_courier = Courier.objects.create(
+            name='Анна Белова',
+            email='anna@example.com',
+            phone='+79991234573',
+            vehicle='Велосипед',
+            current_location_lat=Decimal('55.6000'),
+            current_location_lon=Decimal('37.4000')
+        )
+        Order.objects.filter(id=self.order1.id).update(lat=Decimal('55.7560'), lon=Decimal('37.6180'), geocode_status='ok')
+        Order.objects.filter(id=self.order2.id).update(lat=Decimal('55.6010'), lon=Decimal('37.4010'), geocode_status='ok')
+        Order.objects.filter(id=self.order3.id).update(lat=Decimal('55.6020'), lon=Decimal('37.4020'), geocode_status='ok')
+
+        with mock.patch('orders.order_distribution.create_distance_matrix', wraps=create_distance_matrix) as matrix:
+            result = distribute_orders(mode='global')
+        self.assertEqual(result['message'], "Заказы успешно распределены")
+        # The virtual depot has no place, so no distances are computed to it
+        locations = matrix.call_args.args[0]
+        self.assertEqual(len(locations), 5)
+        self.assertNotIn(None, locations)
+
+        self.assertEqual(Order.objects.get(id=self.order1.id).courier, self.car_courier)
+        self.assertEqual(Order.objects.get(id=self.order2.id).courier, far_courier)
+        self.assertEqual(Order.objects.get(id=self.order3.id).courier, far_courier)
+
+    def test_global_mode_prefers_faster_vehicles(self):
+        """Test that with couriers side by side the order goes to the vehicle that gets there sooner"""
+        self.moto_courier.delete()
+        Courier.objects.filter(id=self.bike_courier.id).update(
+            current_location_lat=self.car_courier.current_location_lat,
+            current_location_lon=self.car_courier.current_location_lon
+        )
+        Order.objects.filter(id=self.order1.id).update(lat=Decimal('55.7900'), lon=Decimal('37.6500'), geocode_status='ok')
+        Order.objects.exclude(id=self.order1.id).delete()
+
+        distribute_orders(mode='global')
+
+        self.assertEqual(Order.objects.get(id=self.order1.id).courier, self.car_courier)
+        route = CourierRoute.objects.get(courier=self.car_courier)
+        profile = VehicleProfile.for_vehicle('Автомобиль')
+        self.assertAlmostEqual(route.duration_min, route.length_km * profile.minutes_per_km, places=0)
+
+    def test_global_mode_respects_capacity(self):
+        """Test that active orders count against capacity in the global model"""
+        for i in range(4):
+            Order.objects.create(
+                customer=self.customer1,
+                courier=self.car_courier,
+                address=f'Active Address {i}',
+                status='In Progress',
+                lat=Decimal('55.7560'),
+                lon=Decimal('37.6180'),
+                geocode_status='ok'
+            )
+        self.moto_courier.delete()
+        self.bike_courier.delete()
+        Order.objects.filter(courier__isnull=True).update(lat=Decimal('55.7561'), lon=Decimal('37.6181'), geocode_status='ok')
+
+        distribute_orders(mode='global')
+
+        self.assertEqual(Order.objects.filter(courier=self.car_courier, status='In Progress').count(), 5)
+        self.assertEqual(Order.objects.filter(courier__isnull=True).count(), 2)
+
+    @override_settings(DISPATCH_CLUSTER_ORDERS=2)
+    def test_cluster_mode_solves_each_area(self):
+        """Test that cluster mode splits the backlog into areas served by their own couriers"""
+        self.moto_courier.delete()
+        far_courier = Courier.objects.create(
+            name='Анна Белова',
+            email='anna@example.com',
+            phone='+79991234573',
+            vehicle='Велосипед',
+            current_location_lat=Decimal('55.6000'),
+            current_location_lon=Decimal('37.4000')
+        )
+        Order.objects.filter(id=self.order1.id).update(lat=Decimal('55.7560'), lon=Decimal('37.6180'), geocode_status='ok')
+        Order.objects.filter(id=self.order2.id).update(lat=Decimal('55.6010'), lon=Decimal('37.4010'), geocode_status='ok')
+        Order.objects.filter(id=self.order3.id).update(lat=Decimal('55.6020'), lon=Decimal('37.4020'), geocode_status='ok')
+
+        with mock.patch('orders.order_distribution.solve_vrps', wraps=solver_pool.solve_vrps) as solve:
+            result = distribute_orders(mode='cluster')
+
+        # Both areas are solved in one batch
+        solve.assert_called_once()
+        self.assertEqual(len(solve.call_args.args[0]), 2)
+        self.assertEqual(result['assigned'], 3)
+        self.assertIn(Order.objects.get(id=self.order1.id).courier, (self.car_courier, self.bike_courier))
+        self.assertEqual(Order.objects.get(id=self.order2.id).courier, far_courier)
+        self.assertEqual(Order.objects.get(id=self.order3.id).courier, far_courier)
+        self.assertEqual(DispatchRun.objects.get(id=result['run_id']).stats['cluster']['clusters'], 2)
+
+    @override_settings(DISPATCH_CLUSTER_ORDERS=2)
+    def test_cluster_mode_repairs_areas_without_couriers(self):
+        """Test that orders of an area no courier joined are inserted into nearby routes"""
+        self.moto_courier.delete()
+        Order.objects.filter(id=self.order1.id).update(lat=Decimal('55.7560'), lon=Decimal('37.6180'), geocode_status='ok')
+        Order.objects.filter(id=self.order2.id).update(lat=Decimal('55.7000'), lon=Decimal('37.5500'), geocode_status='ok')
+        Order.objects.filter(id=self.order3.id).update(lat=Decimal('55.7010'), lon=Decimal('37.5510'), geocode_status='ok')
+
+        result = distribute_orders(mode='cluster')
+
+        self.assertEqual(result['assigned'], 3)
+        stats = DispatchRun.objects.get(id=result['run_id']).stats
+        self.assertEqual(stats['cluster']['without_couriers'], 1)
+        self.assertEqual(stats['repair']['assigned'], 2)
+        for order in Order.objects.filter(id__in=[self.order2.id, self.order3.id]):
+            self.assertIn(order.id, CourierRoute.objects.get(courier=order.courier).stops)
+
+    def test_global_mode_keeps_overdue_orders_when_capacity_is_short(self):
+        """Test that with one free slot the overdue order is served before a closer new one"""
+        for i in range(4):
+            Order.objects.create(
+                customer=self.customer1,
+                courier=self.car_courier,
+                address=f'Active Address {i}',
+                status='In Progress',
+                lat=Decimal('55.7560'),
+                lon=Decimal('37.6180'),
+                geocode_status='ok'
+            )
+        self.moto_courier.delete()
+        self.bike_courier.delete()
+        self.order3.delete()
+        Order.objects.filter(id=self.order1.id).update(
+            lat=Decimal('55.7600'), lon=Decimal('37.6250'), geocode_status='ok',
+            created_at=timezone.now() - timedelta(hours=2)
+        )
+        Order.objects.filter(id=self.order2.id).update(lat=Decimal('55.7562'), lon=Decimal('37.6182'), geocode_status='ok')
+
+        distribute_orders(mode='global')
+
+        self.assertEqual(Order.objects.get(id=self.order1.id).courier, self.car_courier)
+        self.assertIsNone(Order.objects.get(id=self.order2.id).courier)
+
+    def test_dispatch_state_is_loaded_in_two_queries(self):
+        """Test that couriers' positions, loads and active orders come as arrays from two queries"""
+        Courier.objects.filter(id=self.bike_courier.id).update(current_location_lat=None, current_location_lon=None)
+        Order.objects.filter(id__in=[self.order1.id, self.order2.id]).update(courier=self.moto_courier, status='In Progress')
+        couriers = list(Courier.objects.order_by('id'))
+
+        with self.assertNumQueries(2):
+            state = DispatchState.load(couriers)
+
+        self.assertEqual(state.courier_ids.tolist(), [self.car_courier.id, self.moto_courier.id, self.bike_courier.id])
+        self.assertEqual(state.loads.tolist(), [0, 2, 0])
+        self.assertEqual(state.located.tolist(), [True, True, False])
+        self.assertEqual(len(state.active_orders[self.moto_courier.id]), 2)
+        subset = state.subset([1])
+        self.assertEqual((len(subset), subset.free_slots.tolist()), (1, [3]))
+        self.assertEqual(list(subset.active_orders), [self.moto_courier.id])
+
+    def test_run_queries_do_not_grow_with_couriers(self):
+        """Test that a dispatch run has no per-courier queries"""
+        Order.objects.update(lat=Decimal('55.7560'), lon=Decimal('37.6180'), geocode_status='ok')
+
+        def run_queries():
+            Order.objects.filter(id__in=[self.order1.id, self.order2.id, self.order3.id]).update(courier=None, status='Pending')
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(distribute_orders(mode='global')['assigned'], 3)
+            return len(queries)
+
+        before = run_queries()
+        for i in range(5):
+            courier = Courier.objects.create(
+                name=f'Курьер {i}', email=f'courier{i}@example.com', phone=f'+7999000000{i}', vehicle='Велосипед',
+                current_location_lat=Decimal('55.7500'), current_location_lon=Decimal('37.6000')
+            )
+            Order.objects.create(customer=self.customer1, courier=courier, status='In Progress', address=f'Адрес {i}',
+                                 lat=Decimal('55.7400'), lon=Decimal('37.6000'), geocode_status='ok')
+        self.assertEqual(run_queries(), before)
+        # The routes stored by the first run seed the second one
+        self.assertEqual(DispatchRun.objects.latest('id').stats['solve']['warm_starts'], 1)
+
+    def test_couriers_get_nearest_orders(self):
+        """Test that orders beyond the candidate radius are not offered to a courier"""
+        self.moto_courier.delete()
+        self.bike_courier.delete()
+        Order.objects.filter(id=self.order1.id).update(lat=Decimal('55.7560'), lon=Decimal('37.6180'), geocode_status='ok')
+        Order.objects.filter(id=self.order2.id).update(lat=Decimal('59.9343'), lon=Decimal('30.3351'), geocode_status='ok')
+        Order.objects.filter(id=self.order3.id).update(lat=Decimal('55.7520'), lon=Decimal('37.5900'), geocode_status='ok')
+
+        distribute_orders(mode='per_courier')
+
+        self.assertEqual(
+            set(Order.objects.filter(courier=self.car_courier).values_list('id', flat=True)),
+            {self.order1.id, self.order3.id}
+        )
+
+    def test_zone_partition_only_claims_its_zone(self):
+        """Test that a zone run leaves couriers and orders of other zones alone"""
+        west = DispatchPartition('west', bbox=(55.0, 37.0, 56.0, 37.6175))
+        Order.objects.filter(id=self.order1.id).update(lat=Decimal('55.7560'), lon=Decimal('37.6100'), geocode_status='ok')
+        Order.objects.filter(id=self.order2.id).update(lat=Decimal('55.7500'), lon=Decimal('37.6300'), geocode_status='ok')
+        Order.objects.filter(id=self.order3.id).update(lat=Decimal('55.7520'), lon=Decimal('37.5900'), geocode_status='ok')
+
+        result = distribute_orders(partition=west)
+
+        self.assertEqual(result['assigned'], 2)
+        self.assertEqual(
+            dict(Order.objects.filter(courier__isnull=False).values_list('id', 'courier_id')),
+            {self.order1.id: self.car_courier.id, self.order3.id: self.car_courier.id}
+        )
+
+    def test_vehicle_partition_only_claims_orders_in_reach(self):
+        """Test that a vehicle run does not lock orders far from all of its couriers"""
+        bikes = DispatchPartition('Велосипед', vehicle='Велосипед')
+        Order.objects.filter(id=self.order1.id).update(lat=Decimal('55.7560'), lon=Decimal('37.6100'), geocode_status='ok')
+        Order.objects.filter(id=self.order2.id).update(lat=Decimal('59.9343'), lon=Decimal('30.3351'), geocode_status='ok')
+
+        positions = np.array([[55.7539, 37.6208]])
+        claimed = Order.objects.filter(courier__isnull=True).filter(bikes.order_filter(positions))
+
+        self.assertEqual(set(claimed.values_list('id', flat=True)), {self.order1.id, self.order3.id})
+
+    @override_settings(DISPATCH_PARTITION_BY='vehicle')
+    def test_dispatch_worker_command(self):
+        """Test that the worker only dispatches the requested partitions"""
+        Order.objects.filter(courier__isnull=True).update(lat=Decimal('55.7540'), lon=Decimal('37.6200'), geocode_status='ok')
+
+        call_command('dispatch_worker', '--once', '--partition', 'Мотоцикл', stdout=StringIO())
+
+        self.assertEqual(set(Order.objects.values_list('courier_id', flat=True)), {self.moto_courier.id})
+
+    def test_cheapest_insertion(self):
+        """Test insertion between stops and after the last stop"""
+        route = np.array([[55.70, 37.60], [55.80, 37.60]])
+        costs, positions = cheapest_insertion(route, [[55.75, 37.60], [55.90, 37.60]])
+        self.assertEqual(list(positions), [1, 2])
+        self.assertAlmostEqual(costs[0], 0.0, places=6)
+        self.assertAlmostEqual(costs[1], calculate_distance(55.80, 37.60, 55.90, 37.60), places=6)
+
+    def test_dispatch_order_uses_cheapest_route(self):
+        """Test that a single new order goes to the courier whose route it fits best"""
+        Order.objects.create(
+            customer=self.customer1,
+            courier=self.moto_courier,
+            address='ул. Тверская, 20, Москва',
+            status='In Progress',
+            lat=Decimal('55.7700'),
+            lon=Decimal('37.6000'),
+            geocode_status='ok'
+        )
+        Order.objects.filter(id=self.order1.id).update(lat=Decimal('55.7650'), lon=Decimal('37.6050'), geocode_status='ok')
+        self.order1.refresh_from_db()
+
+        courier = dispatch_order(self.order1)
+
+        self.assertEqual(courier, self.moto_courier)
+        self.order1.refresh_from_db()
+        self.assertEqual(self.order1.courier, self.moto_courier)
+        self.assertEqual(self.order1.status, 'In Progress')
+        # The new order sits between the courier and the order further north
+        self.assertEqual(CourierRoute.objects.get(courier=self.moto_courier).stops[0], self.order1.id)
+
+    def test_dispatch_to_courier_fills_free_capacity(self):
+        """Test that a courier with free slots picks up the nearest unassigned orders"""
+        for i in range(4):
+            Order.objects.create(
+                customer=self.customer1,
+                courier=self.bike_courier,
+                address=f'Active Address {i}',
+                status='In Progress'
+            )
+        Order.objects.filter(id=self.order1.id).update(lat=Decimal('55.7540'), lon=Decimal('37.6210'), geocode_status='ok')
+        Order.objects.filter(id=self.order2.id).update(lat=Decimal('55.7600'), lon=Decimal('37.6300'), geocode_status='ok')
+
+        assigned = dispatch_to_courier(self.bike_courier)
+
+        self.assertEqual(assigned, [self.order1.id])
+        self.assertEqual(Order.objects.filter(courier=self.bike_courier, status='In Progress').count(), 5)
+
+    def test_incremental_dispatch_rechecks_capacity(self):
+        """Test that a courier filled by a concurrent dispatch is not pushed past the cap"""
+        Order.objects.filter(id=self.order1.id).update(lat=Decimal('55.7540'), lon=Decimal('37.6210'), geocode_status='ok')
+        self.order1.refresh_from_db()
+        stale = list(Courier.objects.filter(id=self.bike_courier.id))
+        Courier.objects.filter(id=self.bike_courier.id).update(active_orders=MAX_ACTIVE_ORDERS)
+
+        with mock.patch('orders.order_distribution.available_couriers_queryset', return_value=stale):
+            self.assertIsNone(dispatch_order(self.order1))
+        self.assertEqual(dispatch_to_courier(stale[0]), [])
+        self.assertFalse(Order.objects.filter(courier__isnull=False).exists())
+
+    def test_incremental_dispatch_requeues_instead_of_waiting_for_a_locked_courier(self):
+        """Test that a courier held by a batch run is retried on the distribution queue, once"""
+        Order.objects.filter(id=self.order1.id).update(lat=Decimal('55.7540'), lon=Decimal('37.6210'), geocode_status='ok')
+        self.order1.refresh_from_db()
+        couriers = list(Courier.objects.filter(id=self.bike_courier.id))
+
+        with mock.patch('orders.order_distribution.available_couriers_queryset', return_value=couriers), \
+                mock.patch('orders.order_distribution.lock_courier', return_value=None), \
+                mock.patch('orders.order_distribution.run_in_background') as run:
+            self.assertIsNone(dispatch_order(self.order1))
+            self.assertIsNone(dispatch_to_courier(couriers[0]))
+            self.assertIsNone(dispatch_order(self.order1, requeue=False))
+        self.assertEqual(run.call_args_list, [
+            mock.call(dispatch_order_task, self.order1.id, queue='distribution'),
+            mock.call(courier_freed_task, self.bike_courier.id, False, queue='distribution'),
+        ])
+        self.assertFalse(Order.objects.filter(courier__isnull=False).exists())
+
+    def test_distribution_stores_courier_routes(self):
+        """Test that the planned visiting order is stored and used to seed the next solve"""
+        self.moto_courier.delete()
+        self.bike_courier.delete()
+        Order.objects.filter(id=self.order1.id).update(lat=Decimal('55.7600'), lon=Decimal('37.6180'), geocode_status='ok')
+        Order.objects.filter(id=self.order2.id).update(lat=Decimal('55.7700'), lon=Decimal('37.6180'), geocode_status='ok')
+        Order.objects.filter(id=self.order3.id).update(lat=Decimal('55.7650'), lon=Decimal('37.6180'), geocode_status='ok')
+
+        distribute_orders(mode='per_courier')
+
+        route = CourierRoute.objects.get(courier=self.car_courier)
+        self.assertEqual(sorted(route.stops), sorted([self.order1.id, self.order2.id, self.order3.id]))
+        self.assertIn(route.stops[0], (self.order1.id, self.order2.id))
+        self.assertGreater(route.length_km, 0)
+        self.assertEqual(route.eta_minutes, sorted(route.eta_minutes))
+        self.assertEqual(route.duration_min, route.eta_minutes[-1])
+
+        new_order = Order.objects.create(
+            customer=self.customer1, address='Test Address', lat=Decimal('55.7610'), lon=Decimal('37.6190'),
+            geocode_status='ok'
+        )
+        with mock.patch('orders.order_distribution.solve_tsps', wraps=solve_tsps) as solve:
+            distribute_orders(mode='per_courier')
+        initial_routes = solve.call_args.args[2]
+        self.assertEqual(len(initial_routes[0]), 3)
+        self.assertIn(new_order.id, CourierRoute.objects.get(courier=self.car_courier).stops)
+
+    def test_benchmark_command(self):
+        """Test that the benchmark reports every mode and leaves no synthetic rows behind"""
+        couriers, orders = Courier.objects.count(), Order.objects.count()
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'benchmark.json')
+            call_command('benchmark_dispatch', '--couriers', '4', '--orders', '12', '--output', output, stdout=StringIO())
+            with open(output, encoding='utf-8') as f:
+                report = json.load(f)
+
+        self.assertEqual([result['mode'] for result in report['results']], list(DISTRIBUTION_MODES))
+        for result in report['results']:
+            self.assertGreater(result['assigned'], 0)
+            self.assertGreater(result['route_km'], 0)
+            self.assertIn('solve', result['phase_seconds'])
+        self.assertEqual((Courier.objects.count(), Order.objects.count()), (couriers, orders))
+
+    def test_snapshot_is_recorded_and_replayed(self):
+        """Test that a run writes its inputs to a snapshot that replays offline under a profiler"""
+        for order, (lat, lon) in zip((self.order1, self.order2, self.order3),
+                                     (('55.7570', '37.6150'), ('55.7500', '37.5930'), ('55.7600', '37.6400'))):
+            Order.objects.filter(id=order.id).update(lat=Decimal(lat), lon=Decimal(lon), geocode_status='ok')
+        active = Order.objects.create(
+            customer=self.customer1, address='Test Address', lat=Decimal('55.7610'), lon=Decimal('37.6190'),
+            geocode_status='ok', courier=self.car_courier, status='In Progress'
+        )
+        CourierRoute.objects.create(courier=self.car_courier, stops=[active.id])
+
+        cars = DispatchPartition('Автомобиль', vehicle='Автомобиль')
+        with tempfile.TemporaryDirectory() as tmp:
+            with override_settings(DISPATCH_SNAPSHOT_DIR=tmp):
+                result = distribute_orders(mode='global', dry_run=True, partition=cars)
+            path = DispatchRun.objects.get(id=result['run_id']).stats['orders']['snapshot']
+            snapshot = Snapshot.load(path)
+            self.assertEqual(snapshot.meta['mode'], 'global')
+            self.assertEqual(snapshot.meta['partition']['vehicle'], 'Автомобиль')
+            self.assertEqual(snapshot['courier_ids'].tolist(), [self.car_courier.id])
+            self.assertEqual(sorted(snapshot['order_ids'].tolist()), sorted([self.order1.id, self.order2.id, self.order3.id]))
+            self.assertEqual(snapshot['active_ids'].tolist(), [active.id])
+            self.assertEqual(snapshot['route_stops'].tolist(), [active.id])
+            self.assertFalse(np.isnan(snapshot['order_points']).any())
+
+            # The live couriers and orders stay in the database but take no part in the replay
+            output = os.path.join(tmp, 'replay.json')
+            call_command('replay_dispatch', path, '--modes', 'global,per_courier', '--profile', 'cpu',
+                         '--output', output, stdout=StringIO())
+            with open(output, encoding='utf-8') as f:
+                report = json.load(f)
+
+        self.assertEqual([result['mode'] for result in report['results']], ['global', 'per_courier'])
+        for result in report['results']:
+            self.assertEqual(result['assigned'], 3)
+            self.assertIn('function calls', result['profile'])
+        self.assertEqual((Courier.objects.count(), Order.objects.count()), (3, 4))
+        self.assertEqual(list(Order.objects.filter(courier__isnull=False).values_list('id', flat=True)), [active.id])
+
+    @override_settings(
+        ORDERS_BACKGROUND_TASKS=False,
+        ORDER_INCREMENTAL_DISPATCH=True,
+        ORDER_BATCH_DISPATCH={'enabled': True, 'window_seconds': 60, 'max_batch': 2},
+    )
+    def test_new_orders_are_dispatched_in_batches(self):
+        """Test that new orders wait for their batch and are then solved together"""
+        Order.objects.filter(id=self.order1.id).update(lat=Decimal('55.7570'), lon=Decimal('37.6150'), geocode_status='ok')
+        Order.objects.filter(id=self.order2.id).update(lat=Decimal('55.7500'), lon=Decimal('37.5930'), geocode_status='ok')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            order_created_task(self.order1.id)
+        self.assertFalse(Order.objects.filter(courier__isnull=False).exists())
+        self.assertEqual(batching.queued_orders(), [self.order1.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            order_created_task(self.order2.id)
+        # order3 was never queued, so the batch leaves it alone
+        self.assertEqual(
+            set(Order.objects.filter(courier__isnull=False).values_list('id', flat=True)),
+            {self.order1.id, self.order2.id}
+        )
+        self.assertFalse(batching.get_batch_scheduler().pending)
+        self.assertEqual(batching.queued_orders(), [])
+
+    @override_settings(
+        ORDERS_BACKGROUND_TASKS=False,
+        ORDER_INCREMENTAL_DISPATCH=True,
+        ORDER_BATCH_DISPATCH={'enabled': True, 'window_seconds': 60, 'max_batch': 3},
+    )
+    def test_batches_are_shared_between_processes_and_restarts(self):
+        """Test that orders queued by another or a restarted process are picked up from the database"""
+        Order.objects.filter(courier__isnull=True).update(lat=Decimal('55.7540'), lon=Decimal('37.6200'), geocode_status='ok')
+        # Queued by a process that went away before its window closed
+        Order.objects.filter(id=self.order1.id).update(batch_due_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(batching.get_batch_scheduler().pending, [self.order1.id])
+        with self.captureOnCommitCallbacks(execute=True):
+            order_created_task(self.order2.id)
+        self.assertFalse(Order.objects.filter(courier__isnull=False).exists())
+
+        # Flushing here also takes the order queued elsewhere
+        batching.dispatch_batch([self.order2.id])
+        self.assertEqual(
+            set(Order.objects.filter(courier__isnull=False).values_list('id', flat=True)),
+            {self.order1.id, self.order2.id}
+        )
+        self.assertEqual(batching.queued_orders(), [])
+
+    def test_distribution_run_is_recorded(self):
+        """Test that every run stores a summary with per-phase stats and feeds the histograms"""
+        Order.objects.filter(id=self.order1.id).update(lat=Decimal('55.7570'), lon=Decimal('37.6150'), geocode_status='ok')
+        Order.objects.filter(id=self.order2.id).update(lat=Decimal('55.7500'), lon=Decimal('37.5930'), geocode_status='ok')
+        Order.objects.filter(id=self.order3.id).update(geocode_status='failed')
+        runs_before = instrumentation.RUN_SECONDS.snapshot()['series']
+
+        result = distribute_orders(mode='global', profile='cpu')
+
+        run = DispatchRun.objects.get(id=result['run_id'])
+        self.assertEqual((run.mode, run.assigned_count, run.profile_mode), ('global', 2, 'cpu'))
+        self.assertEqual(set(run.phase_timings), set(result['phase_timings']))
+        self.assertEqual(run.stats['orders']['claimed'], 3)
+        self.assertIn('hit_ratio', run.stats['geocoding'])
+        self.assertEqual(run.stats['solve']['routing_success'], 1)
+        self.assertGreater(run.stats['solve']['objective'], 0)
+        self.assertEqual(run.stats['persist']['assigned'], 2)
+        self.assertIn('function calls', run.profile)
+
+        series = {tuple(s['labels'].items()): s['count'] for s in instrumentation.RUN_SECONDS.snapshot()['series']}
+        before = {tuple(s['labels'].items()): s['count'] for s in runs_before}
+        self.assertEqual(series[(('mode', 'global'),)], before.get((('mode', 'global'),), 0) + 1)
+
+    def test_save_assignments_in_batches(self):
+        """Test that a dispatch plan is saved with a fixed number of queries and skips taken orders"""
+        Order.objects.filter(id=self.order2.id).update(courier=self.bike_courier, status='In Progress')
+        plan = {
+            self.order1.id: self.car_courier.id,
+            self.order2.id: self.car_courier.id,
+            self.order3.id: self.moto_courier.id,
+        }
+
+        # savepoint, lock query, update, counters, release
+        with self.assertNumQueries(5):
+            assigned = save_assignments(plan)
+
+        self.assertEqual(set(assigned), {self.order1.id, self.order3.id})
+        self.assertEqual(
+            dict(Order.objects.filter(status='In Progress').values_list('id', 'courier_id')),
+            {self.order1.id: self.car_courier.id, self.order2.id: self.bike_courier.id, self.order3.id: self.moto_courier.id}
+        )
+        self.assertEqual(
+            dict(Courier.objects.values_list('id', 'active_orders')),
+            # order2 was put in progress with a raw update, which bypasses the counter
+            {self.car_courier.id: 1, self.bike_courier.id: 0, self.moto_courier.id: 1}
+        )
+
+    def test_save_assignments_skips_orders_taken_after_the_lock(self):
+        """Test that an order taken between the lock query and the update is neither overwritten nor counted"""
+        plan = {self.order1.id: self.car_courier.id, self.order3.id: self.moto_courier.id}
+
+        def lock_query(**filters):
+            locked = list(Order.objects.filter(**filters).values_list('id', flat=True))
+            # Another dispatcher gets there first; the lock does not stop it on SQLite
+            Order.objects.filter(id=self.order3.id).update(courier=self.bike_courier, status='In Progress')
+            return mock.Mock(values_list=mock.Mock(return_value=locked))
+
+        with mock.patch.object(Order.objects, 'select_for_update', return_value=mock.Mock(filter=lock_query)):
+            assigned = save_assignments(plan)
+
+        self.assertEqual(assigned, [self.order1.id])
+        self.assertEqual(Order.objects.get(id=self.order3.id).courier_id, self.bike_courier.id)
+        self.assertEqual(
+            dict(Courier.objects.values_list('id', 'active_orders')),
+            {self.car_courier.id: 1, self.bike_courier.id: 0, self.moto_courier.id: 0}
+        )
+
+    def test_active_order_counter_follows_status_changes(self):
+        """Test that the counter follows assignment, reassignment, delivery and deletion and survives courier saves"""
+        order = Order.objects.get(id=self.order1.id)
+        order.courier, order.status = self.car_courier, 'In Progress'
+        order.save()
+        Order.objects.create(customer=self.customer1, courier=self.car_courier, status='In Progress', address='Адрес')
+        stale_car = Courier.objects.get(id=self.car_courier.id)
+        self.assertEqual(stale_car.active_orders, 2)
+
+        order.courier = self.bike_courier
+        order.save()
+        # Courier and admin both mark it delivered from copies loaded earlier: one transition
+        other_copy = Order.objects.get(id=order.id)
+        order.status = 'Delivered'
+        order.save()
+        other_copy.status = 'Delivered'
+        other_copy.save()
+        Order.objects.filter(courier=self.car_courier).delete()
+        # Saving a copy loaded before these changes must not restore its old count
+        stale_car.name = 'Сергей Волков-младший'
+        stale_car.save()
+
+        self.assertEqual(
+            dict(Courier.objects.values_list('id', 'active_orders')),
+            {self.car_courier.id: 0, self.bike_courier.id: 0, self.moto_courier.id: 0}
+        )
+        self.assertEqual(Courier.objects.get(id=self.bike_courier.id).balance, Decimal('10.00'))
+
+    def test_reconcile_active_orders_command(self):
+        """Test that the reconcile command rebuilds drifted counters from the orders"""
+        Order.objects.filter(id__in=[self.order1.id, self.order2.id]).update(courier=self.moto_courier, status='In Progress')
+        Courier.objects.filter(id=self.car_courier.id).update(active_orders=3)
+
+        out = StringIO()
+        call_command('reconcile_active_orders', '--dry-run', stdout=out)
+        self.assertIn('Расхождений найдено: 2', out.getvalue())
+        self.assertEqual(Courier.objects.get(id=self.car_courier.id).active_orders, 3)
+
+        call_command('reconcile_active_orders', stdout=StringIO())
+        self.assertEqual(
+            dict(Courier.objects.values_list('id', 'active_orders')),
+            {self.car_courier.id: 0, self.bike_courier.id: 0, self.moto_courier.id: 2}
+        )
+
     def test_courier_balance_update(self):
         """Test courier balance update when order is delivered"""
         # Assign order to courier
@@ -145,4 +747,565 @@ class OrderDistributionTests(TestCase):
         
         # Check that courier's balance was updated
         self.car_courier.refresh_from_db()
-        self.assertEqual(self.car_courier.balance, Decimal('10.00')) 
\ No newline at end of file
+        self.assertEqual(self.car_courier.balance, Decimal('10.00'))
+
+
+class DistanceMatrixTests(SimpleTestCase):
+    points = np.array([
+        [55.7558, 37.6173],
+        [55.7517, 37.6178],
+        [55.7539, 37.6208],
+        [59.9343, 30.3351],
+    ])
+
+    def test_matches_scalar_distance(self):
+        """Test that the vectorized matrix agrees with calculate_distance"""
+        locations = [{'order_id': i, 'lat': lat, 'lon': lon} for i, (lat, lon) in enumerate(self.points)]
+        matrix = create_distance_matrix(locations)
+        for i, (lat1, lon1) in enumerate(self.points):
+            for j, (lat2, lon2) in enumerate(self.points):
+                self.assertAlmostEqual(matrix[i, j], calculate_distance(lat1, lon1, lat2, lon2), places=6)
+
+    def test_symmetric_and_float32(self):
+        """Test the symmetric-only mode and float32 output"""
+        full = haversine_matrix(self.points)
+        np.testing.assert_allclose(haversine_matrix(self.points, symmetric=True), full)
+
+        compact = haversine_matrix(self.points, dtype=np.float32, symmetric=True)
+        self.assertEqual(compact.dtype, np.float32)
+        np.testing.assert_allclose(compact, full, rtol=1e-4, atol=1e-3)
+
+    def test_rectangular_block(self):
+        """Test origin x destination blocks"""
+        block = haversine_matrix(self.points[:2], self.points[1:])
+        self.assertEqual(block.shape, (2, 3))
+        np.testing.assert_allclose(block, haversine_matrix(self.points)[:2, 1:])
+        with self.assertRaises(ValueError):
+            haversine_matrix(self.points[:2], self.points, symmetric=True)
+
+
+class SolverSettingsTests(SimpleTestCase):
+    def route_length(self, matrix, route):
+        return sum(matrix[a][b] for a, b in zip(route, route[1:]))
+
+    def test_exact_solver_is_optimal(self):
+        """Test the dynamic programme against brute force on small instances"""
+        rng = np.random.default_rng(0)
+        for size in range(2, 9):
+            matrix = rng.random((size, size)) * 10
+            route = solve_tsp_exact(matrix)
+            self.assertEqual(route[0], 0)
+            self.assertEqual(route[-1], 0)
+            self.assertEqual(sorted(route[1:-1]), list(range(1, size)))
+            best = min(
+                self.route_length(matrix, [0, *order, 0])
+                for order in itertools.permutations(range(1, size))
+            )
+            self.assertAlmostEqual(self.route_length(matrix, route), best)
+
+    def test_small_routes_skip_the_routing_solver(self):
+        """Test that tiny instances never build an OR-Tools model"""
+        matrix = haversine_matrix(np.array([[55.75, 37.61], [55.76, 37.62], [55.74, 37.60]]))
+        with mock.patch('orders.order_distribution.pywrapcp.RoutingModel') as routing_model:
+            route = solve_tsp(matrix)
+        routing_model.assert_not_called()
+        self.assertEqual(len(route), 4)
+
+    def test_limits_scale_with_problem_size(self):
+        """Test time limits and guided local search thresholds"""
+        solver_settings = SolverSettings(time_limit_per_node=0.1, min_time_limit=1.0, max_time_limit=30.0,
+                                         solutions_per_node=10, guided_local_search_min_nodes=15)
+        self.assertEqual(solver_settings.time_limit(5), 1.0)
+        self.assertAlmostEqual(solver_settings.time_limit(100), 10.0)
+        self.assertEqual(solver_settings.time_limit(1000), 30.0)
+        self.assertEqual(solver_settings.solution_limit(20), 200)
+        self.assertFalse(solver_settings.use_guided_local_search(10))
+        self.assertTrue(solver_settings.use_guided_local_search(20))
+
+    def test_larger_route_with_guided_local_search(self):
+        """Test that the metaheuristic path returns a complete tour within its budget"""
+        points = np.random.default_rng(1).random((20, 2)) * 0.1 + [55.7, 37.5]
+        solver_settings = SolverSettings(min_time_limit=0.5, max_time_limit=0.5, lack_of_improvement_seconds=0.2)
+        route = solve_tsp(haversine_matrix(points), solver_settings)
+        self.assertEqual(sorted(route[1:-1]), list(range(1, 20)))
+
+
+    @override_settings(ORDER_SOLVER_PROCESSES=2)
+    def test_solver_pool_matches_inline_solves(self):
+        """Test that routes solved in worker processes come back complete and in input order"""
+        self.addCleanup(solver_pool.shutdown_pool)
+        rng = np.random.default_rng(2)
+        matrices = [haversine_matrix(rng.random((size, 2)) * 0.1 + [55.7, 37.5]) for size in (12, 3, 10)]
+        solver_settings = SolverSettings(min_time_limit=0.2, max_time_limit=0.2)
+
+        routes = solver_pool.solve_tsps(matrices, solver_settings)
+
+        self.assertIsNotNone(solver_pool._pool)
+        for matrix, route in zip(matrices, routes):
+            self.assertEqual(sorted(route[1:-1]), list(range(1, len(matrix))))
+
+        # Whole routing models go to the workers too: node 0 is the depot, node 1 the courier
+        problems = [
+            {'distance_matrix': matrix, 'vehicle_starts': [1], 'capacities': [len(matrix) - 2]}
+            for matrix in (matrices[0], matrices[2])
+        ]
+        for matrix, vrp_routes in zip((matrices[0], matrices[2]), solver_pool.solve_vrps(problems, solver_settings)):
+            self.assertEqual(sorted(vrp_routes[0]), list(range(2, len(matrix))))
+
+    def test_warm_start_from_previous_route(self):
+        """Test that a solve seeded with a stored route returns a complete tour that is no worse"""
+        points = np.random.default_rng(3).random((20, 2)) * 0.1 + [55.7, 37.5]
+        matrix = haversine_matrix(points)
+        solver_settings = SolverSettings(min_time_limit=0.3, max_time_limit=0.3, lack_of_improvement_seconds=0.1)
+        cold = solve_tsp(matrix, solver_settings)
+
+        # A partial route is completed by cheapest insertion
+        warm = solve_tsp(matrix, solver_settings, initial_route=cold[1:-1][:10])
+        self.assertEqual(sorted(warm[1:-1]), list(range(1, 20)))
+        warm = solve_tsp(matrix, solver_settings, initial_route=cold[1:-1])
+        self.assertLessEqual(self.route_length(matrix, warm), self.route_length(matrix, cold) + 1e-9)
+
+
+class DispatchTraceTests(SimpleTestCase):
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = instrumentation.Histogram('test_seconds', 'Test', (0.1, 1))
+        for value in (0.05, 0.5, 0.7, 3):
+            histogram.observe(value, phase='solve')
+        series = histogram.snapshot()['series'][0]
+        self.assertEqual(series['buckets'], {'0.1': 1, '1': 3, '+Inf': 4})
+        self.assertEqual(series['count'], 4)
+        self.assertAlmostEqual(series['sum'], 4.25)
+
+    def test_trace_collects_nested_reports(self):
+        """Test that code called during a run reports into its trace and is silent otherwise"""
+        trace = instrumentation.DispatchTrace()
+        with trace.run():
+            with instrumentation.current_trace().phase('solve'):
+                instrumentation.current_trace().record('solve', objective=1.5, models=1)
+                instrumentation.current_trace().record('solve', objective=2.0, models=1)
+        instrumentation.current_trace().record('solve', objective=100)
+
+        self.assertEqual(trace.attributes, {'solve': {'objective': 3.5, 'models': 2}})
+        self.assertIn('solve', trace.timings)
+        self.assertGreaterEqual(trace.duration, trace.timings['solve'])
+
+    def test_memory_profile(self):
+        trace = instrumentation.DispatchTrace(profile='memory')
+        with trace.run():
+            [bytearray(1024) for _ in range(100)]
+        self.assertIn('peak', trace.profile)
+
+
+class RoadNetworkTests(SimpleTestCase):
+    def setUp(self):
+        # Two banks of a river along 55.75 and 55.76 with the only bridge at 37.70,
+        # and a one-way street going south at 37.62
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, 'roads.geojson')
+        features = [
+            {'geometry': {'type': 'LineString', 'coordinates': [[37.60, 55.75], [37.62, 55.75], [37.65, 55.75], [37.70, 55.75]]}},
+            {'geometry': {'type': 'LineString', 'coordinates': [[37.60, 55.76], [37.62, 55.76], [37.65, 55.76], [37.70, 55.76]]}},
+            {'geometry': {'type': 'LineString', 'coordinates': [[37.70, 55.75], [37.70, 55.76]]}},
+            {'geometry': {'type': 'LineString', 'coordinates': [[37.62, 55.76], [37.62, 55.755], [37.62, 55.75]]}, 'properties': {'oneway': 'yes'}},
+            {'geometry': {'type': 'Point', 'coordinates': [37.60, 55.75]}},
+        ]
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump({'type': 'FeatureCollection', 'features': features}, f)
+
+    def test_distances_follow_roads(self):
+        network = road_network.RoadNetwork.load(self.path)
+        self.assertEqual(network.node_count, 9)
+        points = [(55.7501, 37.60), (55.7599, 37.60), (55.7599, 37.62), (55.755, 37.6201)]
+        matrix = network.distance_matrix(points)
+        straight = haversine_matrix(points)
+
+        # Crossing the river means going round by the bridge
+        self.assertGreater(matrix[0, 1], 10 * straight[0, 1])
+        # The one-way street can only be driven southwards
+        self.assertAlmostEqual(matrix[2, 3], straight[2, 3], delta=0.05)
+        self.assertGreater(matrix[3, 2], 10 * straight[3, 2])
+        np.testing.assert_allclose(np.diag(matrix), 0)
+        # Few targets are searched backwards from the targets, with the same result
+        np.testing.assert_allclose(network.distance_block(points, points[2:]), network.distance_block(points)[:, 2:])
+
+    def test_points_off_the_network_use_straight_lines(self):
+        network = road_network.RoadNetwork.load(self.path)
+        points = [(55.7501, 37.60), (55.90, 37.90)]
+        nodes, _ = network.snap(points)
+        self.assertEqual(nodes[1], -1)
+        np.testing.assert_allclose(network.distance_matrix(points), haversine_matrix(points))
+
+    def test_parsed_graph_is_cached(self):
+        network = road_network.RoadNetwork.load(self.path)
+        self.assertTrue(os.path.exists(road_network.cache_path(self.path)))
+        with mock.patch.object(road_network.RoadNetwork, 'from_geojson') as parse:
+            cached = road_network.RoadNetwork.load(self.path)
+        parse.assert_not_called()
+        np.testing.assert_array_equal(cached.indptr, network.indptr)
+        np.testing.assert_allclose(cached.weights, network.weights)
+
+    def test_selected_as_distance_provider(self):
+        locations = [{'lat': 55.7501, 'lon': 37.60}, {'lat': 55.7599, 'lon': 37.60}]
+        with override_settings(DISTANCE_PROVIDER='road_network', ROAD_NETWORK={'path': self.path}):
+            road = create_distance_matrix(locations)
+            self.assertEqual(VehicleProfile.for_vehicle('Автомобиль').detour_factor, 1.0)
+            with override_settings(DISTANCE_CACHE={'enabled': True, 'dir': self.tmp.name}):
+                provider = road_network.get_distance_provider()
+                self.assertIsInstance(provider, distance_cache.CachedDistances)
+                np.testing.assert_allclose(create_distance_matrix(locations), road)
+        self.assertGreater(road[0, 1], 10 * create_distance_matrix(locations)[0, 1])
+
+
+class BatchSchedulerTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.batches = []
+        self.deferred = []
+
+    def make_scheduler(self, solve_seconds=0.0, **options):
+        def dispatch(batch):
+            self.batches.append(batch)
+            self.now += solve_seconds
+
+        scheduler = batching.BatchScheduler(
+            dispatch, clock=lambda: self.now, run=lambda func, *args: self.deferred.append((func, args)), **options
+        )
+        self.addCleanup(scheduler.cancel)
+        return scheduler
+
+    def run_deferred(self):
+        while self.deferred:
+            func, args = self.deferred.pop(0)
+            func(*args)
+
+    def test_flushes_when_full_or_when_window_closes(self):
+        scheduler = self.make_scheduler(window_seconds=30, max_batch=3)
+        for order_id in (1, 2, 3, 4):
+            scheduler.add(order_id)
+        self.run_deferred()
+        self.assertEqual(self.batches, [[1, 2, 3]])
+
+        self.now += 29
+        self.assertFalse(scheduler.flush_due())
+        self.now += 1
+        self.assertTrue(scheduler.flush_due())
+        self.run_deferred()
+        self.assertEqual(self.batches, [[1, 2, 3], [4]])
+
+    def test_slow_solves_stretch_the_window_and_bound_the_backlog(self):
+        scheduler = self.make_scheduler(solve_seconds=90, window_seconds=30, max_batch=2, max_pending=3)
+        scheduler.add(1)
+        self.now += 30
+        scheduler.flush_due()
+
+        # Orders arriving during the solve wait, even when a batch is full
+        for order_id in (2, 3, 4):
+            self.assertTrue(scheduler.add(order_id))
+        self.assertFalse(scheduler.add(5))
+        self.assertEqual(len(self.deferred), 1)
+
+        func, args = self.deferred.pop(0)
+        func(*args)
+        self.assertEqual(scheduler.window, 90)
+        self.assertEqual(self.batches, [[1]])
+        # The full batch started as soon as the solver was free; the rest waits
+        self.assertEqual(len(self.deferred), 1)
+        self.assertEqual(scheduler.pending, [4])
+
+        # The remainder waits for the stretched window, not the configured one
+        self.deferred.clear()
+        scheduler.solving = False
+        self.now += 30
+        self.assertFalse(scheduler.flush_due())
+        self.now += 60
+        self.assertTrue(scheduler.flush_due())
+
+
+class DistanceCacheTests(SimpleTestCase):
+    class CountingProvider:
+        """Straight-line distances that remember how many sources were computed"""
+
+        def __init__(self):
+            self.sources = 0
+
+        def distance_block(self, origins, destinations):
+            # A road network searches from the smaller side
+            self.sources += min(len(origins), len(destinations))
+            return haversine_matrix(origins, destinations)
+
+        def pair_distances(self, origins, destinations):
+            self.sources += len(origins)
+            return np.diag(haversine_matrix(origins, destinations))
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.points = np.array([(55.75, 37.60), (55.76, 37.61), (55.77, 37.63), (55.74, 37.65)])
+
+    def make_cache(self):
+        return distance_cache.DistanceCache(self.tmp.name, persist_interval=0)
+
+    def test_repeated_matrix_is_served_from_memory(self):
+        provider = self.CountingProvider()
+        cached = distance_cache.CachedDistances(provider, self.make_cache())
+        first = cached.distance_matrix(self.points)
+        self.assertEqual(provider.sources, 4)
+
+        # The same places, a few metres off, and one new point
+        points = np.vstack([self.points + 0.00001, [(55.78, 37.66)]])
+        second = cached.distance_matrix(points)
+        self.assertEqual(provider.sources, 6)
+        np.testing.assert_allclose(second[:4, :4], first)
+        np.testing.assert_allclose(second, haversine_matrix(points), atol=0.01)
+        stats = cached.cache.stats()
+        self.assertEqual(stats['memory_hits'], 12)
+        self.assertEqual(stats['misses'], 4 * 3 + 2 * 4)
+
+    def test_persisted_table_is_shared(self):
+        provider = self.CountingProvider()
+        cached = distance_cache.CachedDistances(provider, self.make_cache())
+        expected = cached.distance_matrix(self.points)
+        self.assertTrue(cached.cache.persist())
+
+        # Another process: empty memory tier, same directory
+        other = distance_cache.CachedDistances(self.CountingProvider(), self.make_cache())
+        np.testing.assert_allclose(other.distance_matrix(self.points), expected, rtol=1e-6)
+        self.assertEqual(other.provider.sources, 0)
+        self.assertIsInstance(other.cache.disk.table, np.memmap)
+        self.assertEqual(other.cache.stats()['disk_hits'], 12)
+        np.testing.assert_allclose(other.path_lengths(self.points), np.diag(expected, 1), rtol=1e-6)
+        self.assertEqual(other.provider.sources, 0)
+
+    def test_seen_points_stay_bounded(self):
+        cache = distance_cache.DistanceCache(self.tmp.name, disk_points=2, persist_interval=0)
+        points = np.column_stack([np.linspace(55.0, 56.0, 20), np.full(20, 37.6)])
+        keys = cache.keys(points)
+        for _ in range(3):
+            cache.lookup(keys[:2], keys[:2])
+        cache.lookup(keys, keys[:1])
+        self.assertLessEqual(len(cache._seen), distance_cache.SEEN_LIMIT * 2)
+
+        cache.store(keys[:2], keys[:2], np.ones((2, 2)))
+        self.assertTrue(cache.persist())
+        # Only the points that made the table are still counted, at half their count
+        self.assertEqual(dict(cache._seen), {keys[0]: 2, keys[1]: 2})
+
+    def test_concurrent_publishes_are_merged_and_old_generations_swept(self):
+        # Two processes start before either has published and learn different pairs
+        first = distance_cache.CachedDistances(self.CountingProvider(), self.make_cache())
+        second = distance_cache.CachedDistances(self.CountingProvider(), self.make_cache())
+        first.distance_matrix(self.points[:2])
+        second.distance_matrix(self.points[2:])
+        directory = first.cache.disk.directory
+        # Left behind by a process that crashed mid-publish
+        np.save(os.path.join(directory, 'distances.1-99999.table.npy'), np.zeros((1, 1)))
+        self.assertTrue(first.cache.persist())
+        self.assertTrue(second.cache.persist())
+
+        reader = distance_cache.CachedDistances(self.CountingProvider(), self.make_cache())
+        reader.distance_matrix(self.points[:2])
+        reader.distance_matrix(self.points[2:])
+        self.assertEqual(reader.provider.sources, 0)
+        generation = reader.cache.disk.generation
+        self.assertEqual(
+            sorted(name for name in os.listdir(directory) if name.startswith('distances.')),
+            [f'distances.{generation}.points.npy', f'distances.{generation}.table.npy']
+        )
+
+
+class TravelTimeTests(SimpleTestCase):
+    @override_settings(VEHICLE_PROFILES={'Велосипед': {'speed_kmh': 15.0, 'detour_factor': 1.25}},
+                       DEFAULT_VEHICLE_PROFILE={'speed_kmh': 30.0})
+    def test_profiles_and_cached_matrices(self):
+        """Test minutes per km per vehicle and that each vehicle type gets one cached matrix"""
+        self.assertAlmostEqual(VehicleProfile.for_vehicle('Велосипед').minutes_per_km, 5.0)
+        self.assertAlmostEqual(VehicleProfile.for_vehicle('Самокат').minutes_per_km, 2.6)
+
+        travel_times = TravelTimes(np.array([[0.0, 3.0], [3.0, 0.0]]))
+        bike = travel_times.for_vehicle('Велосипед')
+        self.assertIs(travel_times.for_vehicle('Велосипед'), bike)
+        self.assertAlmostEqual(bike[0, 1], 15.0)
+
+class GridIndexTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(2)
+        self.coords = rng.random((500, 2)) * [0.3, 0.5] + [55.6, 37.4]
+        self.ids = list(range(1000, 1500))
+        self.index = GridIndex(self.coords, self.ids, cell_km=0.5)
+
+    def brute_force(self, lat, lon, k, radius_km, exclude=()):
+        distances = haversine_matrix([[lat, lon]], self.coords)[0]
+        order = [i for i in np.argsort(distances, kind='stable')
+                 if distances[i] <= radius_km and self.ids[i] not in exclude]
+        return [self.ids[i] for i in order[:k]]
+
+    def test_nearest_matches_brute_force(self):
+        """Test k-nearest queries within a radius against a full scan"""
+        for lat, lon in [(55.75, 37.62), (55.61, 37.41), (55.95, 37.95)]:
+            for k, radius in [(1, 5.0), (5, 2.0), (20, 50.0)]:
+                self.assertEqual(self.index.nearest(lat, lon, k, radius), self.brute_force(lat, lon, k, radius))
+
+    def test_removed_points_are_skipped(self):
+        """Test that assigned orders disappear from later queries"""
+        first = self.index.nearest(55.75, 37.62, 3, 10.0)
+        for order_id in first:
+            self.index.remove(order_id)
+        self.assertEqual(len(self.index), 497)
+        self.assertEqual(self.index.nearest(55.75, 37.62, 3, 10.0), self.brute_force(55.75, 37.62, 3, 10.0, set(first)))
+        self.assertEqual(self.index.first(2), [i for i in self.ids if i not in first][:2])
+
+
+class OrderQueueTests(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        customer = Customer.objects.create(name='Иван Петров', email='ivan@example.com', phone='+79991234567', address='ул. Ленина, 1')
+        self.orders = {}
+        for name, age_minutes, deliver_in in [('a', 10, None), ('b', 90, None), ('c', 30, None), ('d', 5, 1), ('e', 30, None)]:
+            order = Order.objects.create(customer=customer, address=f'Адрес {name}')
+            Order.objects.filter(id=order.id).update(
+                created_at=now.replace(microsecond=0) - timedelta(minutes=age_minutes),
+                deliver_by=now + timedelta(minutes=deliver_in) if deliver_in else None
+            )
+            self.orders[name] = Order.objects.get(id=order.id)
+
+    def test_orders_come_by_due_time_in_windows(self):
+        """Test that the queue serves the most urgent orders first, one query per window"""
+        queue = OrderQueue(Order.objects.all(), window=2)
+        expected = [self.orders[name].id for name in 'bdcea']
+
+        with self.assertNumQueries(3):
+            self.assertEqual([order.id for order in queue], expected)
+        with self.assertNumQueries(2):
+            self.assertEqual([order.id for order in queue.take(3)], expected[:3])
+
+    @override_settings(ORDER_SLA_MINUTES=60)
+    def test_urgency_grows_with_age(self):
+        self.assertAlmostEqual(urgency(self.orders['b']), 1.5, places=2)
+        self.assertAlmostEqual(urgency(self.orders['a']), 10 / 60, places=2)
+        self.assertGreater(urgency(self.orders['d']), 0.95)
+
+
+class KMeansTests(SimpleTestCase):
+    def test_separates_areas(self):
+        """Test that k-means finds well separated groups of points"""
+        rng = np.random.default_rng(3)
+        centers = np.array([[55.75, 37.62], [55.60, 37.40], [55.90, 37.80]])
+        points = np.concatenate([center + rng.normal(scale=0.005, size=(40, 2)) for center in centers])
+
+        labels, centroids = kmeans(points, 3)
+
+        self.assertEqual(len(set(labels[:40])), 1)
+        self.assertEqual(len(set(labels)), 3)
+        for group in range(3):
+            np.testing.assert_allclose(centroids[labels[group * 40]], centers[group], atol=0.005)
+        np.testing.assert_array_equal(kmeans(points, 3)[0], labels)
+
+
+class GeocodeCacheTests(TestCase):
+    def setUp(self):
+        geocoding.clear_memory_cache()
+        self.addCleanup(geocoding.clear_memory_cache)
+        sleep_patcher = mock.patch('orders.geocoding.time.sleep')
+        sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+
+    def test_normalize_address(self):
+        """Test that formatting differences map to one cache key"""
+        self.assertEqual(
+            geocoding.normalize_address('Ул. Тверская,  1, Москва'),
+            geocoding.normalize_address('ул тверская 1 москва')
+        )
+
+    def test_repeated_lookup_hits_cache(self):
+        """Test that a resolved address is not requested twice"""
+        with mock.patch('orders.geocoding.NominatimGeocoder._request', return_value=(55.757, 37.615)) as request:
+            self.assertEqual(geocoding.geocode_address('ул. Тверская, 1, Москва'), (55.757, 37.615))
+            self.assertEqual(geocoding.geocode_address('ул. Тверская, 1, Москва'), (55.757, 37.615))
+            geocoding.clear_memory_cache()
+            self.assertEqual(geocoding.geocode_address('ул. Тверская, 1, Москва'), (55.757, 37.615))
+        self.assertEqual(request.call_count, 1)
+        self.assertEqual(GeocodeCache.objects.get().status, 'found')
+
+    def test_negative_result_is_cached(self):
+        """Test that unknown addresses are cached, transport errors are not"""
+        with mock.patch('orders.geocoding.NominatimGeocoder._request', return_value=None) as request:
+            self.assertIsNone(geocoding.geocode_address('Нет такого адреса'))
+            self.assertIsNone(geocoding.geocode_address('Нет такого адреса'))
+        self.assertEqual(request.call_count, 1)
+
+        with mock.patch('orders.geocoding.NominatimGeocoder._request', side_effect=ConnectionError) as request:
+            self.assertIsNone(geocoding.geocode_address('Другой адрес'))
+            self.assertIsNone(geocoding.geocode_address('Другой адрес'))
+        self.assertEqual(request.call_count, 2)
+        self.assertFalse(GeocodeCache.objects.filter(address='Другой адрес').exists())
+
+    def test_expired_entry_is_refreshed(self):
+        """Test that entries past their TTL are looked up again"""
+        GeocodeCache.objects.create(
+            address_key=geocoding.normalize_address('ул. Арбат, 20, Москва'),
+            address='ул. Арбат, 20, Москва',
+            status='found',
+            lat=Decimal('1.0'),
+            lon=Decimal('1.0'),
+            expires_at=timezone.now() - timedelta(minutes=1)
+        )
+        with mock.patch('orders.geocoding.NominatimGeocoder._request', return_value=(55.75, 37.59)) as request:
+            self.assertEqual(geocoding.geocode_address('ул. Арбат, 20, Москва'), (55.75, 37.59))
+        self.assertEqual(request.call_count, 1)
+
+    def test_batch_lookup_uses_cache_and_backend_batch(self):
+        """Test that a batch only sends uncached addresses to the backend, once per key"""
+        with mock.patch('orders.geocoding.NominatimGeocoder._request', return_value=(55.757, 37.615)):
+            geocoding.geocode_address('ул. Тверская, 1, Москва')
+        geocoding.clear_memory_cache()
+
+        with mock.patch('orders.geocoding.NominatimGeocoder.geocode_batch',
+                        side_effect=lambda addresses: {a: (55.75, 37.59) for a in addresses}) as batch:
+            results = geocoding.geocode_addresses([
+                'ул. Тверская, 1, Москва',
+                'ул. Арбат, 20, Москва',
+                'ул Арбат 20 Москва',
+            ])
+        batch.assert_called_once()
+        self.assertEqual(len(batch.call_args.args[0]), 1)
+        self.assertEqual(results['ул. Тверская, 1, Москва'], (55.757, 37.615))
+        self.assertEqual(results['ул Арбат 20 Москва'], (55.75, 37.59))
+        self.assertEqual(GeocodeCache.objects.count(), 2)
+
+
+class GazetteerGeocoderTests(TestCase):
+    def write_gazetteer(self, suffix, content):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_load_csv_and_jsonl(self):
+        """Test that both gazetteer formats load into the same index"""
+        csv_path = self.write_gazetteer('.csv', 'address,lat,lon\n"ул. Тверская, 1, Москва",55.757,37.615\n')
+        jsonl_path = self.write_gazetteer('.jsonl', json.dumps(
+            {'address': 'ул. Тверская, 1, Москва', 'lat': 55.757, 'lon': 37.615}, ensure_ascii=False) + '\n')
+        self.assertEqual(geocoding.load_gazetteer(csv_path), geocoding.load_gazetteer(jsonl_path))
+
+        geocoder = geocoding.GazetteerGeocoder(path=csv_path)
+        self.assertEqual(geocoder.geocode('УЛ. ТВЕРСКАЯ 1 МОСКВА'), (55.757, 37.615))
+        self.assertIsNone(geocoder.geocode('Неизвестный адрес'))
+
+    def test_geocode_orders_command_offline(self):
+        """Test bulk geocoding of pending orders with the offline backend"""
+        path = self.write_gazetteer('.csv', 'address,lat,lon\n"ул. Арбат, 20, Москва",55.750,37.593\n')
+        customer = Customer.objects.create(name='Иван Петров', email='ivan@example.com')
+        found = Order.objects.create(customer=customer, address='ул. Арбат, 20, Москва')
+        missing = Order.objects.create(customer=customer, address='Неизвестный адрес')
+
+        with override_settings(GEOCODER_BACKEND='gazetteer', GEOCODER_OPTIONS={'path': path}):
+            call_command('geocode_orders', stdout=StringIO())
+
+        found.refresh_from_db()
+        missing.refresh_from_db()
+        self.assertEqual(found.geocode_status, 'ok')
+        self.assertEqual(found.lat, Decimal('55.750'))
+        self.assertEqual(missing.geocode_status, 'failed')
+        self.assertFalse(GeocodeCache.objects.exists())
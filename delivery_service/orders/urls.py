@@ -8,6 +8,9 @@ from .views import (
     LoginView,
     UserProfileView,
     distribute_orders_view,
+    distribution_job_view,
+    apply_distribution_job_view,
+    dispatch_metrics_view,
     CourierRatingViewSet,
 )
 
@@ -24,4 +27,7 @@ urlpatterns = [
     path("login/", LoginView.as_view(), name="login"),
     path("users/me/", UserProfileView.as_view(), name="user-profile"),
     path('distribute-orders/', distribute_orders_view, name='distribute-orders'),
+    path('distribute-orders/<int:job_id>/', distribution_job_view, name='distribution-job'),
+    path('distribute-orders/<int:job_id>/apply/', apply_distribution_job_view, name='distribution-job-apply'),
+    path('metrics/dispatch/', dispatch_metrics_view, name='dispatch-metrics'),
 ] 
\ No newline at end of file
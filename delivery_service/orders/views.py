@@ -1,8 +1,8 @@
 from rest_framework import viewsets
-from .models import Customer,Courier, Order, User, CourierRating
+from .models import Customer,Courier, Order, User, CourierRating, DistributionJob, CourierRoute
 from rest_framework.decorators import action, api_view, permission_classes
 from .permissions import IsAdmin, IsCourier, IsCustomer, CanUpdateOrderStatus
-from .serializers import CustomerSerializer, CourierSerializer, OrderSerializer, RegisterSerializer, UserSerializer, CourierRatingSerializer, CourierWithRatingSerializer
+from .serializers import CustomerSerializer, CourierSerializer, OrderSerializer, RegisterSerializer, UserSerializer, CourierRatingSerializer, CourierWithRatingSerializer, DistributionJobSerializer, CourierRouteSerializer
 from django.shortcuts import render
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import status
@@ -10,7 +10,7 @@ from rest_framework.viewsets import ModelViewSet
 from django.views.generic import TemplateView
 from datetime import datetime, timedelta
 from django.utils.timezone import now
-from django.http import HttpResponseNotFound
+from django.http import HttpResponse, HttpResponseNotFound
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny, IsAuthenticated
@@ -18,7 +18,12 @@ import logging
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import authenticate
 from decimal import Decimal
-from .order_distribution import distribute_orders
+from .order_distribution import DISTRIBUTION_MODES, order_created_task, courier_freed_task
+from .instrumentation import PROFILE_MODES, metrics_snapshot, render_prometheus
+from .geocoding import geocode_order_task, get_cache_stats
+from .distance_cache import cache_stats as distance_cache_stats
+from .tasks import run_in_background
+from .jobs import apply_distribution_job, create_distribution_job, fail_stale_jobs
 from rest_framework.permissions import IsAdminUser
 from django.db.models import Avg
 from rest_framework.exceptions import PermissionDenied
@@ -134,6 +139,13 @@ class CourierViewSet(viewsets.ModelViewSet):
             return Response(serializer.data)
         return Response({'message': 'Нет курьеров с оценками'}, status=404)
 
+    @action(detail=True, methods=['get'], permission_classes=[IsAdmin | IsCourier])
+    def route(self, request, pk=None):
+        """Текущий маршрут курьера: заказы в порядке объезда (курьеру доступен только свой)"""
+        courier = self.get_object()
+        route = CourierRoute.objects.filter(courier=courier).first() or CourierRoute(courier=courier)
+        return Response(CourierRouteSerializer(route).data)
+
 class OrderViewSet(viewsets.ModelViewSet):
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
@@ -201,7 +213,7 @@ class OrderViewSet(viewsets.ModelViewSet):
             try:
                 # Get the customer instance for the current user
                 customer = Customer.objects.get(email=user.email)
-                serializer.save(customer=customer)
+                order = serializer.save(customer=customer)
             except Customer.DoesNotExist:
                 # If customer doesn't exist, create it
                 customer = Customer.objects.create(
@@ -209,9 +221,26 @@ class OrderViewSet(viewsets.ModelViewSet):
                     email=user.email,
                     phone=user.phone if hasattr(user, 'phone') else None
                 )
-                serializer.save(customer=customer)
+                order = serializer.save(customer=customer)
+        else:
+            order = serializer.save()
+        # Resolve coordinates once, right after creation, instead of on every dispatch
+        run_in_background(order_created_task, order.id)
+
+    def perform_update(self, serializer):
+        old_address = serializer.instance.address
+        old_state = Order.objects.filter(pk=serializer.instance.pk).values('status', 'courier_id').first()
+        new_address = serializer.validated_data.get('address', old_address)
+        if new_address != old_address:
+            order = serializer.save(lat=None, lon=None, geocode_status='pending')
+            run_in_background(geocode_order_task, order.id)
         else:
-            serializer.save()
+            order = serializer.save()
+
+        # A delivered or reassigned order frees a slot for the courier who had it
+        if old_state and old_state['status'] == 'In Progress' and old_state['courier_id'] and (
+                order.status != 'In Progress' or order.courier_id != old_state['courier_id']):
+            run_in_background(courier_freed_task, old_state['courier_id'])
 
     def create(self, request, *args, **kwargs):
         # Validate required fields
@@ -526,5 +555,60 @@ class CourierRatingViewSet(viewsets.ModelViewSet):
 @api_view(['POST'])
 @permission_classes([IsAdminUser])
 def distribute_orders_view(request):
-    result = distribute_orders()
-    return Response(result)
\ No newline at end of file
+    mode = request.data.get('mode')
+    if mode and mode not in DISTRIBUTION_MODES:
+        return Response(
+            {"error": f"Unknown distribution mode: {mode}"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    profile = request.data.get('profile')
+    if profile and profile not in PROFILE_MODES:
+        return Response(
+            {"error": f"Unknown profile mode: {profile}"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    dry_run = request.data.get('dry_run') in (True, 'true', '1', 1)
+    job = create_distribution_job(mode=mode, user=request.user, profile=profile, dry_run=dry_run)
+    return Response(
+        {
+            "job_id": job.id,
+            "status": job.status,
+            "message": "Расчет плана распределения запущен" if dry_run else "Распределение заказов запущено"
+        },
+        status=status.HTTP_202_ACCEPTED
+    )
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def distribution_job_view(request, job_id):
+    # Pollers of a job whose runner died see it fail instead of running forever
+    fail_stale_jobs()
+    job = DistributionJob.objects.filter(pk=job_id).first()
+    if job is None:
+        return Response({"error": "Distribution job not found"}, status=status.HTTP_404_NOT_FOUND)
+    return Response(DistributionJobSerializer(job).data)
+
+@api_view(['POST'])
+@permission_classes([IsAdminUser])
+def apply_distribution_job_view(request, job_id):
+    """Save the plan a dry-run job proposed, without solving again"""
+    job = DistributionJob.objects.filter(pk=job_id).first()
+    if job is None:
+        return Response({"error": "Distribution job not found"}, status=status.HTTP_404_NOT_FOUND)
+    if not job.dry_run:
+        return Response({"error": "Only dry-run jobs have a plan to apply"}, status=status.HTTP_400_BAD_REQUEST)
+    result = apply_distribution_job(job.id)
+    if 'error' in result:
+        return Response(result, status=status.HTTP_409_CONFLICT)
+    return Response(result)
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def dispatch_metrics_view(request):
+    """Dispatcher histograms of this process; ?output=prometheus for the text exposition format"""
+    if request.query_params.get('output') == 'prometheus':
+        return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4')
+    return Response({
+        "metrics": metrics_snapshot(),
+        "caches": {"geocoding": get_cache_stats(), "distance": distance_cache_stats()},
+    })
\ No newline at end of file
@@ -1,15 +1,37 @@
-import React from "react";
+import React, { useState } from "react";
 import { Button } from "@mui/material";
 import apiClient from "../utils/apiClient";
 
+const POLL_INTERVAL_MS = 1000;
+// The server fails jobs whose runner died; this only bounds the wait if it never answers
+const MAX_POLL_MS = 10 * 60 * 1000;
+
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
 const DistributeOrdersButton = () => {
+  const [running, setRunning] = useState(false);
+
   const handleDistribute = async () => {
+    setRunning(true);
     try {
       const response = await apiClient.post("distribute-orders/");
-      alert(response.data.message);
+      const jobId = response.data.job_id;
+      let job = response.data;
+      const deadline = Date.now() + MAX_POLL_MS;
+      while (job.status === "queued" || job.status === "running") {
+        if (Date.now() >= deadline) {
+          alert("Распределение еще выполняется, проверьте результат позже");
+          return;
+        }
+        await sleep(POLL_INTERVAL_MS);
+        job = (await apiClient.get(`distribute-orders/${jobId}/`)).data;
+      }
+      alert(job.message);
     } catch (error) {
       console.error("Error distributing orders:", error);
       alert("Ошибка при распределении заказов");
+    } finally {
+      setRunning(false);
     }
   };
 
@@ -18,9 +40,10 @@ const DistributeOrdersButton = () => {
       variant="contained"
       color="secondary"
       onClick={handleDistribute}
+      disabled={running}
       sx={{ ml: 2 }}
     >
-      Распределить заказы
+      {running ? "Распределение..." : "Распределить заказы"}
     </Button>
   );
 };
@@ -21,27 +21,39 @@ const TrackOrder = () => {
   const [address, setAddress] = useState(
     location.state?.address || "Загрузка..."
   );
+  const [coordinates, setCoordinates] = useState(null);
+  const [isOrderLoaded, setIsOrderLoaded] = useState(false);
   const [isMapLoading, setIsMapLoading] = useState(true);
   const [error, setError] = useState(null);
 
   useEffect(() => {
-    // If address is not provided in location.state, fetch it from the API
-    if (!location.state?.address) {
-      apiClient
-        .get(`/orders/${id}/`)
-        .then((response) => {
+    // Coordinates are resolved on the server when the order is created
+    apiClient
+      .get(`/orders/${id}/`)
+      .then((response) => {
+        if (!location.state?.address) {
           setAddress(response.data.address);
-        })
-        .catch((error) => {
-          console.error("Error fetching order:", error);
+        }
+        if (response.data.lat !== null && response.data.lon !== null) {
+          setCoordinates([Number(response.data.lat), Number(response.data.lon)]);
+        }
+      })
+      .catch((error) => {
+        console.error("Error fetching order:", error);
+        if (!location.state?.address) {
           setError("Не удалось загрузить адрес заказа");
           setAddress("Адрес не найден");
-        });
-    }
+        }
+      })
+      .finally(() => setIsOrderLoaded(true));
   }, [id, location.state]);
 
   useEffect(() => {
-    if (address === "Загрузка..." || address === "Адрес не найден") {
+    if (
+      !isOrderLoaded ||
+      address === "Загрузка..." ||
+      address === "Адрес не найден"
+    ) {
       return;
     }
 
@@ -53,30 +65,40 @@ const TrackOrder = () => {
         controls: ["zoomControl", "fullscreenControl"],
       });
 
+      const showPlacemark = (coords) => {
+        const placemark = new window.ymaps.Placemark(
+          coords,
+          {
+            balloonContent: `Адрес: ${address}`,
+          },
+          {
+            preset: "islands#blueDeliveryIcon",
+            iconColor: "#2563eb",
+          }
+        );
+        map.geoObjects.add(placemark);
+        map.setCenter(coords, 15);
+
+        // Add a smooth zoom animation
+        map.behaviors.disable("scrollZoom");
+        setTimeout(() => {
+          map.setZoom(16, { duration: 1000 });
+        }, 100);
+      };
+
+      if (coordinates) {
+        showPlacemark(coordinates);
+        setIsMapLoading(false);
+        return;
+      }
+
+      // Fall back to geocoding in the browser until the server has coordinates
       window.ymaps
         .geocode(address)
         .then((res) => {
           const geoObject = res.geoObjects.get(0);
           if (geoObject) {
-            const coordinates = geoObject.geometry.getCoordinates();
-            const placemark = new window.ymaps.Placemark(
-              coordinates,
-              {
-                balloonContent: `Адрес: ${address}`,
-              },
-              {
-                preset: "islands#blueDeliveryIcon",
-                iconColor: "#2563eb",
-              }
-            );
-            map.geoObjects.add(placemark);
-            map.setCenter(coordinates, 15);
-
-            // Add a smooth zoom animation
-            map.behaviors.disable("scrollZoom");
-            setTimeout(() => {
-              map.setZoom(16, { duration: 1000 });
-            }, 100);
+            showPlacemark(geoObject.geometry.getCoordinates());
           } else {
             setError("Не удалось найти адрес на карте");
           }
@@ -88,7 +110,7 @@ const TrackOrder = () => {
           setIsMapLoading(false);
         });
     });
-  }, [address]);
+  }, [address, coordinates, isOrderLoaded]);
 
   return (
     <Container maxWidth="lg" sx={styles.container}>